@@ -0,0 +1,129 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+
+class EmbeddingQueueFull(Exception):
+    """Raised when the batcher queue is at capacity and the request should be retried later."""
+
+
+class EmbeddingBatcher:
+    """
+    Coalesce concurrent embedding requests into batched encoder calls.
+
+    Requests wait at most `max_wait_ms` for companions (or until
+    `max_batch_size` is reached), then the whole group is encoded in one call on
+    a dedicated worker thread, so the event loop stays free and concurrent
+    requests do not compete for the CPU with separate forward passes.
+    """
+
+    def __init__(self, encode_fn, max_batch_size=32, max_wait_ms=5.0, max_queue_size=1024):
+        """
+        Args:
+            encode_fn (callable): Takes a list of texts, returns an (n, d) array.
+            max_batch_size (int): Max texts per encoder call.
+            max_wait_ms (float): Max time the first request of a batch waits for more.
+            max_queue_size (int): Pending requests allowed before rejecting new ones.
+        """
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_queue_size = max_queue_size
+
+        self._queue = None
+        self._worker = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding-batcher")
+
+        self.requests = 0
+        self.batches = 0
+        self.batched_texts = 0
+        self.rejected = 0
+        self.failed_batches = 0
+
+    async def start(self):
+        if self._worker is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        self._executor.shutdown(wait=False)
+
+    async def submit(self, text):
+        """
+        Queue one text and wait for its vector.
+
+        Args:
+            text (str): Text to encode.
+
+        Returns:
+            np.ndarray: The encoded vector.
+
+        Raises:
+            EmbeddingQueueFull: If too many requests are already pending.
+        """
+        if self._worker is None:
+            raise RuntimeError("EmbeddingBatcher is not started.")
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((text, future))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise EmbeddingQueueFull(f"Embedding queue is full ({self.max_queue_size} pending).")
+        self.requests += 1
+        return await future
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            # 客户端已断开的请求不再参与编码
+            batch = [(text, future) for text, future in batch if not future.done()]
+            if not batch:
+                continue
+            texts = [text for text, _ in batch]
+            try:
+                vectors = await loop.run_in_executor(self._executor, self.encode_fn, texts)
+            except Exception as e:
+                self.failed_batches += 1
+                logging.error(f"Embedding batch of {len(texts)} failed: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.batched_texts += len(texts)
+            for (_, future), vector in zip(batch, vectors):
+                if not future.done():
+                    future.set_result(vector)
+
+    def stats(self):
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "max_queue_size": self.max_queue_size,
+            "requests": self.requests,
+            "batches": self.batches,
+            "avg_batch_size": self.batched_texts / self.batches if self.batches else 0.0,
+            "rejected": self.rejected,
+            "failed_batches": self.failed_batches,
+        }
@@ -0,0 +1,356 @@
+"""
+进程内指标 (Prometheus 文本格式) 与慢请求分析
+
+Counter / Histogram / CallbackMetric 只依赖标准库, 由 Registry.render() 输出
+Prometheus text exposition format (0.0.4), 挂在服务的 /metrics 上. 每个 uvicorn worker
+各自计数, 由 Prometheus 分别抓取后聚合.
+
+MetricsMiddleware 记录每个请求的耗时, 并在 contextvar 中保存本次请求各阶段的耗时 (RequestTrace),
+请求超过 SLOW_REQUEST_MS 时把阶段明细写入 data/slow_requests.jsonl.
+PROFILE_SAMPLE_RATE > 0 时按比例对请求做栈采样 (SlowRequestProfiler): 被采样的请求在途期间,
+后台线程每 PROFILE_INTERVAL_MS 毫秒记录一次所有线程的调用栈, 请求超过阈值时以 folded 格式
+(可直接输入 flamegraph.pl / speedscope) 写入 data/profiles/.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import logging
+import threading
+from collections import Counter as _Counter
+from contextvars import ContextVar
+
+# 请求耗时超过该值 (毫秒) 时记录阶段明细, 0 表示关闭
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", 0))
+# 被栈采样的请求比例 (0 ~ 1), 0 表示关闭; 采样只在慢请求记录开启时生效
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0))
+PROFILE_INTERVAL_MS = float(os.environ.get("PROFILE_INTERVAL_MS", 5))
+
+# 秒; 覆盖缓存命中 (亚毫秒) 到冷启动的视觉模型调用 (数十秒)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+                   60.0, 120.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + list(extra or [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}.")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """
+        Returns:
+            list: (name suffix, label values, extra label pairs, value) tuples.
+        """
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        names = self.labelnames
+        for suffix, values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(names, values, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [("", key, None, value) for key, value in sorted(self._values.items())]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    samples.append(("_bucket", key, [("le", _format_value(bound))], cumulative))
+                samples.append(("_sum", key, None, total))
+                samples.append(("_count", key, None, count))
+        return samples
+
+
+class CallbackMetric(Metric):
+    """
+    Counter or gauge whose values are read at scrape time, for state that
+    other components already track (cache hit counts, index sizes, RSS).
+    """
+
+    def __init__(self, name, documentation, labelnames=(), fn=None, type="gauge"):
+        """
+        Args:
+            fn (callable): Returns {label values tuple: value}; () for an unlabelled metric.
+            type (str): "gauge" or "counter".
+        """
+        super().__init__(name, documentation, labelnames)
+        self.fn = fn
+        self.type = type
+
+    def samples(self):
+        try:
+            values = self.fn()
+        except Exception as e:
+            logging.warning(f"Metric {self.name} failed: {e}")
+            return []
+        return [("", tuple(str(v) for v in key), None, value) for key, value in sorted(values.items())]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered.")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name, documentation, fn, labelnames=(), type="gauge"):
+        return self.register(CallbackMetric(name, documentation, labelnames, fn, type))
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self._metrics.values()) + "\n"
+
+
+def resident_memory_bytes():
+    """
+    当前进程的常驻内存 (RSS); 非 Linux 系统退回到峰值 RSS
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RequestTrace:
+    """
+    Stage timings of the request being served, shared by every task and
+    worker thread that runs with the request's context.
+    """
+
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.stages = []
+        self._lock = threading.Lock()
+
+    def add(self, stage, search_type, ms):
+        with self._lock:
+            self.stages.append({"stage": stage, "search_type": search_type, "ms": ms})
+
+
+current_trace = ContextVar("current_trace", default=None)
+
+
+class SlowRequestProfiler:
+    """
+    Wall-clock stack sampler for a random fraction of requests.
+
+    One daemon thread runs while at least one sampled request is in flight
+    and records the stack of every other thread. Stacks are process-wide, so
+    concurrent requests share their samples.
+    """
+
+    def __init__(self, path, sample_rate=PROFILE_SAMPLE_RATE, interval_ms=PROFILE_INTERVAL_MS):
+        """
+        Args:
+            path (str): Directory for the folded stack files.
+            sample_rate (float): Fraction of requests to sample.
+            interval_ms (float): Sampling interval.
+        """
+        self.path = path
+        self.sample_rate = sample_rate
+        self.interval = interval_ms / 1000.0
+        self._sessions = {}  # id -> 采样计数
+        self._lock = threading.Lock()
+        self._thread = None
+        self.dumped = 0
+
+    def start(self):
+        """
+        Returns:
+            collections.Counter: Folded stack -> samples for a sampled request, else None.
+        """
+        if random.random() >= self.sample_rate:
+            return None
+        session = _Counter()
+        with self._lock:
+            self._sessions[id(session)] = session
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+                self._thread.start()
+        return session
+
+    def stop(self, session):
+        with self._lock:
+            self._sessions.pop(id(session), None)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while True:
+            with self._lock:
+                sessions = list(self._sessions.values())
+                if not sessions:
+                    self._thread = None
+                    return
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                folded = ";".join([names.get(thread_id, str(thread_id))] + stack[::-1])
+                for session in sessions:
+                    session[folded] += 1
+            time.sleep(self.interval)
+
+    def dump(self, session, trace, elapsed_ms):
+        """
+        把一个慢请求的采样栈写为 <时间>_<方法>_<路由>.folded, 返回文件路径
+        """
+        os.makedirs(self.path, exist_ok=True)
+        route = trace.path.strip("/").replace("/", "_") or "root"
+        file_path = os.path.join(self.path, f"{time.strftime('%Y%m%dT%H%M%S')}_{int(elapsed_ms)}ms_"
+                                            f"{trace.method}_{route}_{threading.get_ident()}.folded")
+        with open(file_path, "w", encoding="utf-8") as f:
+            for stack, count in session.most_common():
+                f.write(f"{stack} {count}\n")
+        self.dumped += 1
+        return file_path
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware: request latency histogram, per-request stage traces and
+    slow request dumps. The latency covers the whole response body, so
+    streamed responses are measured until their last event.
+    """
+
+    def __init__(self, app, duration, slow_log_path, slow_ms=SLOW_REQUEST_MS, profiler=None):
+        """
+        Args:
+            app: The wrapped ASGI app.
+            duration (Histogram): Labelled by method, route and status.
+            slow_log_path (str): JSONL file receiving slow requests.
+            slow_ms (float): Slow request threshold, 0 to disable.
+            profiler (SlowRequestProfiler): Optional stack sampler.
+        """
+        self.app = app
+        self.duration = duration
+        self.slow_log_path = slow_log_path
+        self.slow_ms = slow_ms
+        self.profiler = profiler if slow_ms > 0 else None
+        self._log_lock = threading.Lock()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = RequestTrace(scope["method"], scope["path"])
+        token = current_trace.set(trace)
+        session = self.profiler.start() if self.profiler is not None else None
+        status = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - start
+            current_trace.reset(token)
+            if session is not None:
+                self.profiler.stop(session)
+            # 用路由模板而不是实际路径作为标签, 避免标签基数随 URL 增长
+            route = scope.get("route")
+            trace.path = getattr(route, "path", "unmatched")
+            self.duration.observe(elapsed, method=trace.method, route=trace.path, status=status)
+            if self.slow_ms > 0 and elapsed * 1000 >= self.slow_ms:
+                self.log_slow(trace, status, elapsed * 1000, session)
+
+    def log_slow(self, trace, status, elapsed_ms, session):
+        record = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "method": trace.method, "route": trace.path,
+                  "status": status, "ms": round(elapsed_ms, 3), "stages": trace.stages}
+        if session:
+            record["profile"] = self.profiler.dump(session, trace, elapsed_ms)
+        logging.warning(f"Slow request {trace.method} {trace.path}: {elapsed_ms:.1f} ms, stages {trace.stages}")
+        with self._log_lock:
+            with open(self.slow_log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
@@ -1,22 +1,222 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Depends
+from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Depends, Header
+from fastapi.responses import StreamingResponse, Response, RedirectResponse
 from pydantic import BaseModel
-from ..image_processing.ollama_picture_desc import image_to_base64, pic_caption, PROMPT_CAPTION
-from ..search.style_search import all_ai_info, slugs, img_urls, search_index, index4content, index4style, \
-    index4features, index4color, index4all_ai_info
-from sentence_transformers import SentenceTransformer
+from ..image_processing.ollama_picture_desc import AsyncOllamaClient, CaptionStreamParser, PROMPT_CAPTION, \
+    OLLAMA_MODEL
+from ..image_processing.caption_cache import CaptionCache
+from ..image_processing.thumbnail_cache import ThumbnailCache, FORMATS
+from ..image_processing.image_preprocess import prepare_image, image_to_base64, ImageTooLargeError, MAX_IMAGE_BYTES, \
+    DECODE_ERRORS
+from ..search.search_utils import search_unique, fuse_results, FIELD_KEYS
+from ..search.snapshot import SnapshotRegistry, SnapshotError, load_snapshot, current_version, list_versions, \
+    load_snapshot_manifest, check_manifest, set_current_version, write_worker_status, remove_worker_status, worker_statuses
+from ..search.keyword_search import KeywordIndex
+from ..search.embedding import load_text_encoder, encode_texts, normalize_text, truncate_and_normalize, EMBED_DIM, \
+    RERANK_DIM, ENCODER_ID
+from ..search.embedding_cache import EmbeddingCache
+from .embedding_batcher import EmbeddingBatcher, EmbeddingQueueFull
+from .metrics import Registry, MetricsMiddleware, SlowRequestProfiler, current_trace, resident_memory_bytes, \
+    PROFILE_SAMPLE_RATE
+from contextlib import asynccontextmanager, contextmanager
+from fastapi.concurrency import run_in_threadpool
 import numpy as np
-import base64
-from io import BytesIO
-from PIL import Image, UnidentifiedImageError
+from PIL import UnidentifiedImageError
+import os
 import json
+import time
+import logging
+import sqlite3
+import asyncio
+import base64
+import binascii
 from typing import Optional
 import validators  # For URL validation
-from sklearn.preprocessing import normalize
 
-app = FastAPI()
+# Configure logging
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# 动态生成文件路径
+base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+data_dir = os.path.join(base_dir, 'data')
+
+# Initialize text embedding model (ENCODER_BACKEND 选择 PyTorch 或 ONNX Runtime 后端)
+text_encoder = load_text_encoder()
+# 与离线建库共用的向量缓存, 热门查询直接命中不再经过模型; 缓存 RERANK_DIM 维前缀, 短向量由其截断得到
+embedding_cache = EmbeddingCache(os.path.join(data_dir, 'embedding_cache.sqlite'), dim=RERANK_DIM)
+
+# 并发的 embedding 请求在短时间窗口内合并为一次批量编码
+EMBED_BATCH_MAX_SIZE = int(os.environ.get("EMBED_BATCH_MAX_SIZE", 32))
+EMBED_BATCH_MAX_WAIT_MS = float(os.environ.get("EMBED_BATCH_MAX_WAIT_MS", 5))
+EMBED_QUEUE_MAX_SIZE = int(os.environ.get("EMBED_QUEUE_MAX_SIZE", 1024))
+
+# 精排时默认从索引取 k * RERANK_OVERSAMPLE 个候选
+RERANK_OVERSAMPLE = int(os.environ.get("RERANK_OVERSAMPLE", 4))
+
+
+def encode_batch(texts):
+    """
+    在批处理线程上运行: 先查磁盘缓存 (事件循环上只查内存 LRU), 只编码未命中的文本, 同一批中的重复文本只编码一次
+    """
+    vectors = embedding_cache.get_many(texts)
+    missing_texts = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+    if missing_texts:
+        with timed_stage("encode"):
+            encoded = encode_texts(text_encoder, missing_texts, dim=RERANK_DIM)
+        embedding_cache.put_many(missing_texts, encoded)
+        encoded = dict(zip(missing_texts, encoded))
+        vectors = [encoded[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+    return vectors
+
+
+embedding_batcher = EmbeddingBatcher(encode_batch, max_batch_size=EMBED_BATCH_MAX_SIZE,
+                                     max_wait_ms=EMBED_BATCH_MAX_WAIT_MS, max_queue_size=EMBED_QUEUE_MAX_SIZE)
+
+# 异步 Ollama 客户端: 连接池 + 超时 + 并发上限, 慢速图片描述不会阻塞事件循环
+ollama_client = AsyncOllamaClient()
+
+# 图片描述结果缓存, 按图片内容 (sha256) 或感知哈希 (phash) 作为 key
+caption_cache = CaptionCache(
+    os.path.join(data_dir, 'caption_cache.sqlite'), OLLAMA_MODEL, PROMPT_CAPTION,
+    key_mode=os.environ.get("CAPTION_CACHE_KEY_MODE", "sha256"),
+    ttl=float(os.environ.get("CAPTION_CACHE_TTL", 7 * 24 * 3600)),
+    max_entries=int(os.environ.get("CAPTION_CACHE_MAX_ENTRIES", 100000)),
+)
+
+# 结果图缩略图的磁盘缓存 (data/thumbnails/), 未命中时从源站下载一次并生成所有尺寸
+thumbnail_cache = ThumbnailCache()
+# 正在生成的缩略图: img_url -> Future, 同一张图的并发请求只下载一次
+thumbnail_jobs = {}
+THUMBNAIL_MAX_AGE = int(os.environ.get("THUMBNAIL_MAX_AGE", 30 * 24 * 3600))  # 浏览器缓存时间 (秒)
+
+# styles 表上的 FTS5 全文索引, 用于按名称 / 提示词 / 类别精确召回
+keyword_index = KeywordIndex(os.path.join(data_dir, 'midjourney_styles_demo.db'))
+
+# 目录快照: 启动时加载 data/snapshots/CURRENT 指向的版本 (尚未发布过快照时直接使用 data/),
+# 之后每个 worker 每隔 SNAPSHOT_POLL_INTERVAL 秒检查 CURRENT, 变化时在后台加载新版本并原子切换 (0 关闭轮询)
+snapshots = SnapshotRegistry(load_snapshot(current_version()))
+SNAPSHOT_POLL_INTERVAL = float(os.environ.get("SNAPSHOT_POLL_INTERVAL", 5))
+# 本 worker 最近一次加载失败的版本及原因; CURRENT 再次变化前不重试
+snapshot_failure = {"version": None, "error": None}
+# 设置后 admin 接口需要在 X-Admin-Token 请求头中携带该值
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+# 可检索的字段索引
+SEARCH_TYPES = ("content", "style", "features", "color", "all_ai_info")
+
+
+def index_sizes():
+    with snapshots.acquire() as snap:
+        return snap.index_sizes()
+
+
+def cache_hits():
+    embedding = embedding_cache.stats()
+    return {("embedding", "memory"): embedding["memory_hits"], ("embedding", "disk"): embedding["disk_hits"],
+            ("caption", "disk"): caption_cache.stats()["hits"], ("thumbnail", "disk"): thumbnail_cache.stats()["hits"]}
+
+
+def cache_misses():
+    return {("embedding",): embedding_cache.stats()["misses"], ("caption",): caption_cache.stats()["misses"],
+            ("thumbnail",): thumbnail_cache.stats()["misses"]}
+
+
+# Prometheus 指标, 由 /metrics 输出; 阶段耗时按 stage 和 search_type (与具体字段无关的阶段为空) 分组
+metrics = Registry()
+stage_seconds = metrics.histogram("search_stage_duration_seconds", "Latency of each request stage.",
+                                  ("stage", "search_type"))
+request_seconds = metrics.histogram("http_request_duration_seconds",
+                                    "Latency of HTTP requests until the last byte of the body.",
+                                    ("method", "route", "status"))
+caption_parse_failures = metrics.counter("caption_parse_failures_total",
+                                         "Model captions that were not valid JSON.", ("mode",))
+dedup_candidates = metrics.counter("dedup_candidates_total",
+                                   "Index hits fetched by unique-image searches.", ("search_type",))
+dedup_dropped = metrics.counter("dedup_dropped_total",
+                                "Index hits dropped as duplicate images or deleted rows.", ("search_type",))
+metrics.callback("cache_hits_total", "Cache hits.", cache_hits, ("cache", "tier"), type="counter")
+metrics.callback("cache_misses_total", "Cache misses.", cache_misses, ("cache",), type="counter")
+metrics.callback("ollama_failures_total", "Ollama calls that failed after retries.",
+                 lambda: {(op,): n for op, n in ollama_client.stats()["failures"].items()}, ("operation",),
+                 type="counter")
+metrics.callback("embedding_queue_depth", "Texts waiting for the embedding batcher.",
+                 lambda: {(): embedding_batcher.stats()["queue_depth"]})
+metrics.callback("index_vectors", "Vectors in each field index of the current snapshot.",
+                 lambda: {(name,): n for name, (n, _) in index_sizes().items()}, ("search_type",))
+metrics.callback("index_size_bytes", "Serialized size of each field index of the current snapshot.",
+                 lambda: {(name,): size for name, (_, size) in index_sizes().items()}, ("search_type",))
+metrics.callback("process_resident_memory_bytes", "Resident memory of this worker.",
+                 lambda: {(): resident_memory_bytes()})
+
+
+def record_stage(stage, seconds, search_type=""):
+    stage_seconds.observe(seconds, stage=stage, search_type=search_type)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(stage, search_type, round(seconds * 1000, 3))
 
-# Initialize text embedding model
-text_encoder = SentenceTransformer("richinfoai/ritrieve_zh_v1")
+
+@contextmanager
+def timed_stage(stage, search_type=""):
+    """
+    记录一个阶段的耗时: 写入阶段直方图, 并加入当前请求的阶段明细 (慢请求日志使用)
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start, search_type)
+
+
+async def sync_snapshot():
+    """
+    Load the snapshot CURRENT points at if it differs from the active one.
+
+    The snapshot is loaded and validated in a worker thread while the active
+    one keeps serving; a snapshot that fails validation is discarded, the
+    active one stays in place and the failure is reported in the status.
+    """
+    version = await run_in_threadpool(current_version)
+    if version is not None and version not in (snapshots.active.version, snapshot_failure["version"]):
+        try:
+            snapshot = await run_in_threadpool(load_snapshot, version)
+        except SnapshotError as e:
+            logging.error(f"Snapshot {version} rejected: {e}")
+            snapshot_failure.update(version=version, error=str(e))
+        else:
+            snapshots.swap(snapshot)
+            snapshot_failure.update(version=None, error=None)
+    status = {**snapshots.status(), "current": version, "failed": snapshot_failure["version"],
+              "error": snapshot_failure["error"]}
+    await run_in_threadpool(write_worker_status, status)
+
+
+async def poll_snapshots():
+    while True:
+        try:
+            await sync_snapshot()
+        except Exception as e:
+            logging.exception(f"Snapshot poll failed: {e}")
+        await asyncio.sleep(SNAPSHOT_POLL_INTERVAL)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await embedding_batcher.start()
+    poller = asyncio.create_task(poll_snapshots()) if SNAPSHOT_POLL_INTERVAL > 0 else None
+    yield
+    if poller is not None:
+        poller.cancel()
+        remove_worker_status()
+    await embedding_batcher.stop()
+    await ollama_client.aclose()
+    keyword_index.close()
+
+
+app = FastAPI(lifespan=lifespan)
+# 请求耗时直方图; 设置 SLOW_REQUEST_MS 后记录慢请求, 再设置 PROFILE_SAMPLE_RATE 时对部分请求做栈采样
+request_profiler = SlowRequestProfiler(os.path.join(data_dir, 'profiles')) if PROFILE_SAMPLE_RATE > 0 else None
+app.add_middleware(MetricsMiddleware, duration=request_seconds,
+                   slow_log_path=os.path.join(data_dir, 'slow_requests.jsonl'), profiler=request_profiler)
 
 
 # Request and response models
@@ -35,6 +235,10 @@ class StyleSearchRequest(BaseModel):
     query_vector: list[float]
     search_type: str  # e.g., "content", "style", "features", "color", "all_ai_info"
     k: int = 5  # Number of results to return
+    filters: Optional[dict[str, list[str]]] = None  # e.g. {"categories_en": ["photographers"]}
+    # 用更长的前缀对索引召回的候选精排, query_vector 长度不小于 rerank_dim
+    rerank_dim: Optional[int] = None
+    rerank_candidates: Optional[int] = None  # 精排候选数, 默认 k * RERANK_OVERSAMPLE
 
 
 class StyleSearchResponse(BaseModel):
@@ -43,33 +247,71 @@ class StyleSearchResponse(BaseModel):
     slugs: list[str]
     img_urls: list[str]
     desc: list[str]
+    member_slugs: list[list[str]]  # 与结果共用同一张图片的所有 slug
+
+
+class BatchStyleSearchRequest(BaseModel):
+    search_type: str
+    k: int = 5  # Number of results per query
+    query_vectors: Optional[list[list[float]]] = None
+    query_vectors_b64: Optional[str] = None  # base64 of a little-endian float32 (n, d) row-major matrix
+    filters: Optional[dict[str, list[str]]] = None
+    rerank_dim: Optional[int] = None  # 精排时 query 向量的长度 d 等于 rerank_dim
+    rerank_candidates: Optional[int] = None
+
+
+class BatchStyleSearchResponse(BaseModel):
+    results: list[StyleSearchResponse]
+
+
+class FusedSearchRequest(BaseModel):
+    query_vector: list[float]
+    weights: dict[str, float]  # search_type -> weight, e.g. {"style": 0.7, "color": 0.3}
+    k: int = 5  # Number of results to return
+    fusion: str = "rrf"  # "rrf" or "distance"
+    rrf_k: int = 60
+    filters: Optional[dict[str, list[str]]] = None
+
+
+class FusedSearchResponse(BaseModel):
+    scores: list[float]
+    indices: list[int]
+    slugs: list[str]
+    img_urls: list[str]
+    desc: list[str]
+    member_slugs: list[list[str]]
+
+
+class HybridSearchRequest(BaseModel):
+    query: str
+    search_type: str = "all_ai_info"  # 参与融合的向量索引
+    k: int = 5  # Number of results to return
+    mode: str = "hybrid"  # "hybrid" (BM25 + vector) or "keyword" (BM25 only, no text encoding)
+    keyword_weight: float = 1.0
+    vector_weight: float = 1.0
+    rrf_k: int = 60
+    filters: Optional[dict[str, list[str]]] = None
+
+
+class SearchPipelineResponse(StyleSearchResponse):
+    query: str  # 实际编码的文本 (图片检索时为图片描述)
+    caption: Optional[PicCaptionResponse] = None
+    timings: dict[str, float]  # 各阶段耗时 (ms): fetch, caption, embed, search, total
 
 
 class EmbeddingRequest(BaseModel):
     text: str
+    dim: int = EMBED_DIM  # 返回的前缀长度, 最大 RERANK_DIM; 精排检索时取 rerank_dim
 
 
 class EmbeddingResponse(BaseModel):
     vector: list[float]
 
 
-# 处理 URL 请求
-@app.post("/api/v1/pic_caption/url", response_model=PicCaptionResponse)
-async def generate_pic_caption_by_url(request: PicCaptionRequest):
-    if not request.img_url:
-        raise HTTPException(status_code=400, detail="img_url is required")
-
-    # 验证并处理图像 URL
-    if not validators.url(request.img_url):
-        raise HTTPException(status_code=400, detail="Invalid image URL.")
-    img_base64 = image_to_base64(request.img_url)
-    if not img_base64:
-        raise HTTPException(status_code=400, detail="Failed to process the image URL.")
-
-    # 生成描述
-    result = pic_caption(PROMPT_CAPTION, img_base64)
+def parse_caption_result(result):
     try:
-        result_json = json.loads(result)
+        with timed_stage("parse"):
+            result_json = json.loads(result)
         return PicCaptionResponse(
             desc=result_json.get("desc", ""),
             style=result_json.get("style", ""),
@@ -77,92 +319,730 @@ async def generate_pic_caption_by_url(request: PicCaptionRequest):
             color=result_json.get("color", "")
         )
     except json.JSONDecodeError as e:
+        caption_parse_failures.inc(mode="json")
         raise HTTPException(status_code=500, detail=f"Failed to parse the response: {e}")
 
 
-# 处理文件上传请求
-@app.post("/api/v1/pic_caption/file", response_model=PicCaptionResponse)
-async def generate_pic_caption_by_file(file: UploadFile = File(...)):
-    # 处理上传的图像文件
+def decode_image(data):
+    """
+    解码、旋正并缩放图片 (JPEG 用 draft 在解码时降采样), 每个请求只解码一次
+    """
     try:
-        image = Image.open(BytesIO(await file.read()))
-        buffered = BytesIO()
-        image.save(buffered, format="JPEG")
-        img_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
+        with timed_stage("preprocess"):
+            return prepare_image(data)
     except UnidentifiedImageError:
         raise HTTPException(status_code=400, detail="Unsupported image format.")
     except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Failed to process the uploaded image: {e}")
+        raise HTTPException(status_code=400, detail=f"Failed to process the image: {e}")
+
+
+def image_data_to_base64(data, image=None):
+    """
+    缩放并重新编码为 JPEG 后再转 Base64, 减小发送给视觉模型的数据量; 已解码的图片通过 image 传入
+    """
+    if image is None:
+        image = decode_image(data)
+    with timed_stage("jpeg"):
+        return image_to_base64(image)
+
+
+async def cached_caption(data):
+    """
+    phash 模式的感知哈希取自预处理后的图片, 未命中时该图片直接用于生成描述, 不再重新解码
+
+    Returns:
+        tuple: (cache key, cached PicCaptionResponse or None, decoded image or None)
+    """
+    image = await run_in_threadpool(decode_image, data) if caption_cache.needs_image else None
+    key = await run_in_threadpool(caption_cache.key_for, data, image)
+    # SQLite 读写不放在事件循环上
+    cached = await run_in_threadpool(caption_cache.get, key)
+    return key, None if cached is None else PicCaptionResponse(**cached), image
+
+
+async def caption_image(data):
+    """
+    先查图片描述缓存, 未命中时才预处理图片并调用视觉模型
+    """
+    key, cached, image = await cached_caption(data)
+    if cached is not None:
+        return cached
+
+    img_base64 = await run_in_threadpool(image_data_to_base64, data, image)
+    with timed_stage("caption"):
+        result = await ollama_client.pic_caption(PROMPT_CAPTION, img_base64)
+    response = parse_caption_result(result)
+    if any(response.model_dump().values()):
+        await run_in_threadpool(caption_cache.put, key, response.model_dump())
+    return response
+
+
+async def fetch_image_data(img_url):
+    # 验证并下载图像 URL
+    if not validators.url(img_url):
+        raise HTTPException(status_code=400, detail="Invalid image URL.")
+    try:
+        with timed_stage("fetch"):
+            img_data = await ollama_client.fetch_image(img_url)
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    if not img_data:
+        raise HTTPException(status_code=400, detail="Failed to process the image URL.")
+    return img_data
+
+
+async def read_upload(file):
+    img_data = await file.read(MAX_IMAGE_BYTES + 1)
+    if len(img_data) > MAX_IMAGE_BYTES:
+        raise HTTPException(status_code=413, detail=f"Image exceeds the {MAX_IMAGE_BYTES} bytes limit.")
+    return img_data
+
+
+# 处理 URL 请求
+@app.post("/api/v1/pic_caption/url", response_model=PicCaptionResponse)
+async def generate_pic_caption_by_url(request: PicCaptionRequest):
+    if not request.img_url:
+        raise HTTPException(status_code=400, detail="img_url is required")
 
     # 生成描述
-    result = pic_caption(PROMPT_CAPTION, img_base64)
+    return await caption_image(await fetch_image_data(request.img_url))
+
+
+# 处理文件上传请求
+@app.post("/api/v1/pic_caption/file", response_model=PicCaptionResponse)
+async def generate_pic_caption_by_file(file: UploadFile = File(...)):
+    # 处理上传的图像文件, 生成描述
+    return await caption_image(await read_upload(file))
+
+
+def field_index(snap, search_type):
+    """
+    search_type 在快照中对应的 FAISS 索引, 不支持的类型返回 None
+    """
+    return snap.ss.field_indexes[search_type] if search_type in SEARCH_TYPES else None
+
+
+def select_labels(snap, filters):
     try:
-        result_json = json.loads(result)
-        return PicCaptionResponse(
-            desc=result_json.get("desc", ""),
-            style=result_json.get("style", ""),
-            features=result_json.get("features", ""),
-            color=result_json.get("color", "")
-        )
-    except json.JSONDecodeError as e:
-        raise HTTPException(status_code=500, detail=f"Failed to parse the response: {e}")
+        return snap.metadata_filter.select(filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def unique_search(snap, search_type, query_vectors, k, selection):
+    """
+    search_unique, restricted to the selected labels when filters are given.
+    FAISS time and the time spent collapsing duplicate images are recorded as
+    separate stages, along with how many fetched hits were dropped.
+    """
+    index = field_index(snap, search_type)
+    group_ids = snap.ss.index_groups
+    if selection is None:
+        n_candidates = None
+        search_fn = lambda queries, fetch_k: snap.ss.search_field(index, FIELD_KEYS[search_type], queries, fetch_k)
+    else:
+        key = FIELD_KEYS[search_type]
+        n_candidates = selection.count
+        search_fn = lambda queries, fetch_k: snap.metadata_filter.search(index, key, selection, queries, fetch_k)
+
+    faiss_seconds = []
+
+    def timed_search(queries, fetch_k):
+        t = time.perf_counter()
+        D, I = search_fn(queries, fetch_k)
+        faiss_seconds.append(time.perf_counter() - t)
+        fetched, dropped = 0, 0
+        for row in I:
+            groups = group_ids[row[row >= 0]]
+            fetched += len(groups)
+            # 同一图片组的重复行和已删除的行 (组号 -1) 都会被去重丢弃
+            dropped += len(groups) - len(np.unique(groups[groups >= 0]))
+        dedup_candidates.inc(fetched, search_type=search_type)
+        dedup_dropped.inc(dropped, search_type=search_type)
+        return D, I
+
+    start = time.perf_counter()
+    results = search_unique(index, query_vectors, k, group_ids, n_candidates=n_candidates, search_fn=timed_search)
+    total = time.perf_counter() - start
+    record_stage("faiss", sum(faiss_seconds), search_type)
+    record_stage("dedup", total - sum(faiss_seconds), search_type)
+    return results
+
+
+def check_rerank(snap, search_type, rerank_dim, query_dim):
+    limit = snap.ss.rerank_dim_limit(FIELD_KEYS[search_type])
+    if limit == 0:
+        raise HTTPException(status_code=400, detail="Rerank vectors are not available for this search type.")
+    if not 1 <= rerank_dim <= limit:
+        raise HTTPException(status_code=400, detail=f"rerank_dim must be between 1 and {limit}.")
+    if query_dim < rerank_dim:
+        raise HTTPException(status_code=400, detail="Query vector is shorter than rerank_dim.")
+
+
+def ranked_search(snap, search_type, query_vectors, k, selection, rerank_dim=None, rerank_candidates=None):
+    """
+    unique_search over the index; with rerank_dim, more candidates are fetched
+    and re-ordered by the longer prefix of the query vectors before cutting to k
+    """
+    index = field_index(snap, search_type)
+    short_vectors = query_vectors if query_vectors.shape[1] == index.d else \
+        truncate_and_normalize(query_vectors, index.d)
+    if rerank_dim is None:
+        return unique_search(snap, search_type, short_vectors, k, selection)
+    n_candidates = max(k, rerank_candidates or k * RERANK_OVERSAMPLE)
+    results = unique_search(snap, search_type, short_vectors, n_candidates, selection)
+    with timed_stage("rerank", search_type):
+        results = snap.ss.rerank_results(FIELD_KEYS[search_type], query_vectors, results, rerank_dim)
+    return [(distances[:k], labels[:k]) for distances, labels in results]
+
+
+def top_k_search(snap, search_type, query_vector, k, selection):
+    index = field_index(snap, search_type)
+    if selection is not None and selection.count == 0:
+        return np.zeros((len(query_vector), 0), dtype="float32"), np.zeros((len(query_vector), 0), dtype="int64")
+    with timed_stage("faiss", search_type):
+        if selection is None:
+            return snap.ss.search_field(index, FIELD_KEYS[search_type], query_vector, min(k, index.ntotal))
+        return snap.metadata_filter.search(index, FIELD_KEYS[search_type], selection, query_vector,
+                                           min(k, selection.count))
 
 
 # API to perform style search
 @app.post("/api/v1/style_search", response_model=StyleSearchResponse)
 def style_search(request: StyleSearchRequest):
-    # Map search type to the corresponding FAISS index
-    index_map = {
-        "content": index4content,
-        "style": index4style,
-        "features": index4features,
-        "color": index4color,
-        "all_ai_info": index4all_ai_info
-    }
-    index = index_map.get(request.search_type)
-    if not index:
-        raise HTTPException(status_code=400, detail="Invalid search type provided.")
+    with snapshots.acquire() as snap:
+        index = field_index(snap, request.search_type)
+        if not index:
+            raise HTTPException(status_code=400, detail="Invalid search type provided.")
 
-    query_vector = np.array(request.query_vector, dtype="float32").reshape(1, -1)
-    if query_vector.shape[1] != index.d:
-        raise HTTPException(status_code=400, detail="Query vector dimension does not match index dimension.")
-
-    distances, indices = search_index(index, query_vector, request.k)
-    r_idx = indices[0].tolist()
-    r_distances = distances[0].tolist()
-    r_slugs = [slugs[i] for i in r_idx]
-    r_img_urls = [img_urls[i] for i in r_idx]
-    r_all_ai_info = [all_ai_info[i] for i in r_idx]
-
-    # 这里r_img_urls会有重复的url，需要去重，
-    new_r_img_urls = []
-    new_r_slugs = []
-    new_r_all_ai_info = []
-    new_r_distances = []
-    new_r_idx = []
-    for distance_, slug_, img_url_, all_ai_info_, r_idx_ in zip(r_distances, r_slugs, r_img_urls, r_all_ai_info, r_idx):
-        if img_url_ not in new_r_img_urls:
-            new_r_img_urls.append(img_url_)
-            new_r_slugs.append(slug_)
-            new_r_all_ai_info.append(all_ai_info_)
-            new_r_distances.append(distance_)
-            new_r_idx.append(r_idx_)
+        check_k(request.k)
+        query_vector = np.array(request.query_vector, dtype="float32").reshape(1, -1)
+        if request.rerank_dim is not None:
+            check_rerank(snap, request.search_type, request.rerank_dim, query_vector.shape[1])
+        elif query_vector.shape[1] != index.d:
+            raise HTTPException(status_code=400, detail="Query vector dimension does not match index dimension.")
+
+        # 同一张图片可能对应多行, 返回 k 个不同的图片
+        selection = select_labels(snap, request.filters)
+        distances, labels = ranked_search(snap, request.search_type, query_vector, request.k, selection,
+                                          request.rerank_dim, request.rerank_candidates)[0]
+        return build_style_search_response(snap, distances, labels)
+
+
+def check_k(k):
+    if k < 1:
+        raise HTTPException(status_code=400, detail="k must be a positive integer.")
 
+
+def build_style_search_response(snap, distances, labels):
+    # 索引标签 -> 目录行 (折叠索引中一个标签对应一个图片组)
+    ss = snap.ss
+    r_idx = ss.index_rows[labels].tolist()
     return StyleSearchResponse(
-        distances=new_r_distances[:6],
-        indices=new_r_idx[:6],
-        slugs=new_r_slugs[:6],
-        img_urls=new_r_img_urls[:6],
-        desc=new_r_all_ai_info[:6],
+        distances=distances.tolist(),
+        indices=r_idx,
+        slugs=[ss.slugs[i] for i in r_idx],
+        img_urls=[ss.img_urls[i] for i in r_idx],
+        desc=[ss.all_ai_info[i] for i in r_idx],
+        member_slugs=[ss.member_slugs(i) for i in r_idx],
     )
 
 
-# API to generate text embedding
-@app.post("/api/v1/embedding", response_model=EmbeddingResponse)
-def generate_embedding(request: EmbeddingRequest):
+def decode_query_vectors(request, d):
+    if request.query_vectors_b64 is not None:
+        try:
+            raw = base64.b64decode(request.query_vectors_b64, validate=True)
+        except (binascii.Error, ValueError):
+            raise HTTPException(status_code=400, detail="query_vectors_b64 is not valid base64.")
+        if len(raw) % (4 * d) != 0:
+            raise HTTPException(status_code=400, detail=f"Payload size is not a multiple of {d} float32 values.")
+        return np.frombuffer(raw, dtype="<f4").reshape(-1, d)
+    if request.query_vectors is not None:
+        query_vectors = np.array(request.query_vectors, dtype="float32")
+        if query_vectors.ndim != 2 or query_vectors.shape[1] != d:
+            raise HTTPException(status_code=400, detail="Query vector dimension does not match index dimension.")
+        return query_vectors
+    raise HTTPException(status_code=400, detail="query_vectors or query_vectors_b64 is required.")
+
+
+# API to search many query vectors with one FAISS call
+@app.post("/api/v1/style_search/batch", response_model=BatchStyleSearchResponse)
+def batch_style_search(request: BatchStyleSearchRequest):
+    with snapshots.acquire() as snap:
+        index = field_index(snap, request.search_type)
+        if not index:
+            raise HTTPException(status_code=400, detail="Invalid search type provided.")
+
+        check_k(request.k)
+        if request.rerank_dim is not None:
+            check_rerank(snap, request.search_type, request.rerank_dim, request.rerank_dim)
+        query_vectors = decode_query_vectors(request, request.rerank_dim or index.d)
+        if len(query_vectors) == 0:
+            return BatchStyleSearchResponse(results=[])
+        results = ranked_search(snap, request.search_type, query_vectors, request.k,
+                                select_labels(snap, request.filters), request.rerank_dim, request.rerank_candidates)
+        return BatchStyleSearchResponse(
+            results=[build_style_search_response(snap, distances, indices) for distances, indices in results])
+
+
+# API to search several indexes with one query and fuse the rankings
+@app.post("/api/v1/style_search/fused", response_model=FusedSearchResponse)
+def fused_style_search(request: FusedSearchRequest):
+    weights = {search_type: w for search_type, w in request.weights.items() if w > 0}
+    if not weights:
+        raise HTTPException(status_code=400, detail="At least one positive weight is required.")
+    unknown = [search_type for search_type in weights if search_type not in SEARCH_TYPES]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Invalid search type provided: {unknown}.")
+    if request.fusion not in ("rrf", "distance"):
+        raise HTTPException(status_code=400, detail="Invalid fusion method provided.")
+    check_k(request.k)
+
+    query_vector = np.array(request.query_vector, dtype="float32").reshape(1, -1)
+    with snapshots.acquire() as snap:
+        indexes = [field_index(snap, search_type) for search_type in weights]
+        if any(query_vector.shape[1] != index.d for index in indexes):
+            raise HTTPException(status_code=400, detail="Query vector dimension does not match index dimension.")
+
+        # 每个索引多召回一些, 给融合和去重留余量
+        fetch_k = request.k * 4
+        selection = select_labels(snap, request.filters)
+        results = []
+        for search_type in weights:
+            distances, indices = top_k_search(snap, search_type, query_vector, fetch_k, selection)
+            results.append((distances[0], indices[0]))
+        fused_ids, fused_scores = fuse_results(results, list(weights.values()), method=request.fusion,
+                                               rrf_k=request.rrf_k)
+        return build_fused_response(snap, fused_ids, fused_scores, request.k)
+
+
+def build_fused_response(snap, fused_ids, fused_scores, k):
+    ss = snap.ss
+    r_idx, r_scores, seen = [], [], set()
+    for label, score in zip(fused_ids.tolist(), fused_scores.tolist()):
+        # 已删除的标签组号为 -1
+        if int(ss.index_groups[label]) < 0 or int(ss.index_groups[label]) in seen:
+            continue
+        seen.add(int(ss.index_groups[label]))
+        r_idx.append(int(ss.index_rows[label]))
+        r_scores.append(score)
+        if len(r_idx) >= k:
+            break
+
+    return FusedSearchResponse(
+        scores=r_scores,
+        indices=r_idx,
+        slugs=[ss.slugs[i] for i in r_idx],
+        img_urls=[ss.img_urls[i] for i in r_idx],
+        desc=[ss.all_ai_info[i] for i in r_idx],
+        member_slugs=[ss.member_slugs(i) for i in r_idx],
+    )
+
+
+# API to search by text with BM25 (full-text) and vector candidates fused into one ranking
+@app.post("/api/v1/style_search/hybrid", response_model=FusedSearchResponse)
+async def hybrid_style_search(request: HybridSearchRequest):
+    if request.mode not in ("hybrid", "keyword"):
+        raise HTTPException(status_code=400, detail="Invalid search mode provided.")
+    with snapshots.acquire() as snap:
+        index = field_index(snap, request.search_type)
+        if not index:
+            raise HTTPException(status_code=400, detail="Invalid search type provided.")
+        check_k(request.k)
+
+        fetch_k = request.k * 4
+        selection = await run_in_threadpool(select_labels, snap, request.filters)
+        with timed_stage("keyword", request.search_type):
+            hit_slugs, bm25_scores = await run_in_threadpool(keyword_index.search, request.query, fetch_k)
+        query_vector = None
+        if request.mode == "hybrid":
+            query_vector = truncate_and_normalize((await embed_text(request.query)).reshape(1, -1), index.d)
+        # FAISS 检索、去重和融合都是同步计算, 放到线程池里, 不阻塞事件循环
+        return await run_in_threadpool(fuse_hybrid, snap, request, selection, hit_slugs, bm25_scores,
+                                       query_vector, fetch_k)
+
+
+def fuse_hybrid(snap, request, selection, hit_slugs, bm25_scores, query_vector, fetch_k):
+    """
+    Fuse the BM25 hits with the vector search for query_vector (keyword
+    mode passes None) into the hybrid endpoint's response.
+    """
+    selected = None if selection is None else \
+        np.unpackbits(selection.bitmap, count=len(snap.ss.index_rows), bitorder="little").astype(bool)
+    keyword_labels, keyword_scores, seen = [], [], set()
+    for slug, score in zip(hit_slugs, bm25_scores):
+        label = snap.slug_labels.get(slug)
+        if label is None or (selected is not None and not selected[label]):
+            continue
+        # 折叠索引中同一图片的多行对应同一个标签, 只保留排名最高的一次
+        if label not in seen:
+            seen.add(label)
+            keyword_labels.append(label)
+            keyword_scores.append(score)
+
+    results, weights = [], []
+    if keyword_labels:
+        results.append((np.array(keyword_scores, dtype="float32"), np.array(keyword_labels, dtype="int64")))
+        weights.append(request.keyword_weight)
+    if query_vector is not None:
+        distances, indices = top_k_search(snap, request.search_type, query_vector, fetch_k, selection)
+        results.append((distances[0], indices[0]))
+        weights.append(request.vector_weight)
+    if not results:
+        return build_fused_response(snap, np.array([], dtype="int64"), np.array([]), request.k)
+
+    fused_ids, fused_scores = fuse_results(results, weights, method="rrf", rrf_k=request.rrf_k)
+    return build_fused_response(snap, fused_ids, fused_scores, request.k)
+
+
+async def embed_text(text):
+    text = normalize_text(text)
     try:
-        vector = text_encoder.encode([request.text], normalize_embeddings=False)
-        cut_vector = normalize(vector[:, :100])[0]  # Reduce to 100 dimensions
-        return EmbeddingResponse(vector=cut_vector.tolist())
+        with timed_stage("embed"):
+            cut_vector = embedding_cache.get_memory([text])[0]
+            if cut_vector is None:
+                cut_vector = await embedding_batcher.submit(text)  # RERANK_DIM 维前缀
+        return cut_vector
+    except EmbeddingQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to generate embedding: {e}")
+
+
+# API to generate text embedding
+@app.post("/api/v1/embedding", response_model=EmbeddingResponse)
+async def generate_embedding(request: EmbeddingRequest):
+    if not 1 <= request.dim <= RERANK_DIM:
+        raise HTTPException(status_code=400, detail=f"dim must be between 1 and {RERANK_DIM}.")
+    cut_vector = truncate_and_normalize((await embed_text(request.text)).reshape(1, -1), request.dim)[0]
+    return EmbeddingResponse(vector=cut_vector.tolist())
+
+
+def caption_query(caption):
+    # 图片检索时用于编码的文本, 与 webui 之前拼接的方式一致
+    return f"{caption.desc} {caption.style} {caption.features} {caption.color}"
+
+
+def parse_filters(filters):
+    if not filters:
+        return None
+    try:
+        filters = json.loads(filters)
+    except json.JSONDecodeError as e:
+        raise HTTPException(status_code=400, detail=f"filters is not valid JSON: {e}")
+    if not isinstance(filters, dict) or not all(isinstance(values, list) for values in filters.values()):
+        raise HTTPException(status_code=400, detail="filters must map field names to lists of values.")
+    return filters
+
+
+def check_search_params(search_type, k, rerank_dim, filters):
+    """
+    检查 search / search/stream 的表单参数, 返回解析后的过滤条件
+    """
+    if search_type not in SEARCH_TYPES:
+        raise HTTPException(status_code=400, detail="Invalid search type provided.")
+    check_k(k)
+    filters = parse_filters(filters)
+    with snapshots.acquire() as snap:
+        if rerank_dim is not None:
+            check_rerank(snap, search_type, rerank_dim, RERANK_DIM)
+        select_labels(snap, filters)
+    return filters
+
+
+async def read_image_input(img_url, file):
+    # 下载图片的同时在后台预热视觉模型
+    ollama_client.start_warm_up()
+    return await fetch_image_data(img_url) if img_url else await read_upload(file)
+
+
+async def search_text(query, search_type, k, filters, rerank_dim, timings):
+    """
+    编码并检索一段文本, 把 embed / search 两个阶段的耗时 (ms) 写入 timings
+    """
+    t = time.perf_counter()
+    query_vector = (await embed_text(query)).reshape(1, -1)
+    timings["embed"] = round((time.perf_counter() - t) * 1000, 3)
+    t = time.perf_counter()
+    with snapshots.acquire() as snap:
+        # 过滤条件查询 SQLite, 和检索一样不放在事件循环上
+        selection = await run_in_threadpool(select_labels, snap, filters)
+        distances, labels = (await run_in_threadpool(ranked_search, snap, search_type, query_vector, k,
+                                                     selection, rerank_dim))[0]
+        response = build_style_search_response(snap, distances, labels)
+    timings["search"] = round((time.perf_counter() - t) * 1000, 3)
+    return response
+
+
+# API to search by text, image URL or image upload in one call (caption -> embed -> search in-process)
+@app.post("/api/v1/search", response_model=SearchPipelineResponse)
+async def search_pipeline(text: Optional[str] = Form(None), img_url: Optional[str] = Form(None),
+                          file: Optional[UploadFile] = File(None), search_type: str = Form("all_ai_info"),
+                          k: int = Form(6), filters: Optional[str] = Form(None),
+                          rerank_dim: Optional[int] = Form(None)):
+    """
+    Inputs are tried in the order text, img_url, file. For images the Ollama
+    model is warmed up in the background while the image is downloaded.
+    filters is a JSON object as in the style_search endpoints.
+    """
+    start = time.perf_counter()
+    timings = {}
+    filters = check_search_params(search_type, k, rerank_dim, filters)
+
+    caption = None
+    if text and text.strip():
+        query = text
+    elif img_url or file is not None:
+        t = time.perf_counter()
+        img_data = await read_image_input(img_url, file)
+        timings["fetch"] = round((time.perf_counter() - t) * 1000, 3)
+        t = time.perf_counter()
+        caption = await caption_image(img_data)
+        timings["caption"] = round((time.perf_counter() - t) * 1000, 3)
+        query = caption_query(caption)
+        if not query.strip():
+            raise HTTPException(status_code=502, detail="Failed to caption the image.")
+    else:
+        raise HTTPException(status_code=400, detail="text, img_url or file is required.")
+
+    response = await search_text(query, search_type, k, filters, rerank_dim, timings)
+    timings["total"] = round((time.perf_counter() - start) * 1000, 3)
+    return SearchPipelineResponse(**response.model_dump(), query=query, caption=caption, timings=timings)
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+# Same as /api/v1/search, streamed as Server-Sent Events while the caption is generated
+@app.post("/api/v1/search/stream")
+async def search_pipeline_stream(text: Optional[str] = Form(None), img_url: Optional[str] = Form(None),
+                                 file: Optional[UploadFile] = File(None), search_type: str = Form("all_ai_info"),
+                                 k: int = Form(6), filters: Optional[str] = Form(None),
+                                 rerank_dim: Optional[int] = Form(None)):
+    """
+    Events, in order:
+        token    {"text"}: a piece of the caption as the model generates it;
+        field    {"key", "value"}: a caption field, as soon as it is complete;
+        results  SearchPipelineResponse with "partial": true, searched with the
+                 desc field alone while the other fields are still generated;
+        caption  the complete PicCaptionResponse;
+        results  the final results ("partial": false);
+        done     {"timings"}, including first_token and first_result (ms).
+    Text queries only get the final results and done. Failures after the
+    stream has started are sent as an error event.
+    """
+    start = time.perf_counter()
+    filters = check_search_params(search_type, k, rerank_dim, filters)
+    img_data = None
+    if not (text and text.strip()):
+        if not (img_url or file is not None):
+            raise HTTPException(status_code=400, detail="text, img_url or file is required.")
+        img_data = await read_image_input(img_url, file)
+    fetch_ms = round((time.perf_counter() - start) * 1000, 3)
+
+    def elapsed():
+        return round((time.perf_counter() - start) * 1000, 3)
+
+    def results_event(response, query, caption, partial, timings):
+        return sse_event("results", {**response.model_dump(), "query": query, "partial": partial,
+                                     "caption": None if caption is None else caption.model_dump(),
+                                     "timings": timings})
+
+    async def events():
+        timings = {} if img_data is None else {"fetch": fetch_ms}
+        early_search, early_sent = None, False
+        try:
+            if img_data is None:
+                query, caption = text, None
+            else:
+                key, caption, image = await cached_caption(img_data)
+                if caption is None:
+                    img_base64 = await run_in_threadpool(image_data_to_base64, img_data, image)
+                    parser = CaptionStreamParser()
+                    caption_start = time.perf_counter()
+                    async for token in ollama_client.stream_caption(PROMPT_CAPTION, img_base64):
+                        timings.setdefault("first_token", elapsed())
+                        yield sse_event("token", {"text": token})
+                        for field, value in parser.feed(token):
+                            yield sse_event("field", {"key": field, "value": value})
+                            # desc 生成完就先用它检索一次, 其余字段仍在生成
+                            if field == "desc" and value.strip() and early_search is None:
+                                early_search = asyncio.create_task(
+                                    search_text(value, search_type, k, filters, rerank_dim, {}))
+                                # 取走异常, 提前检索失败不会留下 "exception was never retrieved" 日志
+                                early_search.add_done_callback(lambda task: task.cancelled() or task.exception())
+                        if early_search is not None and early_search.done() and not early_sent:
+                            early_sent = True
+                            # 提前检索失败时只跳过部分结果, 最终检索照常进行
+                            if early_search.exception() is None:
+                                timings["first_result"] = elapsed()
+                                yield results_event(early_search.result(), parser.fields["desc"], None, True, {})
+                    record_stage("caption", time.perf_counter() - caption_start)
+                    caption = PicCaptionResponse(**parser.result())
+                    if parser.parse_error is not None:
+                        caption_parse_failures.inc(mode="stream")
+                    if any(caption.model_dump().values()):
+                        await run_in_threadpool(caption_cache.put, key, caption.model_dump())
+                if early_search is not None and not early_sent:
+                    early_search.cancel()
+                timings["caption"] = elapsed()
+                yield sse_event("caption", caption.model_dump())
+                query = caption_query(caption)
+                if not query.strip():
+                    raise HTTPException(status_code=502, detail="Failed to caption the image.")
+
+            response = await search_text(query, search_type, k, filters, rerank_dim, timings)
+            timings.setdefault("first_result", elapsed())
+            yield results_event(response, query, caption, False, timings)
+        except HTTPException as e:
+            yield sse_event("error", {"status_code": e.status_code, "detail": e.detail})
+        except Exception as e:
+            yield sse_event("error", {"status_code": 500, "detail": f"Search failed: {e}"})
+        finally:
+            # 客户端断开 (生成器被关闭) 或出错时, 提前检索不再继续运行
+            if early_search is not None:
+                early_search.cancel()
+        timings["total"] = elapsed()
+        yield sse_event("done", {"timings": timings})
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/api/v1/style_search/filters")
+def style_search_filters():
+    # 可用的过滤字段和取值 (附匹配的索引标签数)
+    with snapshots.acquire() as snap:
+        return snap.metadata_filter.values()
+
+
+@app.get("/metrics")
+def prometheus_metrics():
+    # Prometheus text exposition format, 每个 worker 单独计数
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/api/v1/embedding/stats")
+def embedding_stats():
+    return {"encoder": ENCODER_ID, "cache": embedding_cache.stats(), "batcher": embedding_batcher.stats()}
+
+
+def is_catalog_image(img_url):
+    # 只代理目录中的图片, 避免被当作任意 URL 的代理 (img_url 列有索引)
+    conn = sqlite3.connect(os.path.join(data_dir, 'midjourney_styles_demo.db'))
+    try:
+        return conn.execute("SELECT 1 FROM styles WHERE img_url=? LIMIT 1", (img_url,)).fetchone() is not None
+    finally:
+        conn.close()
+
+
+async def generate_thumbnails(img_url):
+    """
+    下载一张目录图片并生成所有尺寸的缩略图; 同一张图的并发请求共用一次下载
+    """
+    job = thumbnail_jobs.get(img_url)
+    if job is None:
+        async def run():
+            try:
+                data = await ollama_client.fetch_image(img_url)
+                if data is None:
+                    return False
+                await run_in_threadpool(thumbnail_cache.put, img_url, data)
+                return True
+            except DECODE_ERRORS:
+                return False
+            finally:
+                thumbnail_jobs.pop(img_url, None)
+
+        job = thumbnail_jobs[img_url] = asyncio.ensure_future(run())
+    return await asyncio.shield(job)
+
+
+# Resized catalog image from the local thumbnail cache
+@app.get("/api/v1/thumbnail")
+async def thumbnail(url: str, w: Optional[int] = None, fmt: Optional[str] = None, accept: Optional[str] = Header(None),
+                    if_none_match: Optional[str] = Header(None)):
+    """
+    Args:
+        url: img_url of a catalog style.
+        w: One of THUMBNAIL_WIDTHS, the smallest by default.
+        fmt: "webp" or "jpeg"; by default WebP when the Accept header allows it.
+    """
+    width = w or min(thumbnail_cache.widths)
+    if width not in thumbnail_cache.widths:
+        raise HTTPException(status_code=400, detail=f"w must be one of {list(thumbnail_cache.widths)}.")
+    if fmt is None:
+        fmt = "webp" if "image/webp" in (accept or "") else "jpeg"
+    elif fmt not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"fmt must be one of {list(FORMATS)}.")
+
+    cached = await run_in_threadpool(thumbnail_cache.get, url, width, fmt)
+    if cached is None:
+        if not await run_in_threadpool(is_catalog_image, url):
+            raise HTTPException(status_code=404, detail="Not a catalog image.")
+        if not await generate_thumbnails(url):
+            # 源站不可用或图片无法解码时退回原图
+            return RedirectResponse(url, status_code=307)
+        cached = await run_in_threadpool(thumbnail_cache.get, url, width, fmt)
+    data, etag = cached
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={THUMBNAIL_MAX_AGE}", "Vary": "Accept"}
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=data, media_type=FORMATS[fmt][1], headers=headers)
+
+
+@app.get("/api/v1/thumbnail/stats")
+def thumbnail_stats():
+    return {"cache": thumbnail_cache.stats(), "in_progress": len(thumbnail_jobs)}
+
+
+@app.get("/api/v1/pic_caption/stats")
+def pic_caption_stats():
+    return {"cache": caption_cache.stats()}
+
+
+class SnapshotReloadRequest(BaseModel):
+    version: Optional[str] = None  # 缺省为 data/snapshots/CURRENT 指向的版本
+
+
+def check_admin_token(x_admin_token: Optional[str] = Header(None)):
+    if ADMIN_TOKEN and x_admin_token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Invalid admin token.")
+
+
+def snapshot_workers():
+    # 超过 3 个轮询周期没有更新状态的 worker 视为已退出
+    return worker_statuses(max_age=3 * max(SNAPSHOT_POLL_INTERVAL, 1))
+
+
+# Snapshot CURRENT points at and the one every API worker is serving
+@app.get("/api/v1/admin/snapshot", dependencies=[Depends(check_admin_token)])
+def snapshot_status():
+    return {"current": current_version(), "workers": snapshot_workers()}
+
+
+# Point CURRENT at a snapshot; every worker picks it up on its next poll
+@app.post("/api/v1/admin/snapshot/reload", dependencies=[Depends(check_admin_token)])
+def reload_snapshot(request: SnapshotReloadRequest):
+    """
+    Only the manifest is checked (409 if the snapshot was built for another
+    model or dimension) and CURRENT updated here. Each worker loads,
+    validates and swaps in the new snapshot within SNAPSHOT_POLL_INTERVAL
+    seconds; the per-worker status (active version, last rejected version
+    and error) is returned and can be polled with GET /api/v1/admin/snapshot.
+    """
+    previous = current_version()
+    version = request.version or previous
+    if version is None:
+        raise HTTPException(status_code=404, detail="No snapshot has been published.")
+    if version not in list_versions():
+        raise HTTPException(status_code=404, detail=f"Snapshot {version} not found.")
+    try:
+        check_manifest(version, load_snapshot_manifest(version))
+    except SnapshotError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if version != previous:
+        set_current_version(version)
+    return {"current": version, "previous": previous, "changed": version != previous,
+            "workers": snapshot_workers()}
@@ -1,82 +1,203 @@
+"""
+JSONL -> SQLite 入库
+
+流式读取 JSONL, 每批在一个事务中 executemany 写入, 主键冲突时更新已有行 (可重复运行).
+
+用法:
+    python -m src.database.process_data --batch-size 1000
+    python -m src.database.process_data --index-only  # 只为已有数据库建立索引
+"""
+import os
 import json
+import time
 import sqlite3
-import random
-
-conn = sqlite3.connect('data/midjourney_styles_demo.db')
-
-# Create a table
-conn.execute('''
-    CREATE TABLE IF NOT EXISTS styles (
-        id TEXT PRIMARY KEY,
-        name_zh TEXT,
-        name_en TEXT,
-        categories_zh TEXT,
-        categories_en TEXT,
-        features_zh TEXT,
-        features_en TEXT,
-        slug TEXT,
-        slug_new TEXT,
-        img_url TEXT,
-        createdAt TEXT,
-        promptBasic TEXT,
-        type_zh TEXT,
-        type_en TEXT,
-        desc_zh TEXT,
-        desc_en TEXT,
-        ai_desc_zh TEXT,
-        ai_style_zh TEXT,
-        ai_features_zh TEXT,
-        ai_color_zh TEXT,
-        ai_desc_en TEXT,
-        ai_style_en TEXT,
-        ai_features_en TEXT,
-        ai_color_en TEXT
-    )
-''')
-
-
-# Insert data
-def insert_data(data):
-    conn.execute("""
-    INSERT INTO styles (id, name_zh, name_en, categories_zh, categories_en, features_zh, features_en, slug, slug_new, img_url, createdAt, promptBasic, type_zh, type_en, desc_zh, desc_en, ai_desc_zh, ai_style_zh, ai_features_zh, ai_color_zh, ai_desc_en, ai_style_en, ai_features_en, ai_color_en)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
-        str(data['id']) + str(data["slug_new"]), data['name_zh'], data['name_en'], data['categories_zh'],
-        data['categories_en'],
-        data['features_zh'], data['features_en'], data['slug'], data['slug_new'], data['img_url'],
-        data['createdAt'], data['promptBasic'], data['type_zh'], data['type_en'], data['desc_zh'],
-        data['desc_en'], data['ai_desc_zh'], data['ai_style_zh'], data['ai_features_zh'],
-        data['ai_color_zh'], data['ai_desc_en'], data['ai_style_en'], data['ai_features_en'],
-        data['ai_color_en']
-    ))
+import logging
+import argparse
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+# 动态生成文件路径
+base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+data_dir = os.path.join(base_dir, 'data')
+
+db_path = os.path.join(data_dir, 'midjourney_styles_demo.db')
+jsonl_file_path = os.path.join(data_dir, 'midjoury_styles_lib_final_zh_en_demo.jsonl')
+
+COLUMNS = [
+    "id", "name_zh", "name_en", "categories_zh", "categories_en", "features_zh", "features_en", "slug", "slug_new",
+    "img_url", "createdAt", "promptBasic", "type_zh", "type_en", "desc_zh", "desc_en", "ai_desc_zh", "ai_style_zh",
+    "ai_features_zh", "ai_color_zh", "ai_desc_en", "ai_style_en", "ai_features_en", "ai_color_en",
+]
+
+# 全文检索 (FTS5) 覆盖的字段及其 BM25 权重: 名称最高, 其次是提示词、类别、特征和描述
+FTS_COLUMNS = {
+    "name_zh": 10.0,
+    "name_en": 10.0,
+    "promptBasic": 5.0,
+    "categories_zh": 3.0,
+    "categories_en": 3.0,
+    "features_zh": 2.0,
+    "features_en": 2.0,
+    "desc_zh": 1.0,
+    "desc_en": 1.0,
+}
+
+UPSERT_SQL = f"""
+    INSERT INTO styles ({", ".join(COLUMNS)})
+    VALUES ({", ".join("?" * len(COLUMNS))})
+    ON CONFLICT(id) DO UPDATE SET {", ".join(f"{col}=excluded.{col}" for col in COLUMNS[1:])}
+"""
+
+
+def connect(path=db_path):
+    """
+    打开数据库并设置批量写入用的 pragma: WAL 模式下读写互不阻塞, synchronous=NORMAL 只在检查点时 fsync
+    """
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")  # 64 MB
+    return conn
+
+
+def create_schema(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS styles (
+            id TEXT PRIMARY KEY,
+            name_zh TEXT,
+            name_en TEXT,
+            categories_zh TEXT,
+            categories_en TEXT,
+            features_zh TEXT,
+            features_en TEXT,
+            slug TEXT,
+            slug_new TEXT,
+            img_url TEXT,
+            createdAt TEXT,
+            promptBasic TEXT,
+            type_zh TEXT,
+            type_en TEXT,
+            desc_zh TEXT,
+            desc_en TEXT,
+            ai_desc_zh TEXT,
+            ai_style_zh TEXT,
+            ai_features_zh TEXT,
+            ai_color_zh TEXT,
+            ai_desc_en TEXT,
+            ai_style_en TEXT,
+            ai_features_en TEXT,
+            ai_color_en TEXT
+        )
+    ''')
+    # 按 slug / slug_new / img_url 查询时使用的索引
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_styles_slug ON styles (slug)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_styles_slug_new ON styles (slug_new)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_styles_img_url ON styles (img_url)")
+    conn.commit()
+    create_fts(conn)
+
+
+def create_fts(conn):
+    """
+    Create the styles_fts full-text index over FTS_COLUMNS and the triggers
+    that keep it in sync with the styles table.
+
+    styles_fts is an external-content table (it stores only the index, the
+    text stays in styles). The trigram tokenizer matches substrings of three
+    or more characters, which works for Chinese text without a word segmenter.
+    An index created on a table that already has rows is rebuilt once.
+    """
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='styles_fts'").fetchone()
+    columns = ", ".join(FTS_COLUMNS)
+    new_values = ", ".join(f"new.{col}" for col in FTS_COLUMNS)
+    old_values = ", ".join(f"old.{col}" for col in FTS_COLUMNS)
+    conn.executescript(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS styles_fts USING fts5(
+            {columns}, content='styles', content_rowid='rowid', tokenize='trigram'
+        );
+        CREATE TRIGGER IF NOT EXISTS styles_fts_insert AFTER INSERT ON styles BEGIN
+            INSERT INTO styles_fts (rowid, {columns}) VALUES (new.rowid, {new_values});
+        END;
+        CREATE TRIGGER IF NOT EXISTS styles_fts_delete AFTER DELETE ON styles BEGIN
+            INSERT INTO styles_fts (styles_fts, rowid, {columns}) VALUES ('delete', old.rowid, {old_values});
+        END;
+        CREATE TRIGGER IF NOT EXISTS styles_fts_update AFTER UPDATE ON styles BEGIN
+            INSERT INTO styles_fts (styles_fts, rowid, {columns}) VALUES ('delete', old.rowid, {old_values});
+            INSERT INTO styles_fts (rowid, {columns}) VALUES (new.rowid, {new_values});
+        END;
+    """)
+    if not exists:
+        conn.execute("INSERT INTO styles_fts (styles_fts) VALUES ('rebuild')")
+        logging.info("Built full-text index styles_fts.")
     conn.commit()
 
 
-# 批量插入数据
-def insert_data_batch(data_list):
-    for data in data_list:
-        insert_data(data)
-    conn.commit()
-    print("Data inserted successfully.")
+def to_row(data):
+    """
+    JSONL 中的一条记录 -> styles 表的一行, 主键为 id + slug_new
+    """
+    return (str(data['id']) + str(data["slug_new"]),) + tuple(data.get(col) for col in COLUMNS[1:])
 
 
-# Load data from JSONL file and insert into database
-def get_batch_data(file_path, batch_size):
-    with open(file_path, 'r', encoding="utf-8") as f:
-        lines = f.readlines()
-        # 随机打乱数据
-        random.shuffle(lines)
+def iter_batches(file_path, batch_size):
+    """
+    Stream a JSONL file in batches of table rows.
 
-        for i in range(0, len(lines), batch_size):
-            batch_data = []
-            for line in lines[i:i + batch_size]:
-                data = eval(line)
-                batch_data.append(data)
-            yield batch_data
+    Malformed lines and lines without id / slug_new are logged and skipped.
+
+    Args:
+        file_path (str): Source JSONL file.
+        batch_size (int): Rows per batch.
+
+    Yields:
+        list: Row tuples in COLUMNS order.
+    """
+    batch = []
+    with open(file_path, 'r', encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                batch.append(to_row(json.loads(line)))
+            except (json.JSONDecodeError, KeyError, TypeError) as e:
+                logging.warning(f"Skipping line {line_no} of {file_path}: {e!r}")
+                continue
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def ingest(conn, file_path=jsonl_file_path, batch_size=1000):
+    """
+    Upsert every record of a JSONL file into the styles table.
+
+    Each batch is written with one executemany inside one transaction, so a
+    failure rolls back only the current batch and re-running is safe.
+
+    Args:
+        conn (sqlite3.Connection): Connection from `connect`.
+        file_path (str): Source JSONL file.
+        batch_size (int): Rows per transaction.
+
+    Returns:
+        int: Number of rows written.
+    """
+    total = 0
+    start = time.perf_counter()
+    for batch in iter_batches(file_path, batch_size):
+        with conn:
+            conn.executemany(UPSERT_SQL, batch)
+        total += len(batch)
+    logging.info(f"Upserted {total} rows from {file_path} in {time.perf_counter() - start:.2f}s.")
+    return total
 
 
 # sqlite3 数据库查询
-def query_data():
+def query_data(conn):
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM styles")
     print("Querying data from database...")
@@ -88,7 +209,7 @@ def query_data():
 
 
 # 按照id查询
-def query_by_id(id):
+def query_by_id(conn, id):
     cursor = conn.cursor()
     cursor.execute("SELECT * FROM styles WHERE id=?", (id,))
     row = cursor.fetchone()
@@ -99,15 +220,27 @@ def query_by_id(id):
     cursor.close()
 
 
-
-# 批量插入数据
-batch_size = 1000
-file_path = 'data/midjoury_styles_lib_final_zh_en_demo.jsonl'
-for batch_data in get_batch_data(file_path, batch_size):
-    insert_data_batch(batch_data)
-
-# 查询数据
-# query_data()
-
-# 查询单条数据
-# query_by_id('1')
+def main():
+    parser = argparse.ArgumentParser(description="Load the style JSONL into the SQLite styles table.")
+    parser.add_argument("--input", default=jsonl_file_path, help="Source JSONL file.")
+    parser.add_argument("--db", default=db_path, help="SQLite database file.")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Rows per transaction.")
+    parser.add_argument("--index-only", action="store_true",
+                        help="Only create the indexes (including the full-text index) on an existing database.")
+    args = parser.parse_args()
+
+    conn = connect(args.db)
+    try:
+        # 表结构、普通索引和全文索引都在这里建立, API 启动时只检查不建立
+        create_schema(conn)
+        if not args.index_only:
+            ingest(conn, args.input, batch_size=args.batch_size)
+        # 合并 WAL 文件, 数据库文件可以直接拷贝使用
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("PRAGMA optimize")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+"""
+批量图片描述: 为整个目录 (重新) 生成 ai_desc_zh / ai_style_zh / ai_features_zh / ai_color_zh
+
+从 styles 表或 JSONL 读取 (id, img_url), 图片下载与模型调用分成两个并发池, 中间用有界队列衔接:
+下载池并发拉取并预处理图片, 描述池按 --rate 限速调用 Ollama. 结果按批写入 SQLite 的 caption_jobs 表
+(同一事务内更新 styles 表的 ai_*_zh 字段), 中途崩溃后重新运行会跳过已成功的行.
+任务按模型名 + 提示词区分, 更换模型后重新运行会重新生成全部描述.
+
+用法:
+    python -m src.image_processing.bulk_caption --fetch-concurrency 16 --caption-concurrency 2
+    python -m src.image_processing.bulk_caption --source jsonl --export data/styles_recaptioned.jsonl
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import argparse
+from collections import Counter
+
+import httpx
+
+from .image_preprocess import preprocess_to_base64, ImageTooLargeError, DECODE_ERRORS
+from .ollama_picture_desc import AsyncOllamaClient, PROMPT_CAPTION, OLLAMA_API, OLLAMA_MODEL, CAPTION_FIELDS
+from ..database.process_data import db_path, jsonl_file_path, to_row, connect
+
+# 描述字段 -> styles 表中的列
+AI_COLUMNS = {field: f"ai_{field}_zh" for field in CAPTION_FIELDS}
+
+UPSERT_JOB_SQL = f"""
+    INSERT INTO caption_jobs (id, namespace, status, {", ".join(CAPTION_FIELDS)}, error, attempts, updated_at)
+    VALUES (?, ?, ?, {", ".join("?" * len(CAPTION_FIELDS))}, ?, 1, ?)
+    ON CONFLICT(id, namespace) DO UPDATE SET
+        status=excluded.status, {", ".join(f"{field}=excluded.{field}" for field in CAPTION_FIELDS)},
+        error=excluded.error, attempts=caption_jobs.attempts + 1, updated_at=excluded.updated_at
+"""
+UPDATE_STYLES_SQL = f"""
+    UPDATE styles SET {", ".join(f"{column}=?" for column in AI_COLUMNS.values())} WHERE id=?
+"""
+
+
+def job_namespace(model, prompt):
+    return hashlib.sha256(f"{model}\x00{prompt}".encode("utf-8")).hexdigest()[:16]
+
+
+def create_job_table(conn):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS caption_jobs (
+            id TEXT NOT NULL,
+            namespace TEXT NOT NULL,
+            status TEXT NOT NULL,
+            {", ".join(f"{field} TEXT" for field in CAPTION_FIELDS)},
+            error TEXT,
+            attempts INTEGER NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (id, namespace)
+        )
+    """)
+    conn.commit()
+
+
+def completed_ids(conn, namespace):
+    return {row[0] for row in conn.execute(
+        "SELECT id FROM caption_jobs WHERE namespace=? AND status='ok'", (namespace,))}
+
+
+def iter_db_items(conn):
+    """
+    styles 表中的 (id, img_url)
+    """
+    yield from conn.execute("SELECT id, img_url FROM styles ORDER BY rowid")
+
+
+def iter_jsonl_items(file_path):
+    """
+    JSONL 中的 (id, img_url), id 与入库时的主键一致 (id + slug_new)
+    """
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                data = json.loads(line)
+                yield to_row(data)[0], data.get("img_url")
+            except (json.JSONDecodeError, KeyError, TypeError) as e:
+                logging.warning(f"Skipping malformed line of {file_path}: {e!r}")
+
+
+class RateLimiter:
+    """
+    Spaces out call starts to at most `rate` per second (0 disables).
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class ResultWriter:
+    """
+    Buffers results and writes them in one transaction per batch: the
+    caption_jobs row and, if enabled, the ai_*_zh columns of styles.
+    A crash loses at most the current batch.
+    """
+
+    def __init__(self, conn, namespace, update_styles=True, batch_size=50, flush_interval=5.0):
+        self.conn = conn
+        self.namespace = namespace
+        self.update_styles = update_styles
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._last_flush = time.monotonic()
+
+    def add(self, item_id, caption=None, error=None):
+        self._pending.append((item_id, caption, error))
+        if len(self._pending) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self._last_flush = time.monotonic()
+        if not self._pending:
+            return
+        now = time.time()
+        jobs, styles = [], []
+        for item_id, caption, error in self._pending:
+            values = [caption[field] if caption else None for field in CAPTION_FIELDS]
+            jobs.append((item_id, self.namespace, "ok" if caption else "failed", *values, error, now))
+            if caption:
+                styles.append((*values, item_id))
+        with self.conn:
+            self.conn.executemany(UPSERT_JOB_SQL, jobs)
+            if self.update_styles and styles:
+                self.conn.executemany(UPDATE_STYLES_SQL, styles)
+        self._pending = []
+
+
+class Progress:
+    """
+    成功 / 失败计数, 定期打印吞吐量和预计剩余时间
+    """
+
+    def __init__(self, total, log_interval=10.0):
+        self.total = total
+        self.log_interval = log_interval
+        self.ok = 0
+        self.failures = Counter()
+        self.start = time.perf_counter()
+        self._last_log = self.start
+
+    @property
+    def done(self):
+        return self.ok + sum(self.failures.values())
+
+    def record(self, error_kind=None):
+        if error_kind is None:
+            self.ok += 1
+        else:
+            self.failures[error_kind] += 1
+        now = time.perf_counter()
+        if now - self._last_log >= self.log_interval:
+            self._last_log = now
+            self.log()
+
+    def log(self):
+        elapsed = time.perf_counter() - self.start
+        rate = self.done / elapsed if elapsed else 0.0
+        eta = (self.total - self.done) / rate if rate else float("inf")
+        logging.info(f"{self.done}/{self.total} done ({self.ok} ok, {sum(self.failures.values())} failed), "
+                     f"{rate:.2f} images/s, ETA {eta / 60:.1f} min.")
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        return {
+            "total": self.total,
+            "ok": self.ok,
+            "failed": sum(self.failures.values()),
+            "failures": dict(self.failures),
+            "elapsed_s": round(elapsed, 3),
+            "images_per_s": round(self.done / elapsed, 3) if elapsed else 0.0,
+        }
+
+
+def parse_caption(text):
+    """
+    Returns:
+        dict: One string per CAPTION_FIELDS key, or None if the model output
+            is not a JSON object with at least one non-empty field.
+    """
+    try:
+        parsed = json.loads(text)
+    except (json.JSONDecodeError, TypeError):
+        return None
+    if not isinstance(parsed, dict):
+        return None
+    caption = {field: str(parsed.get(field) or "") for field in CAPTION_FIELDS}
+    return caption if any(caption.values()) else None
+
+
+async def run_job(items, client, writer, progress, fetch_concurrency=16, caption_concurrency=2, rate=0.0,
+                  queue_size=None):
+    """
+    Caption every (id, img_url) item and hand the results to the writer.
+
+    Fetch workers download and preprocess images into a bounded queue;
+    caption workers take from it, so at most queue_size preprocessed images
+    wait in memory while the model is the bottleneck.
+
+    Args:
+        items (list): (id, img_url) pairs.
+        client (AsyncOllamaClient): Shared client; its semaphore should allow caption_concurrency calls.
+        writer (ResultWriter): Receives every result.
+        progress (Progress): Receives every outcome.
+        fetch_concurrency (int): Concurrent image downloads.
+        caption_concurrency (int): Concurrent model calls.
+        rate (float): Max model calls started per second (0 for no limit).
+        queue_size (int): Preprocessed images buffered between the pools (default 2 * caption_concurrency).
+    """
+    todo = asyncio.Queue()
+    for item in items:
+        todo.put_nowait(item)
+    ready = asyncio.Queue(maxsize=queue_size or 2 * caption_concurrency)
+    limiter = RateLimiter(rate)
+
+    def fail(item_id, kind, error):
+        writer.add(item_id, error=f"{kind}: {error}")
+        progress.record(kind)
+
+    async def fetch_worker():
+        while not todo.empty():
+            item_id, img_url = todo.get_nowait()
+            if not img_url:
+                fail(item_id, "no_image", "img_url is empty")
+                continue
+            try:
+                data = await client.fetch_image(img_url)
+            except (ImageTooLargeError, httpx.InvalidURL) as e:
+                # 单张图片的错误只记入该条目, 不能让 worker 退出 (gather 会因此中止整个任务)
+                fail(item_id, "fetch", e)
+                continue
+            if data is None:
+                fail(item_id, "fetch", f"failed to download {img_url}")
+                continue
+            try:
+                img_base64 = await asyncio.to_thread(preprocess_to_base64, data)
+            except DECODE_ERRORS as e:
+                fail(item_id, "decode", e)
+                continue
+            await ready.put((item_id, img_base64))
+
+    async def caption_worker():
+        while True:
+            item_id, img_base64 = await ready.get()
+            try:
+                await limiter.wait()
+                text = await client.pic_caption(PROMPT_CAPTION, img_base64, raise_errors=True)
+                caption = parse_caption(text)
+                if caption is None:
+                    fail(item_id, "caption", f"unusable model output: {text[:200]!r}")
+                else:
+                    writer.add(item_id, caption=caption)
+                    progress.record()
+            except httpx.HTTPError as e:
+                # 重试之后 Ollama 仍然不可用或返回错误状态码
+                fail(item_id, "ollama", repr(e))
+            except Exception as e:
+                fail(item_id, "caption", repr(e))
+            finally:
+                ready.task_done()
+
+    captioners = [asyncio.create_task(caption_worker()) for _ in range(caption_concurrency)]
+    try:
+        await asyncio.gather(*(fetch_worker() for _ in range(fetch_concurrency)))
+        await ready.join()
+    finally:
+        for task in captioners:
+            task.cancel()
+        writer.flush()
+
+
+def export_jsonl(conn, namespace, input_path, output_path):
+    """
+    Write the source JSONL with the ai_*_zh fields replaced by the successful
+    captions of this job, for `vector.py`.
+
+    Returns:
+        int: Number of lines with a new caption.
+    """
+    captions = {row[0]: row[1:] for row in conn.execute(
+        f"SELECT id, {', '.join(CAPTION_FIELDS)} FROM caption_jobs WHERE namespace=? AND status='ok'", (namespace,))}
+    updated = 0
+    tmp_path = output_path + ".tmp"
+    with open(input_path, "r", encoding="utf-8") as src, open(tmp_path, "w", encoding="utf-8") as dst:
+        for line in src:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            values = captions.get(to_row(data)[0])
+            if values is not None:
+                data.update(zip(AI_COLUMNS.values(), values))
+                updated += 1
+            dst.write(json.dumps(data, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, output_path)
+    return updated
+
+
+async def run(args):
+    conn = connect(args.db)
+    create_job_table(conn)
+    namespace = job_namespace(args.model, PROMPT_CAPTION)
+    done = set() if args.restart else completed_ids(conn, namespace)
+
+    source = iter_db_items(conn) if args.source == "db" else iter_jsonl_items(args.input)
+    items = [(item_id, img_url) for item_id, img_url in source if item_id not in done]
+    if args.limit:
+        items = items[:args.limit]
+    logging.info(f"Captioning {len(items)} images with {args.model} ({len(done)} already done, job {namespace}).")
+
+    client = AsyncOllamaClient(api_url=args.api, model=args.model, max_concurrency=args.caption_concurrency,
+                               max_connections=args.fetch_concurrency + args.caption_concurrency)
+    writer = ResultWriter(conn, namespace, update_styles=not args.no_update_styles, batch_size=args.commit_every)
+    progress = Progress(len(items))
+    try:
+        await run_job(items, client, writer, progress, fetch_concurrency=args.fetch_concurrency,
+                      caption_concurrency=args.caption_concurrency, rate=args.rate)
+    finally:
+        await client.aclose()
+        progress.log()
+
+    if args.export:
+        updated = export_jsonl(conn, namespace, args.input, args.export)
+        logging.info(f"Exported {args.export} with {updated} new captions.")
+    conn.close()
+    return progress.summary()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Caption every style image with the vision model.")
+    parser.add_argument("--source", choices=("db", "jsonl"), default="db", help="Read images from the styles table or the JSONL.")
+    parser.add_argument("--input", default=jsonl_file_path, help="Source JSONL (for --source jsonl and --export).")
+    parser.add_argument("--db", default=db_path, help="SQLite database holding styles and caption_jobs.")
+    parser.add_argument("--api", default=OLLAMA_API, help="Ollama /api/chat URL.")
+    parser.add_argument("--model", default=OLLAMA_MODEL, help="Vision model name.")
+    parser.add_argument("--fetch-concurrency", type=int, default=16, help="Concurrent image downloads.")
+    parser.add_argument("--caption-concurrency", type=int, default=2, help="Concurrent model calls.")
+    parser.add_argument("--rate", type=float, default=0.0, help="Max model calls per second (0 for no limit).")
+    parser.add_argument("--commit-every", type=int, default=50, help="Results per write transaction.")
+    parser.add_argument("--limit", type=int, default=0, help="Caption at most this many images.")
+    parser.add_argument("--restart", action="store_true", help="Caption again images already done by this job.")
+    parser.add_argument("--no-update-styles", action="store_true", help="Only record results in caption_jobs.")
+    parser.add_argument("--export", help="Write the source JSONL with the new ai_*_zh fields to this path.")
+    args = parser.parse_args()
+
+    summary = asyncio.run(run(args))
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+from PIL import Image
+
+
+def dhash(image, hash_size=8):
+    """
+    差值感知哈希: 缩放到 (hash_size+1, hash_size) 灰度图后比较相邻像素,
+    缩放/重新压缩后的同一张图通常得到相同的哈希
+    """
+    gray = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(gray.getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+
+def color_signature(image):
+    """
+    平均 RGB, 每个通道量化为 16 级 (3 位十六进制); dHash 只看灰度, 加上它才能区分颜色不同的图片
+    """
+    r, g, b = image.convert("RGB").resize((1, 1), Image.BOX).getpixel((0, 0))
+    return f"{r >> 4:x}{g >> 4:x}{b >> 4:x}"
+
+
+# dHash 中置位 (或未置位) 的比特少于该值时认为图片缺少纹理, 不使用感知哈希
+PHASH_MIN_BITS = 8
+
+
+class CaptionCache:
+    """
+    Disk cache of parsed caption results keyed by image content.
+
+    In "sha256" mode the key is the hash of the raw file bytes, so the same
+    file hits regardless of URL and nothing is decoded for the lookup. In
+    "phash" mode the key is a perceptual hash plus the mean colour of the
+    image as `image_preprocess.prepare_image` decodes and downscales it, so
+    resized or recompressed copies also hit and the decoded image is reused
+    for the caption request; images without enough texture for a meaningful
+    hash fall back to the byte hash. Keys are namespaced by model and prompt,
+    so changing either invalidates old entries.
+    """
+
+    def __init__(self, path, model, prompt, key_mode="sha256", ttl=7 * 24 * 3600, max_entries=100000):
+        """
+        Args:
+            path (str): SQLite file path.
+            model (str): Vision model name, part of every key.
+            prompt (str): Caption prompt, part of every key.
+            key_mode (str): "sha256" (exact bytes) or "phash" (perceptual).
+            ttl (float): Seconds before an entry expires.
+            max_entries (int): Max entries kept before evicting the oldest.
+        """
+        if key_mode not in ("sha256", "phash"):
+            raise ValueError(f"Unsupported caption cache key mode: {key_mode}")
+        self.path = path
+        self.key_mode = key_mode
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.namespace = hashlib.sha256(f"{model}\x00{prompt}".encode("utf-8")).hexdigest()[:16]
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS captions (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_captions_created_at ON captions (created_at)")
+        self._conn.commit()
+        self._entries = self._conn.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    @property
+    def needs_image(self):
+        """True when `key_for` needs the preprocessed image, not just the bytes."""
+        return self.key_mode == "phash"
+
+    def key_for(self, data, image=None):
+        """
+        Compute the cache key of an image. Hashing large files takes a few
+        milliseconds, so call it off the event loop.
+
+        Args:
+            data (bytes): Raw image bytes.
+            image (PIL.Image.Image): The image from
+                `image_preprocess.prepare_image(data)`; required when
+                `needs_image` is true, ignored otherwise.
+
+        Returns:
+            str: The cache key.
+        """
+        digest = None
+        if self.key_mode == "phash":
+            if image is None:
+                raise ValueError("The phash key mode needs the preprocessed image.")
+            bits = dhash(image)
+            # 纯色 / 低纹理图片的 dHash 几乎全 0 或全 1, 无法区分不同图片, 退回按文件字节精确匹配
+            ones = bin(int(bits, 16)).count("1")
+            if PHASH_MIN_BITS <= ones <= len(bits) * 4 - PHASH_MIN_BITS:
+                digest = f"p{bits}{color_signature(image)}"
+        if digest is None:
+            digest = "s" + hashlib.sha256(data).hexdigest()
+        return f"{self.namespace}:{digest}"
+
+    def get(self, key):
+        """
+        Returns:
+            dict: The cached caption, or None if missing or expired.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM captions WHERE key=?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            value, created_at = row
+            if time.time() - created_at > self.ttl:
+                self._conn.execute("DELETE FROM captions WHERE key=?", (key,))
+                self._conn.commit()
+                self._entries -= 1
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.hits += 1
+            return json.loads(value)
+
+    def put(self, key, value):
+        """
+        Args:
+            key (str): Key from `key_for`.
+            value (dict): Parsed caption fields.
+        """
+        row = (json.dumps(value, ensure_ascii=False), time.time(), key)
+        with self._lock:
+            # 已有的 key 只更新, 条目数只在真正插入新行时增加
+            inserted = self._conn.execute(
+                "INSERT OR IGNORE INTO captions (value, created_at, key) VALUES (?, ?, ?)", row).rowcount
+            if not inserted:
+                self._conn.execute("UPDATE captions SET value=?, created_at=? WHERE key=?", row)
+            self._conn.commit()
+            self._entries += inserted
+            if self._entries > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        """
+        先删除过期条目, 仍超限时按写入时间删除最旧的条目, 降到上限的 90%
+        """
+        self._conn.execute("DELETE FROM captions WHERE created_at < ?", (time.time() - self.ttl,))
+        self._entries = self._conn.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+        excess = self._entries - int(self.max_entries * 0.9)
+        if excess > 0:
+            self._conn.execute(
+                "DELETE FROM captions WHERE key IN (SELECT key FROM captions ORDER BY created_at LIMIT ?)",
+                (excess,))
+            self._entries -= excess
+            self.evictions += excess
+            logging.info(f"Evicted {excess} entries from caption cache {self.path}.")
+        self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "key_mode": self.key_mode,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": self._entries,
+                "expired": self.expired,
+                "evictions": self.evictions,
+            }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
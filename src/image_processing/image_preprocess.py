@@ -0,0 +1,99 @@
+import os
+import base64
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+# 视觉模型的图像编码器本身会降采样, 传原图只会增大 base64 体积和预填充耗时
+MAX_IMAGE_EDGE = int(os.environ.get("MAX_IMAGE_EDGE", 1024))  # 长边上限 (像素)
+JPEG_QUALITY = int(os.environ.get("JPEG_QUALITY", 85))
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_BYTES", 20 * 1024 * 1024))  # 下载/上传大小上限
+
+# 图片无法解码时可能抛出的异常; 像素数超过 Image.MAX_IMAGE_PIXELS 两倍时 PIL 抛出的
+# DecompressionBombError 不是 OSError / ValueError 的子类, 需要单独列出
+DECODE_ERRORS = (OSError, ValueError, Image.DecompressionBombError)
+
+
+class ImageTooLargeError(ValueError):
+    """Raised when an image download or upload exceeds MAX_IMAGE_BYTES."""
+
+
+def load_rgb(data, max_edge):
+    """
+    Decode an image as an upright RGB bitmap, with transparent areas on white.
+
+    JPEG sources are decoded with `draft`, which lets libjpeg scale by 1/2..1/8
+    during decoding instead of materializing the full-resolution bitmap, so
+    the result may be smaller than the source but is never smaller than
+    max_edge on its longer side (unless the source is).
+
+    Args:
+        data (bytes): Raw image bytes.
+        max_edge (int): Longest edge the caller will resize to.
+
+    Returns:
+        PIL.Image.Image: The RGB image.
+    """
+    image = Image.open(BytesIO(data))
+    if image.format == "JPEG":
+        image.draft("RGB", (max_edge, max_edge))
+    image = ImageOps.exif_transpose(image)
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        # 透明背景铺白, 否则转 RGB 后会变黑
+        rgba = image.convert("RGBA")
+        image = Image.new("RGB", rgba.size, (255, 255, 255))
+        image.paste(rgba, mask=rgba.getchannel("A"))
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+    return image
+
+
+def prepare_image(data, max_edge=MAX_IMAGE_EDGE):
+    """
+    Decode, orient and downscale an image to at most max_edge on its longer side.
+
+    Args:
+        data (bytes): Raw image bytes.
+        max_edge (int): Max length of the longer edge after resizing.
+
+    Returns:
+        PIL.Image.Image: The RGB image.
+    """
+    image = load_rgb(data, max_edge)
+    image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    return image
+
+
+def encode_jpeg(image, quality=JPEG_QUALITY):
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG", quality=quality)
+    return buffered.getvalue()
+
+
+def preprocess_image(data, max_edge=MAX_IMAGE_EDGE, quality=JPEG_QUALITY):
+    """
+    Decode, orient, downscale and re-encode an image as JPEG.
+
+    Args:
+        data (bytes): Raw image bytes.
+        max_edge (int): Max length of the longer edge after resizing.
+        quality (int): JPEG quality.
+
+    Returns:
+        bytes: The JPEG-encoded image.
+    """
+    return encode_jpeg(prepare_image(data, max_edge), quality)
+
+
+def preprocess_to_base64(data, max_edge=MAX_IMAGE_EDGE, quality=JPEG_QUALITY):
+    """
+    预处理图片并转换为 Base64 编码
+    """
+    return base64.b64encode(preprocess_image(data, max_edge, quality)).decode("utf-8")
+
+
+def image_to_base64(image, quality=JPEG_QUALITY):
+    """
+    把 `prepare_image` 得到的图片编码为 JPEG 再转 Base64, 已解码过的图片不必重新解码
+    """
+    return base64.b64encode(encode_jpeg(image, quality)).decode("utf-8")
@@ -1,10 +1,26 @@
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import logging
 import requests
-import base64
+import httpx
 from PIL import Image
 from io import BytesIO
+from contextlib import nullcontext
+
+from .image_preprocess import preprocess_to_base64, ImageTooLargeError, MAX_IMAGE_BYTES
 
 # 定义全局变量
-OLLAMA_API = "http://127.0.0.1:11434/api/chat" # Ollama API 地址, 需要调用多模态大模型
+OLLAMA_API = os.environ.get("OLLAMA_API", "http://127.0.0.1:11434/api/chat")  # Ollama API 地址, 需要调用多模态大模型
+OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "gemma3:27b")
+OLLAMA_MAX_CONCURRENCY = int(os.environ.get("OLLAMA_MAX_CONCURRENCY", 2))  # 同时在途的模型调用数
+OLLAMA_TIMEOUT = float(os.environ.get("OLLAMA_TIMEOUT", 300))  # 单次模型调用超时 (秒)
+IMAGE_FETCH_TIMEOUT = float(os.environ.get("IMAGE_FETCH_TIMEOUT", 20))  # 图片下载超时 (秒)
+# 距上次模型调用不超过该时间 (秒) 时认为模型仍在显存中, 不再预热; Ollama 默认 keep_alive 为 5 分钟
+OLLAMA_WARM_INTERVAL = float(os.environ.get("OLLAMA_WARM_INTERVAL", 60))
 PROMPT_CAPTION = """
 请简单描述一下这个图片，包括以下几个部分：
 [画面内容]: 图片的具体内容描述，
@@ -20,71 +36,336 @@ key为color，value为图片色彩，string。
 2. 不要返回其他任何内容
 """
 
-def pic_caption(prompt, local_img_base64):
+# 同步调用共用一个 Session, 复用 TCP 连接
+session = requests.Session()
+
+
+def build_caption_payload(prompt, local_img_base64, model=OLLAMA_MODEL):
+    return {
+        "model": model,
+        "temperature": 0.1,
+        "messages": [
+            {
+                "role": "user",
+                "content": prompt,
+                "images": [local_img_base64] if local_img_base64 else [],
+            }
+        ]
+    }
+
+
+# 图片描述 JSON 中的字段
+CAPTION_FIELDS = ("desc", "style", "features", "color")
+# 一个已经生成完整的 "key": "value" 对 (value 中允许转义字符)
+_FIELD_PATTERN = re.compile(r'"(\w+)"\s*:\s*"((?:[^"\\]|\\.)*)"', re.S)
+
+
+def chat_content(line):
     """
-    调用 Ollama API 进行图片描述
+    Ollama /api/chat 流式响应 (NDJSON) 中一行的 message.content, 无法解析的行返回空字符串
     """
+    line = line.strip()
+    if not line:
+        return ""
     try:
-        data = {
-            "model": "gemma3:27b",
-            "temperature": 0.1,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": prompt,
-                    "images": [local_img_base64] if local_img_base64 else [],
-                }
-            ]
-        }
-
-        resp = requests.post(OLLAMA_API, json=data)
-        resp.raise_for_status()  # 检查 HTTP 请求是否成功
-        result = []
+        item = json.loads(line)
+    except json.JSONDecodeError:
+        return ""
+    message = item.get("message") if isinstance(item, dict) else None
+    return (message or {}).get("content") or ""
 
-        for item in resp.text.split("\n"):
-            try:
-                parsed_item = eval(item.replace("false", "False").replace("true", "True"))
-                if "message" in parsed_item and "content" in parsed_item["message"]:
-                    result.append(parsed_item["message"]["content"])
-            except (SyntaxError, NameError):
+
+def clean_caption_text(text):
+    """
+    取模型输出中第一个 { 到最后一个 } 之间的内容, 去掉 ```json 代码块标记和前后的多余文字
+    """
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end < start:
+        return text.strip()
+    return text[start:end + 1]
+
+
+def parse_chat_response(text):
+    """
+    解析 Ollama /api/chat 的逐行响应, 拼接 message.content
+    """
+    return clean_caption_text("".join(chat_content(line) for line in text.split("\n")))
+
+
+class CaptionStreamParser:
+    """
+    Incremental parser for the caption JSON while the model is generating it.
+
+    Tokens are fed as they arrive; every "key": "value" pair of
+    CAPTION_FIELDS is returned as soon as its closing quote has been
+    generated, so later stages can start before the object is complete.
+    """
+
+    def __init__(self, fields=CAPTION_FIELDS):
+        self.text = ""
+        self.fields = {}
+        self._wanted = fields
+        self._pos = 0
+        self.parse_error = None  # result() 无法把完整输出解析为 JSON 时的错误
+
+    def feed(self, token):
+        """
+        Args:
+            token (str): Next piece of generated text.
+
+        Returns:
+            list: (key, value) pairs completed by this token.
+        """
+        self.text += token
+        completed = []
+        for match in _FIELD_PATTERN.finditer(self.text, self._pos):
+            self._pos = match.end()
+            key = match.group(1)
+            if key not in self._wanted or key in self.fields:
                 continue
+            try:
+                value = json.loads(f'"{match.group(2)}"')
+            except json.JSONDecodeError:
+                value = match.group(2)
+            self.fields[key] = value
+            completed.append((key, value))
+        return completed
+
+    def result(self):
+        """
+        The whole caption, parsed as JSON when the output is valid and from the
+        fields seen so far otherwise.
 
-        return "".join(result).replace("`", "").replace("json", "")
+        Returns:
+            dict: One string per CAPTION_FIELDS key ("" when missing).
+        """
+        try:
+            parsed = json.loads(clean_caption_text(self.text))
+        except json.JSONDecodeError as e:
+            parsed = None
+            self.parse_error = e
+        if not isinstance(parsed, dict):
+            self.parse_error = self.parse_error or ValueError("caption is not a JSON object")
+            parsed = self.fields
+        return {key: str(parsed.get(key) or "") for key in self._wanted}
+
+
+def pic_caption(prompt, local_img_base64):
+    """
+    调用 Ollama API 进行图片描述
+    """
+    try:
+        data = build_caption_payload(prompt, local_img_base64)
+        resp = session.post(OLLAMA_API, json=data, timeout=OLLAMA_TIMEOUT)
+        resp.raise_for_status()  # 检查 HTTP 请求是否成功
+        return parse_chat_response(resp.text)
     except requests.RequestException as e:
-        print(f"Request error: {e}")
+        logging.warning(f"Request error: {e}")
         return ""
     except Exception as e:
-        print(f"Unexpected error: {e}")
+        logging.warning(f"Unexpected error: {e}")
         return ""
 
 
+def read_limited(chunks, max_bytes, content_length=None):
+    """
+    按块读取响应体, 超过 max_bytes 立即中止, 不会把超大文件读入内存
+    """
+    if content_length and int(content_length) > max_bytes:
+        raise ImageTooLargeError(f"Image is {content_length} bytes, limit is {max_bytes}.")
+    buffered = BytesIO()
+    for chunk in chunks:
+        buffered.write(chunk)
+        if buffered.tell() > max_bytes:
+            raise ImageTooLargeError(f"Image exceeds the {max_bytes} bytes limit.")
+    return buffered.getvalue()
+
+
+def fetch_image(img_url, max_bytes=MAX_IMAGE_BYTES):
+    """
+    流式下载图片原始字节
+    """
+    with session.get(img_url, timeout=IMAGE_FETCH_TIMEOUT, stream=True) as response:
+        response.raise_for_status()
+        return read_limited(response.iter_content(64 * 1024), max_bytes, response.headers.get("Content-Length"))
+
+
 def load_image_from_url(img_url):
     """
     从 URL 加载图片
     """
     try:
-        response = requests.get(img_url)
-        response.raise_for_status()
-        return Image.open(BytesIO(response.content))
-    except requests.RequestException as e:
-        print(f"Failed to load image from URL: {e}")
+        return Image.open(BytesIO(fetch_image(img_url)))
+    except (requests.RequestException, ImageTooLargeError) as e:
+        logging.warning(f"Failed to load image from URL: {e}")
         return None
 
 
 def image_to_base64(img_url):
     """
-    将图片 URL 转换为 Base64 编码
+    将图片 URL 转换为 Base64 编码 (缩放并重新编码为 JPEG)
     """
     try:
-        response = requests.get(img_url)
-        response.raise_for_status()
-        img = BytesIO(response.content)
-        return base64.b64encode(img.getvalue()).decode('utf-8')
-    except requests.RequestException as e:
-        print(f"Failed to convert image to Base64: {e}")
+        return preprocess_to_base64(fetch_image(img_url))
+    except (requests.RequestException, ImageTooLargeError, OSError) as e:
+        logging.warning(f"Failed to convert image to Base64: {e}")
         return None
 
 
+class AsyncOllamaClient:
+    """
+    Non-blocking Ollama client for use inside the FastAPI event loop.
+
+    One pooled httpx.AsyncClient is shared by all requests. Model calls are
+    limited by a semaphore (waiters are served in FIFO order), so slow caption
+    requests queue up instead of piling onto Ollama, while searches keep running.
+    """
+
+    def __init__(self, api_url=OLLAMA_API, model=OLLAMA_MODEL, max_concurrency=OLLAMA_MAX_CONCURRENCY,
+                 timeout=OLLAMA_TIMEOUT, fetch_timeout=IMAGE_FETCH_TIMEOUT, max_retries=2, backoff=0.5,
+                 max_connections=50):
+        """
+        Args:
+            api_url (str): Ollama /api/chat URL.
+            model (str): Vision model name.
+            max_concurrency (int): Max in-flight model calls.
+            timeout (float): Per-call timeout for model calls, in seconds.
+            fetch_timeout (float): Per-call timeout for image downloads, in seconds.
+            max_retries (int): Retries on connection errors and 5xx responses (0 disables).
+            backoff (float): Base delay for exponential backoff, in seconds.
+            max_connections (int): Connection pool size.
+        """
+        self.api_url = api_url
+        self.model = model
+        self.timeout = timeout
+        self.fetch_timeout = fetch_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._last_used = -float("inf")
+        self._warm_task = None
+        # 按调用类型统计的失败次数 (重试之后仍然失败)
+        self.failures = {"caption": 0, "stream": 0, "fetch": 0, "warm_up": 0}
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(fetch_timeout, connect=5.0),
+            follow_redirects=True,
+        )
+
+    async def _with_retry(self, url, call, semaphore=None):
+        """
+        执行请求, 连接错误或 5xx 时按指数退避重试; 给出 semaphore 时每次尝试单独占用一个并发名额,
+        退避等待期间释放, 不挡住其他请求
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with semaphore or nullcontext():
+                    return await call()
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                retryable = isinstance(e, httpx.TransportError) or e.response.status_code >= 500
+                if attempt == self.max_retries or not retryable:
+                    raise
+                logging.warning(f"Request to {url} failed ({e}), retrying.")
+            await asyncio.sleep(self.backoff * (2 ** attempt) * (1 + random.random()))
+
+    async def _request(self, method, url, timeout, semaphore=None, **kwargs):
+        async def call():
+            response = await self._client.request(method, url, timeout=timeout, **kwargs)
+            response.raise_for_status()
+            return response
+        return await self._with_retry(url, call, semaphore)
+
+    async def pic_caption(self, prompt, local_img_base64, raise_errors=False):
+        """
+        调用 Ollama API 进行图片描述, 失败时返回空字符串; raise_errors=True 时改为抛出 httpx.HTTPError,
+        调用方可以区分请求失败和模型输出为空
+        """
+        data = build_caption_payload(prompt, local_img_base64, model=self.model)
+        try:
+            response = await self._request("POST", self.api_url, self.timeout, semaphore=self._semaphore, json=data)
+            self._last_used = time.monotonic()
+            return parse_chat_response(response.text)
+        except httpx.HTTPError as e:
+            self.failures["caption"] += 1
+            logging.warning(f"Caption request to {self.api_url} failed: {e}")
+            if raise_errors:
+                raise
+            return ""
+
+    async def stream_caption(self, prompt, local_img_base64):
+        """
+        调用 Ollama API 进行图片描述, 逐个产出模型生成的文本片段 (增量解析 NDJSON 流式响应).
+        不做重试, 请求失败时抛出 httpx.HTTPError
+        """
+        data = {**build_caption_payload(prompt, local_img_base64, model=self.model), "stream": True}
+        try:
+            async with self._semaphore:
+                async with self._client.stream("POST", self.api_url, json=data, timeout=self.timeout) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        content = chat_content(line)
+                        if content:
+                            yield content
+        except httpx.HTTPError:
+            self.failures["stream"] += 1
+            raise
+        self._last_used = time.monotonic()
+
+    async def warm_up(self):
+        """
+        Ask Ollama to load the model (a chat request without messages only
+        loads it), so a cold load overlaps with the image download instead of
+        following it. Skipped if the model was used within OLLAMA_WARM_INTERVAL.
+        """
+        if time.monotonic() - self._last_used < OLLAMA_WARM_INTERVAL:
+            return
+        self._last_used = time.monotonic()
+        try:
+            await self._client.post(self.api_url, json={"model": self.model, "messages": []}, timeout=self.timeout)
+        except httpx.HTTPError as e:
+            self.failures["warm_up"] += 1
+            logging.warning(f"Failed to warm up {self.model}: {e}")
+
+    def start_warm_up(self):
+        """
+        在后台预热模型, 不等待结果; 同一时间只有一个预热请求
+        """
+        if self._warm_task is None or self._warm_task.done():
+            self._warm_task = asyncio.create_task(self.warm_up())
+
+    async def fetch_image(self, img_url, max_bytes=MAX_IMAGE_BYTES):
+        """
+        流式下载图片原始字节, 失败时返回 None, 超过 max_bytes 时抛出 ImageTooLargeError
+        """
+        async def call():
+            async with self._client.stream("GET", img_url, timeout=self.fetch_timeout) as response:
+                response.raise_for_status()
+                length = response.headers.get("Content-Length")
+                if length and int(length) > max_bytes:
+                    raise ImageTooLargeError(f"Image is {length} bytes, limit is {max_bytes}.")
+                buffered = BytesIO()
+                async for chunk in response.aiter_bytes(64 * 1024):
+                    buffered.write(chunk)
+                    if buffered.tell() > max_bytes:
+                        raise ImageTooLargeError(f"Image exceeds the {max_bytes} bytes limit.")
+                return buffered.getvalue()
+
+        try:
+            return await self._with_retry(img_url, call)
+        except httpx.HTTPError as e:
+            self.failures["fetch"] += 1
+            logging.warning(f"Failed to load image from {img_url}: {e}")
+            return None
+
+    def stats(self):
+        return {"model": self.model, "failures": dict(self.failures)}
+
+    async def aclose(self):
+        if self._warm_task is not None:
+            self._warm_task.cancel()
+        await self._client.aclose()
+
+
 if __name__ == "__main__":
     # 示例图片 URL
     img_url = "https://img2.baidu.com/it/u=2781037149,3187912571&fm=253&fmt=auto&app=138&f=JPEG?w=800&h=1422"
@@ -0,0 +1,210 @@
+"""
+结果图缩略图的本地磁盘缓存
+
+每张目录图片只从源站下载一次, 按 THUMBNAIL_WIDTHS 中的每个宽度生成 WebP 和 JPEG 两种缩略图,
+保存为 data/thumbnails/<url 哈希前两位>/<url 哈希>_<宽度>.<webp|jpg>. 文件写入后不再修改,
+ETag 由 url 哈希、宽度、格式和文件大小组成.
+
+用法 (为整个目录预先生成缩略图):
+    python -m src.image_processing.thumbnail_cache --concurrency 16
+"""
+import os
+import time
+import asyncio
+import hashlib
+import sqlite3
+import logging
+import argparse
+import threading
+from io import BytesIO
+
+import httpx
+from PIL import Image
+
+from .image_preprocess import load_rgb, DECODE_ERRORS
+from .ollama_picture_desc import AsyncOllamaClient
+
+# 动态生成文件路径
+base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+data_dir = os.path.join(base_dir, 'data')
+thumbnail_dir = os.path.join(data_dir, 'thumbnails')
+db_path = os.path.join(data_dir, 'midjourney_styles_demo.db')
+
+# 允许的缩略图宽度 (像素), 只生成这些尺寸, 防止任意宽度参数把缓存撑大
+THUMBNAIL_WIDTHS = tuple(int(w) for w in os.environ.get("THUMBNAIL_WIDTHS", "256,512").split(","))
+THUMBNAIL_WEBP_QUALITY = int(os.environ.get("THUMBNAIL_WEBP_QUALITY", 80))
+THUMBNAIL_JPEG_QUALITY = int(os.environ.get("THUMBNAIL_JPEG_QUALITY", 82))
+
+# 格式 -> (文件扩展名, Content-Type)
+FORMATS = {"webp": ("webp", "image/webp"), "jpeg": ("jpg", "image/jpeg")}
+
+
+def render_thumbnails(data, widths=THUMBNAIL_WIDTHS):
+    """
+    Resize an image to every width and encode each size as WebP and JPEG.
+    Images narrower than a width are not upscaled.
+
+    Args:
+        data (bytes): Raw image bytes.
+        widths (tuple): Target widths in pixels.
+
+    Returns:
+        dict: (width, format) -> encoded bytes.
+    """
+    source = load_rgb(data, max(widths))
+    variants = {}
+    for width in sorted(widths, reverse=True):
+        image = source.copy()
+        # 宽度固定, 高度按比例缩放
+        image.thumbnail((width, max(1, round(width * source.height / source.width))), Image.LANCZOS)
+        for fmt in FORMATS:
+            buffered = BytesIO()
+            if fmt == "webp":
+                image.save(buffered, format="WEBP", quality=THUMBNAIL_WEBP_QUALITY, method=4)
+            else:
+                image.save(buffered, format="JPEG", quality=THUMBNAIL_JPEG_QUALITY, optimize=True, progressive=True)
+            variants[width, fmt] = buffered.getvalue()
+    return variants
+
+
+class ThumbnailCache:
+    """
+    Disk cache of resized catalog images, keyed by image URL.
+    """
+
+    def __init__(self, path=thumbnail_dir, widths=THUMBNAIL_WIDTHS):
+        """
+        Args:
+            path (str): Cache directory.
+            widths (tuple): Widths generated for every image.
+        """
+        self.path = path
+        self.widths = tuple(widths)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+
+    def url_key(self, img_url):
+        return hashlib.sha256(img_url.encode("utf-8")).hexdigest()
+
+    def file_path(self, img_url, width, fmt):
+        key = self.url_key(img_url)
+        return os.path.join(self.path, key[:2], f"{key}_{width}.{FORMATS[fmt][0]}")
+
+    def etag(self, img_url, width, fmt, size):
+        return f'"{self.url_key(img_url)[:16]}-{width}-{fmt}-{size}"'
+
+    def get(self, img_url, width, fmt):
+        """
+        Returns:
+            tuple: (bytes, etag) of the cached thumbnail, or None if missing.
+        """
+        path = self.file_path(img_url, width, fmt)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data, self.etag(img_url, width, fmt, len(data))
+
+    def contains(self, img_url):
+        return all(os.path.exists(self.file_path(img_url, width, fmt)) for width in self.widths for fmt in FORMATS)
+
+    def put(self, img_url, data):
+        """
+        Render and store every variant of an image. Each file is written to a
+        temporary name and renamed, so readers never see a partial file.
+        Decoding is CPU-bound, call it off the event loop.
+
+        Args:
+            img_url (str): Catalog image URL.
+            data (bytes): Raw image bytes.
+        """
+        for (width, fmt), encoded in render_thumbnails(data, self.widths).items():
+            path = self.file_path(img_url, width, fmt)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(encoded)
+            os.replace(tmp_path, path)
+        with self._lock:
+            self.generated += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "widths": list(self.widths),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "generated": self.generated,
+            }
+
+
+def catalog_img_urls(path=db_path):
+    conn = sqlite3.connect(path)
+    try:
+        return [row[0] for row in conn.execute("SELECT DISTINCT img_url FROM styles WHERE img_url IS NOT NULL "
+                                               "AND img_url != ''")]
+    finally:
+        conn.close()
+
+
+async def prewarm(cache, img_urls, concurrency=16):
+    """
+    Fetch and render every image missing from the cache.
+
+    Returns:
+        dict: Counts of generated, skipped (already cached) and failed images.
+    """
+    client = AsyncOllamaClient(max_connections=concurrency)
+    todo = [url for url in img_urls if not cache.contains(url)]
+    counts = {"generated": 0, "skipped": len(img_urls) - len(todo), "failed": 0}
+    queue = asyncio.Queue()
+    for url in todo:
+        queue.put_nowait(url)
+    logging.info(f"Generating thumbnails for {len(todo)} images ({counts['skipped']} already cached).")
+    start = time.perf_counter()
+
+    async def worker():
+        while not queue.empty():
+            url = queue.get_nowait()
+            try:
+                data = await client.fetch_image(url)
+                if data is None:
+                    raise OSError(f"failed to download {url}")
+                await asyncio.to_thread(cache.put, url, data)
+                counts["generated"] += 1
+            except (*DECODE_ERRORS, httpx.InvalidURL) as e:
+                logging.warning(f"Thumbnail for {url} failed: {e!r}")
+                counts["failed"] += 1
+            done = counts["generated"] + counts["failed"]
+            if done % 100 == 0:
+                logging.info(f"{done}/{len(todo)} images, {done / (time.perf_counter() - start):.1f} images/s.")
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        await client.aclose()
+    return counts
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Pre-generate result thumbnails for the whole catalog.")
+    parser.add_argument("--db", default=db_path, help="SQLite database holding the styles table.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent image downloads.")
+    args = parser.parse_args()
+
+    counts = asyncio.run(prewarm(ThumbnailCache(), catalog_img_urls(args.db), concurrency=args.concurrency))
+    logging.info(f"Thumbnails: {counts}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import os
+import json
+import math
+import logging
+
+import faiss
+import numpy as np
+
+# 支持的索引类型; 除 flat 外都是近似检索, 参数由 index_benchmark.py 扫描后写入 index_config.json
+INDEX_TYPES = ("flat", "fp16", "int8", "binary", "ivf", "ivfsq8", "ivfpq", "hnsw")
+# 量化存储: 与 flat 一样逐个比较, 但每维只存 2 字节 (fp16) / 1 字节 (int8) / 1 bit (binary, 按各维中位数取符号);
+# binary 按汉明距离排序, 检索时多取 BINARY_RESCORE_OVERSAMPLE 倍候选再用原始向量重新计算 L2 距离,
+# 返回的距离与其他索引类型一致 (可用于 distance 融合)
+QUANTIZED_TYPES = ("fp16", "int8", "binary")
+BINARY_RESCORE_OVERSAMPLE = int(os.environ.get("BINARY_RESCORE_OVERSAMPLE", 8))
+
+
+def default_params(index_type, n, d):
+    """
+    Reasonable defaults for a corpus of n vectors of dimension d.
+
+    nlist follows the usual 4*sqrt(n) rule but is capped so that every
+    centroid gets at least 39 training points (FAISS' minimum), which keeps
+    IVF usable on small catalogs.
+
+    Args:
+        index_type (str): One of INDEX_TYPES.
+        n (int): Number of vectors.
+        d (int): Vector dimension.
+
+    Returns:
+        dict: Build and search parameters.
+    """
+    nlist = max(1, min(int(4 * math.sqrt(n)), n // 39))
+    if index_type == "flat" or index_type in QUANTIZED_TYPES:
+        return {}
+    if index_type in ("ivf", "ivfsq8"):
+        return {"nlist": nlist, "nprobe": min(16, nlist)}
+    if index_type == "ivfpq":
+        # pq_m 必须整除 d; 每个码本至少要有 39 * 2^nbits 个训练样本, 小数据集减少 bit 数
+        pq_m = max(m for m in range(1, min(d, 32) + 1) if d % m == 0)
+        pq_nbits = max(4, min(8, int(math.log2(max(n, 39) / 39))))
+        return {"nlist": nlist, "nprobe": min(16, nlist), "pq_m": pq_m, "pq_nbits": pq_nbits}
+    if index_type == "hnsw":
+        return {"M": 32, "efConstruction": 200, "efSearch": 64}
+    raise ValueError(f"Unsupported index type: {index_type}")
+
+
+def factory_string(index_type, params):
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "fp16":
+        return "SQfp16"
+    if index_type == "int8":
+        return "SQ8"
+    if index_type == "binary":
+        return "LSHt"
+    if index_type == "ivf":
+        return f"IVF{params['nlist']},Flat"
+    if index_type == "ivfsq8":
+        return f"IVF{params['nlist']},SQ8"
+    if index_type == "ivfpq":
+        return f"IVF{params['nlist']},PQ{params['pq_m']}x{params.get('pq_nbits', 8)}"
+    if index_type == "hnsw":
+        return f"HNSW{params['M']}"
+    raise ValueError(f"Unsupported index type: {index_type}")
+
+
+def set_search_params(index, params):
+    """
+    设置查询期参数 (nprobe / efSearch), 这些参数不影响索引内容, 可以随时调整
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and "nprobe" in params:
+        ivf.nprobe = int(params["nprobe"])
+    hnsw_index = faiss.downcast_index(index)
+    if hasattr(hnsw_index, "hnsw") and "efSearch" in params:
+        hnsw_index.hnsw.efSearch = int(params["efSearch"])
+
+
+def create_index(vectors, index_type="flat", params=None):
+    """
+    Create, train and fill a FAISS index (L2 metric).
+
+    Args:
+        vectors (np.ndarray): float32 array of shape (n, d).
+        index_type (str): One of INDEX_TYPES.
+        params (dict): Overrides for `default_params`.
+
+    Returns:
+        faiss.Index: The filled index.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    n, d = vectors.shape
+    params = {**default_params(index_type, n, d), **(params or {})}
+    index = faiss.index_factory(d, factory_string(index_type, params), faiss.METRIC_L2)
+    if index_type == "hnsw":
+        faiss.downcast_index(index).hnsw.efConstruction = int(params["efConstruction"])
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    set_search_params(index, params)
+    return index
+
+
+def is_binary(index):
+    return isinstance(faiss.downcast_index(index), faiss.IndexLSH)
+
+
+def supports_selector(index):
+    """
+    IndexLSH (binary) 的 search 不接受 SearchParameters, 无法传入 IDSelector
+    """
+    return not is_binary(index)
+
+
+def index_memory_bytes(index):
+    return int(faiss.serialize_index(index).size)
+
+
+def load_index_config(config_path):
+    """
+    读取每个字段选定的索引配置, 文件不存在时返回空配置 (全部使用 flat)
+    """
+    if not os.path.exists(config_path):
+        return {}
+    with open(config_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_index_config(config_path, config):
+    tmp_path = config_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, config_path)
+    logging.info(f"Index config saved to {config_path}.")
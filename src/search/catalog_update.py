@@ -0,0 +1,359 @@
+"""
+目录增量更新
+
+以 SQLite styles 表为准, 对比当前向量/索引中的目录行, 只编码新增和修改过的风格,
+并把它们追加到六个字段索引中; 删除和修改前的旧行以墓碑方式标记, 检索时过滤.
+每次更新都会提升目录版本号 (data/catalog_manifest.json) 并写入变更日志 (data/catalog_changes.jsonl).
+
+用法:
+    python -m src.search.catalog_update status
+    python -m src.search.catalog_update sync
+    python -m src.search.catalog_update delete <styles.id> ...
+    python -m src.search.catalog_update compact
+"""
+import os
+import sqlite3
+import logging
+import argparse
+import itertools
+
+import faiss
+import numpy as np
+
+from .style_search import StyleCatalog, data_dir, save_group_ids
+from .search_utils import FIELD_KEYS, build_group_ids, group_members, collapse_vectors
+from .embedding import RERANK_DIM, load_text_encoder
+from .embedding_cache import EmbeddingCache
+from .index_manifest import file_stamp, save_manifest, save_labels, append_change_log
+from .column_store import meta_path, write_catalog
+from .vector import (jsonl_file_path, embedding_cache_path, iter_jsonl, style_id, row_hash, embed_rows, rerank_key,
+                     format_all_ai_info)
+
+db_path = os.path.join(data_dir, 'midjourney_styles_demo.db')
+
+# 墓碑标签超过该比例时, status 建议执行 compact
+COMPACT_THRESHOLD = 0.2
+
+# 重写精排向量矩阵时每次拷贝的行数
+RERANK_COPY_ROWS = 65536
+
+
+def save_index(index, path):
+    tmp_path = path + ".tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def save_rerank_rows(ss, key, rows=None, extra=None):
+    """
+    Atomically rewrite the rerank matrix of one field: keep `rows` of the
+    current matrix (all rows when None) and append the `extra` vectors.
+    Rows are copied in chunks, so the matrix is never fully loaded.
+    """
+    matrix = ss.rerank_vectors[key]
+    rows = np.arange(len(matrix)) if rows is None else rows
+    n_extra = 0 if extra is None else len(extra)
+    path = os.path.join(ss.rerank_dir, f"{key}.npy")
+    tmp_path = path + ".tmp.npy"
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=matrix.dtype,
+                                    shape=(len(rows) + n_extra, matrix.shape[1]))
+    for start in range(0, len(rows), RERANK_COPY_ROWS):
+        chunk = rows[start:start + RERANK_COPY_ROWS]
+        out[start:start + len(chunk)] = matrix[chunk]
+    if n_extra:
+        out[len(rows):] = extra[:, :matrix.shape[1]]
+    out.flush()
+    del out
+    os.replace(tmp_path, path)
+    ss.rerank_vectors[key] = np.load(path, mmap_mode="r")
+
+
+def load_style_rows(ss, keys):
+    """
+    读取每行对应的 styles.id 和文本哈希; 旧版 vector.py 没有生成这两列时, 按 JSONL 的行顺序补齐
+    """
+    if "style_ids" in ss.catalog_columns and "style_hashes" in ss.catalog_columns:
+        return list(ss.catalog_columns["style_ids"]), list(ss.catalog_columns["style_hashes"])
+    logging.info(f"style_ids not found in {ss.catalog_dir}, deriving style ids from {jsonl_file_path}.")
+    style_ids, style_hashes = [], []
+    for line in iter_jsonl(jsonl_file_path):
+        style_ids.append(style_id(line))
+        style_hashes.append(row_hash(line, keys))
+    if len(style_ids) != len(ss.slugs):
+        raise ValueError(f"{jsonl_file_path} has {len(style_ids)} rows but the catalog has {len(ss.slugs)}.")
+    return style_ids, style_hashes
+
+
+def live_style_rows(ss, style_ids):
+    """
+    styles.id -> 当前有效的目录行; 同一个 id 出现多次时 (上次更新中途失败) 只保留最后一行
+
+    Returns:
+        tuple: (dict of id -> row, list of duplicate rows to delete)
+    """
+    live, duplicates = {}, []
+    for row in np.flatnonzero(ss.row_alive).tolist():
+        sid = style_ids[row]
+        if sid in live:
+            duplicates.append(live[sid])
+        live[sid] = row
+    return live, duplicates
+
+
+def fetch_db_styles(db_path=db_path):
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    try:
+        return {row["id"]: dict(row) for row in conn.execute("SELECT * FROM styles")}
+    finally:
+        conn.close()
+
+
+def diff_catalog(ss, db_styles, style_ids, style_hashes, keys):
+    """
+    Compare the styles table with the indexed catalog rows.
+
+    Args:
+        ss (StyleCatalog): Catalog opened with build=True.
+        db_styles (dict): styles.id -> row dict.
+        style_ids (list): styles.id of every catalog row.
+        style_hashes (list): Text hash of every catalog row.
+        keys (list): Embedded fields, in vectors_dict order.
+
+    Returns:
+        tuple: (added ids, updated ids, deleted ids)
+    """
+    live, _ = live_style_rows(ss, style_ids)
+    added = [sid for sid in db_styles if sid not in live]
+    updated = [sid for sid, row in live.items() if sid in db_styles
+               and row_hash(db_styles[sid], keys) != style_hashes[row]]
+    deleted = [sid for sid in live if sid not in db_styles]
+    return added, updated, deleted
+
+
+def label_updates(ss, dead_rows, new_rows):
+    """
+    Work out which labels to tombstone and which to append in the current
+    collapse mode.
+
+    Without collapsing every row has its own label. With collapsing, every
+    image group touched by a deleted or added row gets a new label (with a
+    re-computed group vector) and its old label is tombstoned.
+
+    Returns:
+        tuple: (kill mask over current labels, new label groups, new label rows,
+            dict of field key -> vectors of the new labels)
+    """
+    if ss.collapse == "none":
+        kill = np.isin(ss.index_rows, dead_rows) & (ss.index_groups >= 0)
+        vectors = {key: ss.vector_dict[key][new_rows] for key in FIELD_KEYS.values()}
+        return kill, ss.group_ids[new_rows], new_rows, vectors
+
+    touched = np.unique(ss.group_ids[np.concatenate([dead_rows, new_rows]).astype('int64')])
+    kill = np.isin(ss.index_groups, touched) & (ss.index_groups >= 0)
+    live_touched = touched[np.diff(ss.group_offsets)[touched] > 0]
+    members = np.flatnonzero(np.isin(ss.group_ids, live_touched) & ss.row_alive)
+    vectors = {key: collapse_vectors(ss.vector_dict[key][members], ss.group_ids[members], ss.collapse)
+               for key in FIELD_KEYS.values()}
+    return kill, live_touched, ss.group_member_rows[ss.group_offsets[live_touched]], vectors
+
+
+def apply_changes(ss, upserts, delete_ids, text_encoder=None, cache=None, batch_size=256):
+    """
+    Add, replace and delete styles in the catalog and in every field index.
+
+    Replaced and deleted styles keep their rows and labels as tombstones; new
+    and replaced styles are embedded and appended. All files are rewritten
+    atomically and the manifest is written last, so an interrupted update is
+    detected as drift on the next load.
+
+    Args:
+        ss (StyleCatalog): Catalog opened with build=True; updated in place.
+        upserts (list): Row dicts from the styles table; existing ids are replaced.
+        delete_ids (list): styles.id values to delete.
+        text_encoder: Sentence encoder, loaded on demand.
+        cache (EmbeddingCache): Optional embedding cache.
+        batch_size (int): Texts per forward pass.
+
+    Returns:
+        dict: Summary of the applied change.
+    """
+    keys = list(ss.vector_dict)
+    style_ids, style_hashes = load_style_rows(ss, keys)
+    live, dead_rows = live_style_rows(ss, style_ids)
+    missing = [sid for sid in delete_ids if sid not in live]
+    if missing:
+        logging.warning(f"Ignoring {len(missing)} unknown style ids: {missing[:10]}")
+    dead_rows += [live[sid] for sid in delete_ids if sid in live]
+    dead_rows += [live[row["id"]] for row in upserts if row["id"] in live]
+    dead_rows = np.array(sorted(set(dead_rows)), dtype='int64')
+
+    # 编码新增/修改的行并追加到目录末尾
+    n_old = len(ss.slugs)
+    new_rows = np.arange(n_old, n_old + len(upserts), dtype='int64')
+    if upserts:
+        if text_encoder is None:
+            text_encoder = load_text_encoder()
+        arrays = embed_rows(text_encoder, upserts, keys, batch_size, cache)
+        for key in keys:
+            ss.vector_dict[key] = np.concatenate([ss.vector_dict[key], arrays[key]])
+            if key not in ss.rerank_vectors:
+                continue
+            if ss.rerank_dim_limit(key) > RERANK_DIM:
+                # 精排矩阵比当前 RERANK_DIM 更长, 新行无法补齐; 该字段停用精排, 重新运行 vector.py 后恢复
+                logging.warning(f"Rerank vectors of {key} are {ss.rerank_dim_limit(key)}-d, RERANK_DIM is "
+                                f"{RERANK_DIM}. Rerank is disabled for this field.")
+                del ss.rerank_vectors[key]
+                continue
+            save_rerank_rows(ss, key, extra=arrays[rerank_key(key)])
+    new_strings = {
+        "slugs": [row["slug_new"] for row in upserts],
+        "img_urls": [row["img_url"] for row in upserts],
+        "all_ai_info": [format_all_ai_info(row) for row in upserts],
+    }
+    style_ids.extend(row["id"] for row in upserts)
+    style_hashes.extend(row_hash(row, keys) for row in upserts)
+
+    # 新行沿用同一 img_url 已有的图片组, 新图片分配新组号
+    group_of = {}
+    if upserts:
+        for url, g in zip(ss.img_urls, ss.group_ids.tolist()):
+            group_of.setdefault(url, g)
+    next_group = int(ss.group_ids.max()) + 1 if n_old else 0
+    new_groups = []
+    for url in new_strings["img_urls"]:
+        if url not in group_of:
+            group_of[url] = next_group
+            next_group += 1
+        new_groups.append(group_of[url])
+    ss.group_ids = np.concatenate([ss.group_ids, np.array(new_groups, dtype='int64')])
+    ss.row_alive = np.concatenate([ss.row_alive, np.ones(len(upserts), dtype=bool)])
+    ss.row_alive[dead_rows] = False
+    ss.group_offsets, ss.group_member_rows = group_members(ss.group_ids, ss.row_alive)
+
+    kill, add_groups, add_rows, add_vectors = label_updates(ss, dead_rows, new_rows)
+    ss.index_groups = np.concatenate([np.where(kill, -1, ss.index_groups), add_groups]).astype('int64')
+    ss.index_rows = np.concatenate([ss.index_rows, add_rows]).astype('int64')
+    ss.row_labels = ss.build_row_labels()
+    for name, key in FIELD_KEYS.items():
+        index = ss.field_indexes[name]
+        if len(add_rows):
+            index.add(np.ascontiguousarray(add_vectors[key], dtype='float32'))
+        if index.ntotal != len(ss.index_rows):
+            raise RuntimeError(f"Index {name} holds {index.ntotal} vectors, label table has {len(ss.index_rows)}.")
+
+    version = ss.catalog_manifest["version"] + 1
+    # 只删除时目录列不变 (删除记录在清单的 deleted_rows 中)
+    if upserts or "style_ids" not in ss.catalog_columns:
+        strings = {name: itertools.chain(ss.catalog_columns[name], values) for name, values in new_strings.items()}
+        write_catalog(ss.catalog_dir, strings={**strings, "style_ids": style_ids, "style_hashes": style_hashes},
+                      vectors=ss.vector_dict if upserts else None)
+        ss.load_catalog()
+    save_group_ids(ss.group_ids_path, ss.group_ids, ss.img_urls)
+    entries = {}
+    for name, index in ss.field_indexes.items():
+        index_path = ss.field_index_spec(name)[2]
+        save_index(index, index_path)
+        entries[os.path.basename(index_path)] = {"version": version, "ntotal": int(index.ntotal)}
+    save_labels(ss.index_labels_path(), version, ss.index_groups, ss.index_rows)
+
+    ss.catalog_manifest = {
+        **ss.catalog_manifest,
+        "version": version,
+        "vectors_stamp": file_stamp(meta_path(ss.catalog_dir)),
+        "rows": len(ss.slugs),
+        "deleted_rows": np.flatnonzero(~ss.row_alive).tolist(),
+        "indexes": {**ss.catalog_manifest["indexes"], **entries},
+    }
+    save_manifest(ss.catalog_manifest_path, ss.catalog_manifest)
+
+    summary = {"version": version, "upserted": len(upserts), "deleted_rows": len(dead_rows),
+               "rows": len(ss.slugs), "live_rows": int(ss.row_alive.sum()), "labels": len(ss.index_rows)}
+    append_change_log(ss.catalog_changes_path, {**summary, "upserted_ids": [row["id"] for row in upserts],
+                                                "deleted_ids": [sid for sid in delete_ids if sid in live]})
+    logging.info(f"Catalog updated: {summary}")
+    return summary
+
+
+def compact(ss):
+    """
+    Drop deleted rows from the catalog files and rebuild every field index of
+    the current collapse mode from the live rows (no re-embedding).
+    """
+    keys = list(ss.vector_dict)
+    style_ids, style_hashes = load_style_rows(ss, keys)
+    keep = np.flatnonzero(ss.row_alive)
+    for key in list(ss.rerank_vectors):
+        save_rerank_rows(ss, key, rows=keep)
+    strings = {name: map(ss.catalog_columns[name].__getitem__, keep) for name in ("slugs", "img_urls", "all_ai_info")}
+    write_catalog(ss.catalog_dir, strings={**strings, "style_ids": [style_ids[i] for i in keep],
+                                           "style_hashes": [style_hashes[i] for i in keep]},
+                  vectors={key: ss.vector_dict[key][keep] for key in keys})
+    ss.load_catalog()
+    ss.group_ids = build_group_ids(ss.img_urls)
+    save_group_ids(ss.group_ids_path, ss.group_ids, ss.img_urls)
+    ss.row_alive = np.ones(len(keep), dtype=bool)
+    ss.group_offsets, ss.group_member_rows = group_members(ss.group_ids, ss.row_alive)
+
+    # 提升版本号后所有索引都视为过期, 由 load_field_indexes 按存活行重建
+    ss.catalog_manifest = {**ss.catalog_manifest, "version": ss.catalog_manifest["version"] + 1,
+                           "vectors_stamp": file_stamp(meta_path(ss.catalog_dir)), "rows": len(keep),
+                           "deleted_rows": [], "indexes": {}}
+    ss.field_indexes = ss.load_field_indexes()
+    summary = {"version": ss.catalog_manifest["version"], "compacted": True, "rows": len(keep),
+               "live_rows": len(keep), "labels": len(ss.index_rows)}
+    append_change_log(ss.catalog_changes_path, summary)
+    logging.info(f"Catalog compacted: {summary}")
+    return summary
+
+
+def status(ss):
+    keys = list(ss.vector_dict)
+    style_ids, style_hashes = load_style_rows(ss, keys)
+    added, updated, deleted = diff_catalog(ss, fetch_db_styles(), style_ids, style_hashes, keys)
+    tombstones = int((ss.index_groups < 0).sum())
+    print(f"catalog version: {ss.catalog_manifest['version']}")
+    print(f"rows: {len(ss.slugs)}, live: {int(ss.row_alive.sum())}, deleted: {int((~ss.row_alive).sum())}")
+    print(f"labels ({ss.collapse}): {len(ss.index_rows)}, tombstoned: {tombstones}")
+    for name, index in ss.field_indexes.items():
+        print(f"  {os.path.basename(ss.field_index_spec(name)[2])}: ntotal={index.ntotal}")
+    print(f"database drift: {len(added)} added, {len(updated)} updated, {len(deleted)} deleted")
+    if len(ss.index_rows) and tombstones / len(ss.index_rows) > COMPACT_THRESHOLD:
+        print(f"{tombstones / len(ss.index_rows):.0%} of labels are tombstoned, consider running compact.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Incrementally sync the style indexes with the styles table.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("status", help="Show catalog version and drift against the database.")
+    sync_parser = subparsers.add_parser("sync", help="Embed and index added/updated styles, drop deleted ones.")
+    sync_parser.add_argument("--batch-size", type=int, default=256, help="Texts per forward pass.")
+    sync_parser.add_argument("--no-cache", action="store_true", help="Do not read or write the embedding cache.")
+    sync_parser.add_argument("--dry-run", action="store_true", help="Only report what would change.")
+    delete_parser = subparsers.add_parser("delete", help="Delete styles by styles.id.")
+    delete_parser.add_argument("ids", nargs="+", help="styles.id values.")
+    subparsers.add_parser("compact", help="Drop deleted rows and rebuild the indexes.")
+    args = parser.parse_args()
+
+    ss = StyleCatalog(data_dir, build=True)
+    if args.command == "status":
+        status(ss)
+    elif args.command == "sync":
+        keys = list(ss.vector_dict)
+        style_ids, style_hashes = load_style_rows(ss, keys)
+        db_styles = fetch_db_styles()
+        added, updated, deleted = diff_catalog(ss, db_styles, style_ids, style_hashes, keys)
+        logging.info(f"Database drift: {len(added)} added, {len(updated)} updated, {len(deleted)} deleted.")
+        if args.dry_run or not (added or updated or deleted):
+            return
+        cache = None if args.no_cache else EmbeddingCache(embedding_cache_path, dim=RERANK_DIM)
+        apply_changes(ss, [db_styles[sid] for sid in added + updated], deleted, cache=cache,
+                      batch_size=args.batch_size)
+    elif args.command == "delete":
+        apply_changes(ss, [], args.ids)
+    elif args.command == "compact":
+        compact(ss)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+"""
+列式目录存储
+
+每个字符串列保存为 <name>.g<代>.offsets.npy (int64, n + 1 个偏移) + <name>.g<代>.blob (UTF-8 拼接),
+每个字段的向量保存为 vectors/<key>.g<代>.npy (float32). 全部以只读 mmap 打开: 启动时不反序列化,
+按行号读取时才解码字符串, 向量只在重建索引 / 精确计算时才读入对应的页,
+多个 worker 进程共享同一份页缓存.
+
+每次写入都使用新的文件名 (代号递增), 从不覆盖正在被读取的文件; meta.json 记录行数和每列对应的文件,
+最后原子替换, 是唯一的切换点. 读取时每列都截断到 meta 中的行数. 上一代的文件保留到下一次写入,
+已读取旧 meta 但还没打开文件的进程仍能读到一致的旧版本.
+
+用法 (把旧版 pickle 文件转换为列式存储):
+    python -m src.search.column_store --from-pickles
+"""
+import os
+import json
+import time
+import pickle
+import hashlib
+import logging
+import argparse
+import operator
+
+import numpy as np
+
+# 动态生成文件路径
+base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+data_dir = os.path.join(base_dir, 'data')
+catalog_dir = os.path.join(data_dir, 'catalog')
+
+META_FILE = "meta.json"
+VECTORS_DIR = "vectors"
+
+
+class StringColumn:
+    """
+    Read-only, memory-mapped column of strings, indexable like a list.
+    Strings are decoded on access and never cached.
+    """
+
+    def __init__(self, path, rows=None):
+        """
+        Args:
+            path (str): Column path without suffix (<path>.offsets.npy and <path>.blob).
+            rows (int): Expose only the first `rows` strings; all when None.
+        """
+        self.path = path
+        self.offsets = np.load(path + ".offsets.npy", mmap_mode="r")
+        if rows is not None:
+            if rows > len(self.offsets) - 1:
+                raise ValueError(f"Column {path} holds {len(self.offsets) - 1} rows, expected {rows}.")
+            self.offsets = self.offsets[:rows + 1]
+        # 长度为 0 的文件不能 mmap
+        self.blob = np.memmap(path + ".blob", dtype=np.uint8, mode="r") if self.offsets[-1] else \
+            np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = operator.index(i)
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError(f"Row {i} out of range for {n} rows.")
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def digest(self):
+        """
+        列内容 (偏移 + UTF-8 字节) 的 sha256, 不需要逐行解码
+        """
+        h = hashlib.sha256(np.ascontiguousarray(self.offsets, dtype=np.int64).tobytes())
+        h.update(self.blob[:self.offsets[-1]].tobytes())
+        return h.hexdigest()
+
+
+def write_string_column(path, values):
+    """
+    Stream strings into a column; the files are replaced atomically, so an
+    open StringColumn of the same path keeps reading the old data.
+
+    Returns:
+        int: Number of rows written.
+    """
+    offsets = [0]
+    tmp_blob = path + ".blob.tmp"
+    with open(tmp_blob, "wb") as f:
+        for value in values:
+            data = ("" if value is None else str(value)).encode("utf-8")
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+    tmp_offsets = path + ".offsets.tmp.npy"
+    np.save(tmp_offsets, np.array(offsets, dtype=np.int64))
+    os.replace(tmp_blob, path + ".blob")
+    os.replace(tmp_offsets, path + ".offsets.npy")
+    return len(offsets) - 1
+
+
+def write_vectors(path, vectors):
+    tmp_path = path + ".tmp.npy"
+    np.save(tmp_path, np.ascontiguousarray(vectors, dtype="float32"))
+    os.replace(tmp_path, path)
+
+
+def catalog_exists(store_dir):
+    return os.path.exists(os.path.join(store_dir, META_FILE))
+
+
+def meta_path(store_dir):
+    return os.path.join(store_dir, META_FILE)
+
+
+def load_meta(store_dir):
+    with open(meta_path(store_dir), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def string_file(meta, name):
+    # 旧版 meta 没有 string_files, 列文件没有代号
+    return meta.get("string_files", {}).get(name, name)
+
+
+def vector_file(meta, key):
+    return meta.get("vector_files", {}).get(key, os.path.join(VECTORS_DIR, f"{key}.npy"))
+
+
+def referenced_files(meta):
+    """
+    meta 引用的所有列文件 (相对 store_dir 的路径)
+    """
+    files = {string_file(meta, name) + suffix for name in meta["strings"] for suffix in (".blob", ".offsets.npy")}
+    return files | {vector_file(meta, key) for key in meta["vectors"]}
+
+
+def open_catalog(store_dir):
+    """
+    Open every column of a catalog store read-only, each cut to meta["rows"].
+
+    Returns:
+        tuple: (meta, strings, vectors); strings maps column name -> StringColumn,
+            vectors maps field key -> read-only (n, d) float32 memmap.
+
+    Raises:
+        ValueError: If a column holds fewer rows than the meta says.
+    """
+    meta = load_meta(store_dir)
+    rows = meta["rows"]
+    strings = {name: StringColumn(os.path.join(store_dir, string_file(meta, name)), rows) for name in meta["strings"]}
+    vectors = {}
+    for key in meta["vectors"]:
+        matrix = np.load(os.path.join(store_dir, vector_file(meta, key)), mmap_mode="r")
+        if len(matrix) < rows:
+            raise ValueError(f"Vectors {key} hold {len(matrix)} rows, expected {rows}.")
+        vectors[key] = matrix[:rows]
+    return meta, strings, vectors
+
+
+def write_catalog(store_dir, strings=None, vectors=None):
+    """
+    Write some columns of a catalog store and then its meta.json.
+
+    Columns not given are kept. New columns go to files of a new generation
+    and meta.json, replaced atomically last, switches readers to them in one
+    step. Files referenced by neither the new nor the previous meta are
+    removed afterwards.
+
+    Args:
+        store_dir (str): Store directory.
+        strings (dict): Column name -> iterable of str.
+        vectors (dict): Field key -> (n, d) array.
+
+    Returns:
+        dict: The new meta.
+    """
+    os.makedirs(os.path.join(store_dir, VECTORS_DIR), exist_ok=True)
+    old_meta = load_meta(store_dir) if catalog_exists(store_dir) else {"rows": None, "strings": [], "vectors": []}
+    generation = old_meta.get("generation", 0) + 1
+    string_files = {name: string_file(old_meta, name) for name in old_meta["strings"]}
+    vector_files = {key: vector_file(old_meta, key) for key in old_meta["vectors"]}
+    rows = {}
+    for name, values in (strings or {}).items():
+        string_files[name] = f"{name}.g{generation}"
+        rows[name] = write_string_column(os.path.join(store_dir, string_files[name]), values)
+    for key, matrix in (vectors or {}).items():
+        vector_files[key] = os.path.join(VECTORS_DIR, f"{key}.g{generation}.npy")
+        write_vectors(os.path.join(store_dir, vector_files[key]), matrix)
+        rows[key] = len(matrix)
+    if old_meta["rows"] is not None:
+        untouched = [name for name in old_meta["strings"] + old_meta["vectors"] if name not in rows]
+        rows.update({name: old_meta["rows"] for name in untouched})
+    if len(set(rows.values())) > 1:
+        raise ValueError(f"Catalog columns have different lengths: {rows}")
+
+    meta = {
+        "rows": next(iter(rows.values()), 0),
+        "generation": generation,
+        "strings": list(string_files),
+        "vectors": list(vector_files),
+        "string_files": string_files,
+        "vector_files": vector_files,
+        "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    tmp_path = meta_path(store_dir) + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, meta_path(store_dir))
+    remove_unreferenced(store_dir, referenced_files(meta) | referenced_files(old_meta))
+    return meta
+
+
+def remove_unreferenced(store_dir, keep):
+    """
+    删除不再被引用的列文件 (更早的代和写入中断留下的文件)
+    """
+    for rel_dir in ("", VECTORS_DIR):
+        for name in os.listdir(os.path.join(store_dir, rel_dir)):
+            rel_path = os.path.join(rel_dir, name)
+            if rel_path not in keep and ".tmp" not in name and (name.endswith(".blob") or name.endswith(".npy")):
+                os.remove(os.path.join(store_dir, rel_path))
+
+
+def migrate_pickles(store_dir, data_dir):
+    """
+    Convert the pickle files of older vector.py versions (vectors_dict.pkl,
+    slugs.pkl, img_urls.pkl, all_ai_info.pkl, and style_ids.pkl /
+    style_hashes.pkl when present) into a catalog store.
+    """
+    def load(name):
+        with open(os.path.join(data_dir, name), "rb") as f:
+            return pickle.load(f)
+
+    strings = {name: load(f"{name}.pkl") for name in ("slugs", "img_urls", "all_ai_info")}
+    for name in ("style_ids", "style_hashes"):
+        if os.path.exists(os.path.join(data_dir, f"{name}.pkl")):
+            strings[name] = load(f"{name}.pkl")
+    vectors = {key: np.asarray(value, dtype="float32") for key, value in load("vectors_dict.pkl").items()}
+    meta = write_catalog(store_dir, strings=strings, vectors=vectors)
+    logging.info(f"Converted pickles in {data_dir} into {store_dir}: {meta['rows']} rows, "
+                 f"{len(meta['strings'])} string columns, {len(meta['vectors'])} vector fields.")
+    return meta
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Columnar catalog store tools.")
+    parser.add_argument("--from-pickles", action="store_true", help="Convert data/*.pkl into the columnar store.")
+    args = parser.parse_args()
+    if args.from_pickles:
+        migrate_pickles(catalog_dir, data_dir)
+    meta = load_meta(catalog_dir)
+    print(json.dumps(meta, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import os
+import unicodedata
+import numpy as np
+from sklearn.preprocessing import normalize
+
+# 文本向量模型配置, 离线建库 (vector.py) 与在线服务 (service.py) 必须保持一致
+MODEL_NAME = "richinfoai/ritrieve_zh_v1"  # infgrad/stella-mrl-large-zh-v3.5-1792d
+EMBED_DIM = 100  # 截断维度, 只保留前 100 维 (Matryoshka)
+# 精排使用的更长前缀 (模型完整输出为 1792 维); 离线存储在 data/rerank_vectors/, 检索时对候选重新打分
+RERANK_DIM = int(os.environ.get("RERANK_DIM", 768))
+ENCODE_BATCH_SIZE = 64
+
+# 编码后端: torch (SentenceTransformer, fp32), onnx / onnx-int8 (ONNX Runtime, 需先运行 onnx_encoder export)
+ENCODER_BACKENDS = ("torch", "onnx", "onnx-int8")
+ENCODER_BACKEND = os.environ.get("ENCODER_BACKEND", "torch")
+if ENCODER_BACKEND not in ENCODER_BACKENDS:
+    raise ValueError(f"ENCODER_BACKEND must be one of {ENCODER_BACKENDS}, got {ENCODER_BACKEND!r}.")
+# 缓存和断点使用的编码器标识; 不同后端的输出略有差异, 不共用缓存
+ENCODER_ID = MODEL_NAME if ENCODER_BACKEND == "torch" else f"{MODEL_NAME}@{ENCODER_BACKEND}"
+
+
+def load_text_encoder(model_name=MODEL_NAME, backend=ENCODER_BACKEND):
+    """
+    Load the sentence embedding model.
+
+    Args:
+        model_name (str): Hugging Face model name.
+        backend (str): One of ENCODER_BACKENDS.
+
+    Returns:
+        SentenceTransformer or OnnxTextEncoder: The loaded encoder; both
+            provide the same `encode` method.
+    """
+    if backend == "torch":
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(model_name)
+    if model_name != MODEL_NAME:
+        raise ValueError(f"The {backend} backend only serves the exported {MODEL_NAME}.")
+    from .onnx_encoder import OnnxTextEncoder
+    return OnnxTextEncoder(backend=backend)
+
+
+def normalize_text(text):
+    """
+    编码前的文本规范化 (NFC + 去首尾空白), 同时也是缓存 key 的输入
+    """
+    return unicodedata.normalize("NFC", str(text)).strip()
+
+
+def truncate_and_normalize(vectors, dim=EMBED_DIM):
+    """
+    Keep the first `dim` dimensions of each vector and L2-normalize them.
+
+    Args:
+        vectors (np.ndarray): Full model output of shape (n, D).
+        dim (int): Number of leading dimensions to keep.
+
+    Returns:
+        np.ndarray: Contiguous float32 array of shape (n, dim).
+    """
+    vectors = np.asarray(vectors, dtype="float32")
+    return np.ascontiguousarray(normalize(vectors[:, :dim]), dtype="float32")
+
+
+def encode_texts(text_encoder, texts, dim=EMBED_DIM, batch_size=ENCODE_BATCH_SIZE, cache=None):
+    """
+    Encode a list of texts in batches.
+
+    SentenceTransformer sorts the inputs by length before batching, so passing
+    a large list here keeps padding (and wasted compute) per batch small. With
+    a cache, only texts not seen before reach the model.
+
+    Args:
+        text_encoder: Encoder returned by `load_text_encoder`.
+        texts (list): Texts to encode.
+        dim (int): Truncation dimension.
+        batch_size (int): Number of texts per forward pass.
+        cache (EmbeddingCache): Optional embedding cache.
+
+    Returns:
+        np.ndarray: float32 array of shape (len(texts), dim).
+    """
+    texts = [normalize_text(text) for text in texts]
+    if len(texts) == 0:
+        return np.zeros((0, dim), dtype="float32")
+    if cache is None:
+        vectors = text_encoder.encode(texts, batch_size=batch_size, normalize_embeddings=False,
+                                      show_progress_bar=False)
+        return truncate_and_normalize(vectors, dim)
+
+    if cache.dim != dim:
+        raise ValueError(f"Cache dimension {cache.dim} does not match requested dimension {dim}.")
+    result = np.zeros((len(texts), dim), dtype="float32")
+    missing = {}
+    for i, vector in enumerate(cache.get_many(texts)):
+        if vector is None:
+            missing.setdefault(texts[i], []).append(i)
+        else:
+            result[i] = vector
+    if missing:
+        missing_texts = list(missing)
+        vectors = text_encoder.encode(missing_texts, batch_size=batch_size, normalize_embeddings=False,
+                                      show_progress_bar=False)
+        vectors = truncate_and_normalize(vectors, dim)
+        cache.put_many(missing_texts, vectors)
+        for text, vector in zip(missing_texts, vectors):
+            result[missing[text]] = vector
+    return result
@@ -0,0 +1,202 @@
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .embedding import ENCODER_ID, EMBED_DIM
+
+
+def cache_key(model_name, dim, text):
+    return hashlib.sha256(f"{model_name}\x00{dim}\x00{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Two-tier embedding cache: an in-process LRU in front of a SQLite store.
+
+    Keys are content hashes of (model name, truncation dim, normalized text), so
+    the offline builder and the API can share one database file safely. Texts
+    passed in must already be normalized with `embedding.normalize_text`.
+
+    The memory tier and the SQLite connection have separate locks, so a
+    `get_memory` probe (cheap enough for the event loop) never waits for disk
+    I/O running in another thread.
+    """
+
+    def __init__(self, path, model_name=ENCODER_ID, dim=EMBED_DIM, memory_size=10000, max_disk_entries=1000000):
+        """
+        Args:
+            path (str): SQLite file path for the disk tier.
+            model_name (str): Encoder id (model name and backend), part of every key.
+            dim (int): Truncation dimension, part of every key.
+            memory_size (int): Max entries kept in the in-process LRU.
+            max_disk_entries (int): Max entries kept on disk before evicting least recently used.
+        """
+        self.path = path
+        self.model_name = model_name
+        self.dim = dim
+        self.memory_size = memory_size
+        self.max_disk_entries = max_disk_entries
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()  # 内存 LRU 和统计
+        self._db_lock = threading.Lock()  # SQLite 连接
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings (last_access)")
+        self._conn.commit()
+        self._disk_entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _key(self, text):
+        return cache_key(self.model_name, self.dim, text)
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get_memory(self, texts):
+        """
+        Look up normalized texts in the in-process LRU only; misses are not
+        counted, they are expected to be looked up again with `get_many`.
+
+        Returns:
+            list: One float32 vector per text, or None where the text is not in memory.
+        """
+        results = [None] * len(texts)
+        with self._lock:
+            for i, text in enumerate(texts):
+                key = self._key(text)
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    results[i] = vector
+                    self.memory_hits += 1
+        return results
+
+    def get_many(self, texts):
+        """
+        Look up normalized texts in memory, then on disk. Runs SQLite queries,
+        so keep it off the event loop.
+
+        Args:
+            texts (list): Normalized texts.
+
+        Returns:
+            list: One float32 vector per text, or None where the text is not cached.
+        """
+        keys = [self._key(text) for text in texts]
+        results = [None] * len(texts)
+        disk_lookup = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    results[i] = vector
+                    self.memory_hits += 1
+                else:
+                    disk_lookup.setdefault(key, []).append(i)
+        if not disk_lookup:
+            return results
+
+        found = {}
+        lookup_keys = list(disk_lookup)
+        with self._db_lock:
+            for start in range(0, len(lookup_keys), 500):
+                chunk = lookup_keys[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype="float32")
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE embeddings SET last_access=? WHERE key=?",
+                                       [(now, key) for key in found])
+                self._conn.commit()
+        with self._lock:
+            for key, positions in disk_lookup.items():
+                vector = found.get(key)
+                if vector is None:
+                    self.misses += len(positions)
+                    continue
+                self._remember(key, vector)
+                self.disk_hits += len(positions)
+                for i in positions:
+                    results[i] = vector
+        return results
+
+    def put_many(self, texts, vectors):
+        """
+        Store vectors for normalized texts in both tiers.
+
+        Args:
+            texts (list): Normalized texts.
+            vectors (np.ndarray): float32 array of shape (len(texts), dim).
+        """
+        now = time.time()
+        rows = []
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                key = self._key(text)
+                vector = np.ascontiguousarray(vector, dtype="float32")
+                self._remember(key, vector)
+                rows.append((key, vector.tobytes(), now))
+        with self._db_lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+            self._disk_entries += len(rows)
+            if self._disk_entries > self.max_disk_entries:
+                self._evict()
+
+    def _evict(self):
+        """
+        删除最久未访问的条目, 直到磁盘条目数降到上限的 90%
+        """
+        self._disk_entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        excess = self._disk_entries - int(self.max_disk_entries * 0.9)
+        if excess <= 0:
+            return
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_access LIMIT ?)",
+            (excess,))
+        self._conn.commit()
+        self._disk_entries -= excess
+        self.evictions += excess
+        logging.info(f"Evicted {excess} entries from embedding cache {self.path}.")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_entries": self._disk_entries,
+                "evictions": self.evictions,
+            }
+
+    def close(self):
+        with self._db_lock:
+            self._conn.close()
@@ -0,0 +1,282 @@
+"""
+ANN 索引参数扫描
+
+对每个字段的向量 (或合成向量) 扫描 IVF / IVF-SQ8 / IVF-PQ / HNSW 的参数,
+以 flat 精确检索结果为基准统计 recall@k, 同时测量 QPS、单条查询延迟和索引内存,
+并为每个字段选出满足目标召回率且最快的配置, 写入 data/index_config.json.
+
+--quantization 只比较量化存储 (fp16 / int8 / binary) 与当前 float32 flat 索引: 报告节省的内存和损失的 recall@k,
+并选出满足目标召回率且内存最小的存储方式. binary 按服务端的检索路径测量 (汉明距离取候选后用 float32 向量精确重排),
+内存中也计入重排所需的 float32 向量.
+
+用法:
+    python -m src.search.index_benchmark --k 10 --target-recall 0.95 --write-config
+    python -m src.search.index_benchmark --synthetic 200000 --k 10
+    python -m src.search.index_benchmark --quantization --target-recall 0.95 --write-config
+"""
+import os
+import time
+import json
+import logging
+import argparse
+
+import faiss
+import numpy as np
+
+from .ann_index import (QUANTIZED_TYPES, BINARY_RESCORE_OVERSAMPLE, create_index, default_params, set_search_params,
+                        index_memory_bytes, is_binary, load_index_config, save_index_config)
+from .metadata_filter import rescore_exact
+from .search_utils import FIELD_KEYS
+from .style_search import StyleCatalog, data_dir
+
+NPROBE_SWEEP = [1, 2, 4, 8, 16, 32, 64, 128]
+EF_SEARCH_SWEEP = [16, 32, 64, 128, 256]
+HNSW_M_SWEEP = [16, 32]
+
+
+def make_synthetic(n, d=100, n_clusters=256, seed=0):
+    """
+    生成带聚类结构的归一化向量, 比均匀随机向量更接近真实 embedding 的分布
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, d)).astype('float32')
+    vectors = centers[rng.integers(0, n_clusters, n)] + 0.5 * rng.standard_normal((n, d)).astype('float32')
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def make_queries(vectors, nq, seed=1):
+    """
+    从库中抽样并加少量噪声作为查询, 避免查询与库中向量完全重合
+    """
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(len(vectors), size=min(nq, len(vectors)), replace=False)]
+    queries = queries + (0.05 / np.sqrt(vectors.shape[1])) * rng.standard_normal(queries.shape).astype('float32')
+    return np.ascontiguousarray(queries / np.linalg.norm(queries, axis=1, keepdims=True), dtype='float32')
+
+
+def recall_at_k(ground_truth, indices):
+    k = ground_truth.shape[1]
+    hits = sum(len(np.intersect1d(gt, res[res >= 0])) for gt, res in zip(ground_truth, indices))
+    return hits / (len(ground_truth) * k)
+
+
+def served_search(index, vectors):
+    """
+    与 StyleCatalog.search_field 相同的检索路径: binary 索引先按汉明距离取 k * BINARY_RESCORE_OVERSAMPLE
+    个候选, 再用原始向量按 L2 距离精确重排; 其他索引直接检索
+    """
+    if not is_binary(index):
+        return index.search
+
+    def search(queries, k):
+        _, labels = index.search(queries, min(index.ntotal, k * BINARY_RESCORE_OVERSAMPLE))
+        return rescore_exact(lambda candidates: vectors[candidates], labels, queries, k)
+    return search
+
+
+def served_memory_bytes(index, vectors):
+    """
+    检索时常驻的内存: 索引本身, binary 索引另加重排用的 float32 向量
+    """
+    return index_memory_bytes(index) + (vectors.nbytes if is_binary(index) else 0)
+
+
+def measure(index, queries, ground_truth, k, latency_queries=200, vectors=None):
+    """
+    Measure recall@k, batched QPS and single-query latency of an index,
+    searched the way the service searches it (see `served_search`).
+
+    Args:
+        vectors (np.ndarray): The indexed float32 vectors, needed to re-score binary indexes.
+
+    Returns:
+        dict: recall, qps, latency_ms (median single-query latency).
+    """
+    search = served_search(index, vectors)
+    start = time.perf_counter()
+    _, indices = search(queries, k)
+    elapsed = time.perf_counter() - start
+
+    latencies = []
+    for query in queries[:latency_queries]:
+        t = time.perf_counter()
+        search(query.reshape(1, -1), k)
+        latencies.append(time.perf_counter() - t)
+    return {
+        "recall": round(recall_at_k(ground_truth, indices), 4),
+        "qps": round(len(queries) / elapsed, 1),
+        "latency_ms": round(float(np.median(latencies)) * 1000, 4),
+    }
+
+
+def candidate_builds(n, d):
+    """
+    产出 (index_type, 构建参数, 查询参数列表); 同一构建参数只训练一次, 只扫描查询期参数
+    """
+    yield from quantized_builds(n, d)
+
+    ivf = default_params("ivf", n, d)
+    nlists = sorted({max(1, ivf["nlist"] // 2), ivf["nlist"], min(ivf["nlist"] * 2, max(1, n // 39))})
+    for nlist in nlists:
+        nprobes = [{"nprobe": p} for p in NPROBE_SWEEP if p <= nlist]
+        yield "ivf", {"nlist": nlist}, nprobes
+        yield "ivfsq8", {"nlist": nlist}, nprobes
+
+    pq = default_params("ivfpq", n, d)
+    pq_ms = sorted({m for m in (d // 10, d // 5, d // 4, d // 2, pq["pq_m"]) if m > 0 and d % m == 0})
+    for pq_m in pq_ms:
+        yield "ivfpq", {"nlist": ivf["nlist"], "pq_m": pq_m, "pq_nbits": pq["pq_nbits"]}, \
+            [{"nprobe": p} for p in NPROBE_SWEEP if p <= ivf["nlist"]]
+
+    for M in HNSW_M_SWEEP:
+        yield "hnsw", {"M": M, "efConstruction": 200}, [{"efSearch": ef} for ef in EF_SEARCH_SWEEP]
+
+
+def quantized_builds(n, d):
+    for index_type in QUANTIZED_TYPES:
+        yield index_type, {}, [{}]
+
+
+def sweep(vectors, k=10, nq=1000, builds=candidate_builds):
+    """
+    Sweep index types and parameters on one set of vectors.
+
+    Args:
+        vectors (np.ndarray): float32 array of shape (n, d).
+        k (int): Recall cut-off.
+        nq (int): Number of queries.
+        builds (callable): Generator of the configurations to try, called as builds(n, d).
+
+    Returns:
+        list: One result dict per (index type, parameters) combination, flat first.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    n, d = vectors.shape
+    k = min(k, n)
+    queries = make_queries(vectors, nq)
+
+    flat = create_index(vectors, "flat")
+    _, ground_truth = flat.search(queries, k)
+    results = [{"index_type": "flat", "params": {}, "memory_bytes": index_memory_bytes(flat), "build_s": 0.0,
+                **measure(flat, queries, ground_truth, k)}]
+
+    for index_type, build_params, search_params_list in builds(n, d):
+        start = time.perf_counter()
+        try:
+            index = create_index(vectors, index_type, build_params)
+        except RuntimeError as e:
+            logging.warning(f"Skipping {index_type} {build_params}: {e}")
+            continue
+        build_s = round(time.perf_counter() - start, 3)
+        memory_bytes = served_memory_bytes(index, vectors)
+        for search_params in search_params_list:
+            set_search_params(index, search_params)
+            results.append({"index_type": index_type, "params": {**build_params, **search_params},
+                            "memory_bytes": memory_bytes, "build_s": build_s,
+                            **measure(index, queries, ground_truth, k, vectors=vectors)})
+    return results
+
+
+def choose(results, target_recall, key="qps"):
+    """
+    在满足目标召回率的配置中选 QPS 最高 (key="memory" 时选内存最小) 的, 都不满足时退回 flat
+    """
+    ok = [r for r in results if r["recall"] >= target_recall]
+    if not ok:
+        return results[0]
+    if key == "memory":
+        return min(ok, key=lambda r: r["memory_bytes"])
+    return max(ok, key=lambda r: r[key])
+
+
+def print_report(title, results, chosen):
+    print(f"\n== {title} ==")
+    print(f"{'type':<8} {'recall':>7} {'qps':>10} {'lat_ms':>8} {'mem_MB':>8} {'build_s':>8}  params")
+    for r in results:
+        mark = " *" if r is chosen else ""
+        print(f"{r['index_type']:<8} {r['recall']:>7.4f} {r['qps']:>10.1f} {r['latency_ms']:>8.3f} "
+              f"{r['memory_bytes'] / 2 ** 20:>8.2f} {r['build_s']:>8.3f}  {json.dumps(r['params'])}{mark}")
+
+
+def print_quantization_report(title, results, chosen):
+    flat = results[0]
+    print(f"\n== {title} ==")
+    print(f"{'type':<8} {'mem_MB':>8} {'saved_MB':>9} {'saved':>7} {'recall':>7} {'lost':>7} {'qps':>10}")
+    for r in results:
+        mark = " *" if r is chosen else ""
+        saved = flat["memory_bytes"] - r["memory_bytes"]
+        print(f"{r['index_type']:<8} {r['memory_bytes'] / 2 ** 20:>8.2f} {saved / 2 ** 20:>9.2f} "
+              f"{saved / flat['memory_bytes']:>7.1%} {r['recall']:>7.4f} {flat['recall'] - r['recall']:>7.4f} "
+              f"{r['qps']:>10.1f}{mark}")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Sweep ANN index parameters and report recall/QPS/memory.")
+    parser.add_argument("--fields", default="all", help="Comma-separated field names, or 'all'.")
+    parser.add_argument("--synthetic", type=int, default=0, help="Benchmark N synthetic vectors instead of the catalog.")
+    parser.add_argument("--dim", type=int, default=100, help="Dimension of synthetic vectors.")
+    parser.add_argument("--k", type=int, default=10, help="Recall cut-off.")
+    parser.add_argument("--nq", type=int, default=1000, help="Number of queries.")
+    parser.add_argument("--target-recall", type=float, default=0.95, help="Minimum recall@k for the chosen config.")
+    parser.add_argument("--threads", type=int, default=0, help="FAISS OpenMP threads (0 = library default).")
+    parser.add_argument("--quantization", action="store_true",
+                        help="Only compare fp16/int8/binary storage with float32 flat; choose the smallest index "
+                             "that meets the target recall.")
+    parser.add_argument("--report", help="Write all results as JSON to this path.")
+    parser.add_argument("--write-config", action="store_true",
+                        help="Persist the chosen config per field next to the .faiss files.")
+    args = parser.parse_args()
+
+    if args.threads:
+        faiss.omp_set_num_threads(args.threads)
+
+    builds = quantized_builds if args.quantization else candidate_builds
+    choose_key = "memory" if args.quantization else "qps"
+    show = print_quantization_report if args.quantization else print_report
+
+    report = {}
+    if args.synthetic:
+        vectors = make_synthetic(args.synthetic, args.dim)
+        results = sweep(vectors, k=args.k, nq=args.nq, builds=builds)
+        chosen = choose(results, args.target_recall, key=choose_key)
+        show(f"synthetic n={args.synthetic} d={args.dim}", results, chosen)
+        report["synthetic"] = {"results": results, "chosen": chosen}
+    else:
+        # 加载 data/ 中的目录, 保证扫描的正是服务实际使用的向量 (含折叠模式)
+        catalog = StyleCatalog(data_dir, build=True)
+        fields = list(FIELD_KEYS) if args.fields == "all" else args.fields.split(",")
+        config = load_index_config(catalog.index_config_path)
+        for name in fields:
+            vectors = catalog.field_vectors(FIELD_KEYS[name])
+            results = sweep(vectors, k=args.k, nq=args.nq, builds=builds)
+            chosen = choose(results, args.target_recall, key=choose_key)
+            show(f"{name} n={len(vectors)}", results, chosen)
+            report[name] = {"results": results, "chosen": chosen}
+
+            new_config = {"index_type": chosen["index_type"], "params": chosen["params"],
+                          "k": args.k, "recall": chosen["recall"], "qps": chosen["qps"],
+                          "memory_bytes": chosen["memory_bytes"]}
+            old_config = config.get(name, {})
+            changed = (old_config.get("index_type", "flat"), old_config.get("params", {})) != \
+                (new_config["index_type"], new_config["params"])
+            if args.write_config and changed and new_config["index_type"] != "flat":
+                # 参数变化后删除同类型的旧索引文件, 下次建库时按新配置重建 (flat 没有参数, 无需重建)
+                stale_path = catalog.index_path_for(name, index_type=new_config["index_type"])
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+            config[name] = new_config
+        if args.write_config:
+            save_index_config(catalog.index_config_path, config)
+        total = {name: report[name]["results"][0]["memory_bytes"] for name in fields}
+        chosen_total = sum(report[name]["chosen"]["memory_bytes"] for name in fields)
+        print(f"\nper-worker index memory: {sum(total.values()) / 2 ** 20:.2f} MB float32 flat -> "
+              f"{chosen_total / 2 ** 20:.2f} MB chosen")
+
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import os
+import json
+import time
+import logging
+
+import numpy as np
+
+# 目录版本清单: 记录当前目录版本号、列式目录 meta.json 的文件戳、已删除的行以及每个索引文件对应的版本,
+# 用于在加载时发现数据库 / 向量 / 索引之间的不一致
+
+
+def file_stamp(path):
+    """
+    文件大小 + 修改时间 (ns), 用于判断列式目录是否在增量更新之外被重新生成
+    """
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def load_manifest(manifest_path):
+    """
+    读取目录版本清单, 文件不存在时返回版本 0 的空清单
+    """
+    if not os.path.exists(manifest_path):
+        return {"version": 0, "vectors_stamp": None, "rows": None, "deleted_rows": [], "indexes": {}}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest_path, manifest):
+    manifest = {**manifest, "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def load_labels(labels_path, version):
+    """
+    Load the label table of the indexes (label -> image group, label -> catalog row).
+
+    Args:
+        labels_path (str): .npz file written by `save_labels`.
+        version (int): Current catalog version; tables of other versions are stale.
+
+    Returns:
+        tuple: (index_groups, index_rows) int64 arrays, or None if missing or stale.
+    """
+    if not os.path.exists(labels_path):
+        return None
+    with np.load(labels_path) as labels:
+        if int(labels["version"]) != version:
+            logging.info(f"Label table {labels_path} is from version {int(labels['version'])}, expected {version}.")
+            return None
+        return labels["index_groups"], labels["index_rows"]
+
+
+def save_labels(labels_path, version, index_groups, index_rows):
+    tmp_path = labels_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, version=np.int64(version), index_groups=index_groups, index_rows=index_rows)
+    os.replace(tmp_path, labels_path)
+
+
+def append_change_log(log_path, entry):
+    """
+    追加一条目录变更记录 (JSON Lines)
+    """
+    entry = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), **entry}
+    with open(log_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
@@ -0,0 +1,174 @@
+import re
+import sqlite3
+import logging
+import threading
+
+from ..database.process_data import FTS_COLUMNS
+
+# trigram 分词器只能匹配不少于 3 个字符的片段, 更短的词 (如 "莫奈" "黑白") 在 FTS_COLUMNS 上按子串匹配
+MIN_TERM_LENGTH = 3
+
+TERM_SPLIT = re.compile(r"[\s,，、;；/|]+")
+
+
+def split_terms(text):
+    """
+    Split a query into its whitespace-normalised form and its terms.
+    """
+    text = " ".join(text.split())
+    return text, [term for term in TERM_SPLIT.split(text) if term]
+
+
+def build_match_query(text):
+    """
+    Turn free text into an FTS5 MATCH expression.
+
+    The whole query is searched as a phrase OR-ed with each of its terms, so
+    an exact name ranks first and partial matches still score. Every term is
+    quoted, so user input cannot inject FTS5 syntax.
+
+    Args:
+        text (str): User query.
+
+    Returns:
+        str: The MATCH expression, or None if no term is long enough.
+    """
+    text, terms = split_terms(text)
+    terms = [term for term in terms if len(term) >= MIN_TERM_LENGTH]
+    if len(text) >= MIN_TERM_LENGTH and text not in terms:
+        terms.insert(0, text)
+    if not terms:
+        return None
+    return " OR ".join('"' + term.replace('"', '""') + '"' for term in dict.fromkeys(terms))
+
+
+def escape_like(term):
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def short_terms_sql(n_terms):
+    """
+    Substring scan over every FTS column for n_terms terms.
+
+    Each term is bound twice per column (match count, weighted score) and
+    twice for the exact name check; see `KeywordIndex._short_terms`.
+    """
+    like = "ifnull({column}, '') LIKE ? ESCAPE '\\'"
+    any_column = "(" + " OR ".join(like.format(column=column) for column in FTS_COLUMNS) + ")"
+    weighted = " + ".join(f"{weight} * (" + like.format(column=column) + ")" for column, weight in FTS_COLUMNS.items())
+    exact = " OR ".join(["name_zh = ? OR name_en = ? COLLATE NOCASE"] * n_terms)
+    return f"""
+        SELECT slug_new, exact FROM (
+            SELECT slug_new, name_zh, ({exact}) AS exact,
+                   {" + ".join([any_column] * n_terms)} AS matched,
+                   {" + ".join([f"({weighted})"] * n_terms)} AS score
+            FROM styles
+        )
+        WHERE matched > 0
+        ORDER BY exact DESC, matched DESC, score DESC, length(name_zh)
+        LIMIT ?
+    """
+
+
+class KeywordIndex:
+    """
+    BM25 search over the styles_fts full-text index in the styles database.
+
+    The trigram index cannot match terms shorter than MIN_TERM_LENGTH
+    (two-character words such as 莫奈 or 黑白 are common in Chinese), so
+    those terms are matched as substrings of every indexed column in both
+    languages and merged into the BM25 hits.
+    """
+
+    def __init__(self, db_path):
+        """
+        Args:
+            db_path (str): SQLite database holding the styles table. The
+                full-text index is built by src.database.process_data; if it
+                is missing every term is matched by substring scan.
+        """
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self.has_fts = self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='styles_fts'"
+        ).fetchone() is not None
+        if not self.has_fts:
+            logging.warning(f"Full-text index styles_fts not found in {db_path}; keyword search falls back to "
+                            f"substring scans. Build it with: python -m src.database.process_data --index-only")
+        weights = ", ".join(str(w) for w in FTS_COLUMNS.values())
+        self._sql = f"""
+            SELECT styles.slug_new, bm25(styles_fts, {weights}) AS score
+            FROM styles_fts JOIN styles ON styles.rowid = styles_fts.rowid
+            WHERE styles_fts MATCH ?
+            ORDER BY score
+            LIMIT ?
+        """
+
+    def _bm25(self, text, k):
+        query = build_match_query(text)
+        if query is None or not self.has_fts:
+            return []
+        try:
+            with self._lock:
+                return self._conn.execute(self._sql, (query, k)).fetchall()
+        except sqlite3.OperationalError as e:
+            logging.warning(f"Full-text query {query!r} failed: {e}")
+            return []
+
+    def _short_terms(self, text, k):
+        """
+        Substring matches for the terms the full-text index cannot handle,
+        over every FTS column in both languages.
+
+        A row whose name equals a term ranks first. The other rows are
+        ranked by how many of the terms they contain, then by the summed
+        BM25 weights of the columns containing them (a term in the name
+        outranks one in the description).
+
+        Returns:
+            tuple: (exact name match slugs, substring match slugs), best first.
+        """
+        text, terms = split_terms(text)
+        terms = [text] + terms
+        if self.has_fts:
+            terms = [term for term in terms if len(term) < MIN_TERM_LENGTH]
+        terms = list(dict.fromkeys(term for term in terms if term))
+        if not terms:
+            return [], []
+        patterns = [f"%{escape_like(term)}%" for term in terms]
+        params = [value for term in terms for value in (term, term)]
+        params += [pattern for pattern in patterns for _ in FTS_COLUMNS] * 2 + [k]
+        exact, partial = [], []
+        with self._lock:
+            for slug, is_exact in self._conn.execute(short_terms_sql(len(terms)), params):
+                (exact if is_exact else partial).append(slug)
+        return exact, partial
+
+    def search(self, text, k=20):
+        """
+        Args:
+            text (str): User query.
+            k (int): Max number of hits.
+
+        Returns:
+            tuple: (slug_new list, scores), best first; higher scores are
+                better. Exact name matches of short terms rank above the
+                BM25 hits and their substring matches below them.
+        """
+        # SQLite 的 bm25() 越小越相关, 取负数使分数越大越好
+        hits = [(slug, -score) for slug, score in self._bm25(text, k)]
+        exact, partial = self._short_terms(text, k)
+        if exact or partial:
+            top = hits[0][1] if hits else 0.0
+            bottom = hits[-1][1] if hits else 0.0
+            hits = [(slug, top + 1.0) for slug in exact] + hits + [(slug, bottom - 1.0) for slug in partial]
+        merged = {}
+        for slug, score in hits:
+            merged.setdefault(slug, score)
+        slugs = list(merged)[:k]
+        return slugs, [merged[slug] for slug in slugs]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,225 @@
+import os
+import math
+import sqlite3
+import logging
+from collections import namedtuple
+
+import faiss
+import numpy as np
+
+from .ann_index import BINARY_RESCORE_OVERSAMPLE, supports_selector
+
+# 可用于过滤的字段; 多个取值用逗号分隔 (如 features_en = "portraits,bw-monochrome")
+FILTER_FIELDS = ("categories_en", "type_en", "features_en")
+
+# 选中的标签不超过该数量时直接在候选向量上精确计算距离, 否则把位图作为 IDSelector 传给 FAISS
+FILTER_BRUTE_FORCE_MAX = int(os.environ.get("FILTER_BRUTE_FORCE_MAX", 4096))
+
+# bitmap: 按标签打包的位图 (little bit order, 与 faiss.IDSelectorBitmap 一致); count: 选中的标签数
+Selection = namedtuple("Selection", ["bitmap", "count"])
+
+
+def split_values(text):
+    return [value.strip() for value in (text or "").split(",") if value.strip()]
+
+
+class MetadataFilter:
+    """
+    Per-value label bitmaps of the filterable styles columns.
+
+    Bitmaps are built once from SQLite and kept packed, so combining filters
+    is a few bitwise ops over n_labels / 8 bytes. Values of one field are
+    OR-ed, different fields are AND-ed.
+    """
+
+    def __init__(self, db_path, slugs, row_labels, n_labels, label_vectors):
+        """
+        Args:
+            db_path (str): SQLite database holding the styles table.
+            slugs (list): slug_new of every catalog row.
+            row_labels (np.ndarray): Index label of every catalog row, -1 if deleted.
+            n_labels (int): Number of labels in the indexes.
+            label_vectors (callable): `label_vectors(key, labels)` of the same catalog
+                (StyleCatalog.label_vectors), used to score small selections exactly.
+        """
+        self.n_labels = n_labels
+        self.label_vectors = label_vectors
+        label_of_slug = {slug: int(label) for slug, label in zip(slugs, row_labels.tolist()) if label >= 0}
+
+        columns = ", ".join(FILTER_FIELDS)
+        conn = sqlite3.connect(db_path)
+        try:
+            rows = conn.execute(f"SELECT slug_new, {columns} FROM styles").fetchall()
+        finally:
+            conn.close()
+
+        labels_by_value = {field: {} for field in FILTER_FIELDS}
+        for slug, *values in rows:
+            label = label_of_slug.get(slug)
+            if label is None:
+                continue
+            for field, text in zip(FILTER_FIELDS, values):
+                for value in split_values(text):
+                    labels_by_value[field].setdefault(value, []).append(label)
+
+        self.bitmaps = {}
+        self.counts = {}
+        for field, values in labels_by_value.items():
+            self.bitmaps[field], self.counts[field] = {}, {}
+            for value, labels in values.items():
+                mask = np.zeros(n_labels, dtype=bool)
+                mask[labels] = True
+                self.bitmaps[field][value] = np.packbits(mask, bitorder="little")
+                self.counts[field][value] = int(mask.sum())
+        logging.info(f"Built filter bitmaps for {sum(len(v) for v in self.bitmaps.values())} values "
+                     f"over {n_labels} labels.")
+
+    def values(self):
+        """
+        Returns:
+            dict: field -> {value: number of matching labels}, most frequent first.
+        """
+        return {field: dict(sorted(counts.items(), key=lambda item: -item[1])) for field, counts in self.counts.items()}
+
+    def select(self, filters):
+        """
+        Combine filter values into one label bitmap.
+
+        Args:
+            filters (dict): field -> list of accepted values.
+
+        Returns:
+            Selection: The combined bitmap and its popcount, or None if no filter is given.
+
+        Raises:
+            ValueError: If a field is not filterable.
+        """
+        filters = {field: values for field, values in (filters or {}).items() if values}
+        if not filters:
+            return None
+        unknown = [field for field in filters if field not in self.bitmaps]
+        if unknown:
+            raise ValueError(f"Unsupported filter fields: {unknown}, expected some of {list(FILTER_FIELDS)}.")
+
+        empty = np.zeros((self.n_labels + 7) // 8, dtype=np.uint8)
+        bitmap = None
+        for field, values in filters.items():
+            field_bitmap = empty
+            for value in values:
+                field_bitmap = field_bitmap | self.bitmaps[field].get(value, empty)
+            bitmap = field_bitmap if bitmap is None else bitmap & field_bitmap
+        count = int(np.unpackbits(bitmap, count=self.n_labels, bitorder="little").sum())
+        return Selection(bitmap, count)
+
+    def search(self, index, key, selection, query_vectors, k):
+        """
+        Search only the selected labels of an index.
+
+        Small selections are scored exactly against their vectors (cheaper
+        than any index scan). Larger ones are passed to FAISS as an
+        IDSelectorBitmap; IVF nprobe and HNSW efSearch are scaled up by the
+        inverse selectivity so enough selected candidates are visited.
+        Indexes without selector support (binary) are searched k / selectivity
+        deep, the unselected labels are dropped and the remaining candidates
+        are re-scored with exact L2 distances.
+
+        Args:
+            index (faiss.Index): Field index.
+            key (str): vectors_dict key of the field.
+            selection (Selection): From `select`.
+            query_vectors (np.ndarray): Query matrix of shape (n, d).
+            k (int): Number of results per query.
+
+        Returns:
+            tuple: (distances, labels) of shape (n, k), padded with -1 like faiss.
+        """
+        query_vectors = np.ascontiguousarray(query_vectors, dtype="float32")
+        if selection.count <= FILTER_BRUTE_FORCE_MAX:
+            labels = np.flatnonzero(np.unpackbits(selection.bitmap, count=self.n_labels, bitorder="little"))
+            return search_exact(self.label_vectors(key, labels), labels, query_vectors, k)
+
+        selectivity = selection.count / self.n_labels
+        if not supports_selector(index):
+            selected = np.unpackbits(selection.bitmap, count=self.n_labels, bitorder="little").astype(bool)
+            fetch_k = k * BINARY_RESCORE_OVERSAMPLE
+            distances, labels = index.search(query_vectors, min(index.ntotal, math.ceil(fetch_k / selectivity)))
+            _, labels = keep_selected(distances, labels, selected, fetch_k)
+            return rescore_exact(lambda candidates: self.label_vectors(key, candidates), labels, query_vectors, k)
+
+        selector = faiss.IDSelectorBitmap(self.n_labels, faiss.swig_ptr(selection.bitmap))
+        params = faiss.SearchParameters(sel=selector)
+        concrete = faiss.downcast_index(index)
+        if isinstance(concrete, faiss.IndexIVF):
+            params = faiss.SearchParametersIVF(sel=selector,
+                                               nprobe=min(concrete.nlist, math.ceil(concrete.nprobe / selectivity)))
+        elif hasattr(concrete, "hnsw"):
+            params = faiss.SearchParametersHNSW(sel=selector,
+                                                efSearch=min(4096, math.ceil(concrete.hnsw.efSearch / selectivity)))
+        return index.search(query_vectors, k, params=params)
+
+
+def keep_selected(distances, labels, selected, k):
+    """
+    Keep the first k selected labels of each result row, padded with -1 like faiss.
+    """
+    n = len(labels)
+    result_distances = np.full((n, k), np.inf, dtype="float32")
+    result_labels = np.full((n, k), -1, dtype="int64")
+    for row in range(n):
+        keep = labels[row] >= 0
+        keep[keep] = selected[labels[row][keep]]
+        top = np.flatnonzero(keep)[:k]
+        result_distances[row, :len(top)] = distances[row, top]
+        result_labels[row, :len(top)] = labels[row, top]
+    return result_distances, result_labels
+
+
+def search_exact(vectors, labels, query_vectors, k):
+    """
+    Exact L2 search over a small candidate set.
+
+    Returns:
+        tuple: (distances, labels) of shape (n, k), padded with -1 like faiss.
+    """
+    n = len(query_vectors)
+    distances = np.full((n, k), np.inf, dtype="float32")
+    result_labels = np.full((n, k), -1, dtype="int64")
+    if len(labels) == 0:
+        return distances, result_labels
+    d2 = ((query_vectors ** 2).sum(1)[:, None] + (vectors ** 2).sum(1)[None, :]
+          - 2.0 * query_vectors @ vectors.T).clip(min=0)
+    top = min(k, len(labels))
+    part = np.argpartition(d2, top - 1, axis=1)[:, :top]
+    order = np.take_along_axis(d2, part, axis=1).argsort(axis=1, kind="stable")
+    part = np.take_along_axis(part, order, axis=1)
+    distances[:, :top] = np.take_along_axis(d2, part, axis=1)
+    result_labels[:, :top] = labels[part]
+    return distances, result_labels
+
+
+def rescore_exact(label_vectors, labels, query_vectors, k):
+    """
+    Re-rank the candidate labels of every query by exact L2 distance, e.g.
+    the Hamming-ranked hits of a binary index.
+
+    Args:
+        label_vectors (callable): Sorted label array -> their vectors.
+        labels (np.ndarray): Candidate labels of shape (n, m), -1 for padding.
+        query_vectors (np.ndarray): Query matrix of shape (n, d).
+        k (int): Number of results per query.
+
+    Returns:
+        tuple: (distances, labels) of shape (n, k), padded with -1 like faiss.
+    """
+    n = len(query_vectors)
+    distances = np.full((n, k), np.inf, dtype="float32")
+    result_labels = np.full((n, k), -1, dtype="int64")
+    candidates = np.unique(labels[labels >= 0])
+    if len(candidates) == 0:
+        return distances, result_labels
+    vectors = np.asarray(label_vectors(candidates), dtype="float32")
+    for row in range(n):
+        row_labels = labels[row][labels[row] >= 0]
+        d, l = search_exact(vectors[np.searchsorted(candidates, row_labels)], row_labels, query_vectors[row:row + 1], k)
+        distances[row], result_labels[row] = d[0], l[0]
+    return distances, result_labels
@@ -0,0 +1,267 @@
+"""
+ONNX Runtime 文本编码后端
+
+export 把 SentenceTransformer 模型 (Transformer + Pooling + Dense) 导出为 ONNX, 只保留前
+output_dim (默认 RERANK_DIM) 维输出: 末尾的 Dense 层按行裁剪, 不再计算用不到的维度; Normalize 层被去掉,
+截断后由 embedding.truncate_and_normalize 重新归一化, 结果与先归一化再截断一致.
+加 --quantize 再生成动态 int8 量化的 model_int8.onnx. 运行时只依赖 onnxruntime 和 tokenizers,
+不加载 PyTorch.
+
+verify 用 PyTorch 编码结果作为基准, 报告 ONNX 后端的余弦偏差、在现有字段索引上的 recall@k 变化、
+单条查询编码延迟和模型文件大小.
+
+通过环境变量 ENCODER_BACKEND=onnx / onnx-int8 让 API 服务和建库脚本使用该后端.
+
+用法:
+    python -m src.search.onnx_encoder export --quantize
+    python -m src.search.onnx_encoder verify --backend onnx-int8 --queries 500 --k 10
+"""
+import os
+import copy
+import json
+import time
+import random
+import logging
+import argparse
+
+import numpy as np
+
+from .embedding import MODEL_NAME, EMBED_DIM, RERANK_DIM, ENCODER_BACKENDS, load_text_encoder, encode_texts, \
+    truncate_and_normalize
+
+# 动态生成文件路径
+base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+data_dir = os.path.join(base_dir, 'data')
+onnx_dir = os.environ.get("ONNX_MODEL_DIR") or os.path.join(data_dir, 'onnx', MODEL_NAME.replace("/", "__"))
+jsonl_file_path = os.path.join(data_dir, 'midjoury_styles_lib_final_zh_en_demo.jsonl')
+
+# 每个 worker 的 ONNX Runtime 线程数, 0 表示由 onnxruntime 决定 (物理核数)
+ONNX_NUM_THREADS = int(os.environ.get("ONNX_NUM_THREADS", 0))
+ONNX_OPSET = 17
+
+MODEL_FILES = {"onnx": "model.onnx", "onnx-int8": "model_int8.onnx"}
+CONFIG_FILE = "encoder.json"
+TOKENIZER_FILE = "tokenizer.json"
+
+
+def model_path(backend, path=onnx_dir):
+    return os.path.join(path, MODEL_FILES[backend])
+
+
+class OnnxTextEncoder:
+    """
+    Drop-in replacement for SentenceTransformer.encode backed by ONNX Runtime.
+    """
+
+    def __init__(self, path=onnx_dir, backend="onnx", num_threads=ONNX_NUM_THREADS):
+        """
+        Args:
+            path (str): Directory written by `export`.
+            backend (str): "onnx" (fp32) or "onnx-int8" (dynamically quantized).
+            num_threads (int): Intra-op threads, 0 for the onnxruntime default.
+        """
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(path, CONFIG_FILE), "r", encoding="utf-8") as f:
+            self.config = json.load(f)
+        if self.config["model"] != MODEL_NAME:
+            raise ValueError(f"{path} was exported from {self.config['model']}, expected {MODEL_NAME}.")
+        self.output_dim = self.config["output_dim"]
+        if self.output_dim < max(EMBED_DIM, RERANK_DIM):
+            raise ValueError(f"{path} outputs {self.output_dim} dimensions, RERANK_DIM is {RERANK_DIM}. "
+                             f"Re-run the export with a larger --dim.")
+        self.prompt = self.config.get("prompt") or ""
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(path, TOKENIZER_FILE))
+        self.tokenizer.enable_truncation(max_length=self.config["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=self.config["pad_token_id"], pad_token=self.config["pad_token"])
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(model_path(backend, path), options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def encode(self, texts, batch_size=32, normalize_embeddings=False, show_progress_bar=False):
+        """
+        Encode texts into (n, output_dim) float32 vectors. Like
+        SentenceTransformer, inputs are sorted by length before batching so
+        each batch pads to a similar length.
+        """
+        if isinstance(texts, str):
+            texts = [texts]
+        vectors = np.zeros((len(texts), self.output_dim), dtype="float32")
+        order = np.argsort([-len(text) for text in texts], kind="stable")
+        for start in range(0, len(texts), batch_size):
+            batch = order[start:start + batch_size]
+            encodings = self.tokenizer.encode_batch([self.prompt + texts[i] for i in batch])
+            feed = {
+                "input_ids": np.array([e.ids for e in encodings], dtype="int64"),
+                "attention_mask": np.array([e.attention_mask for e in encodings], dtype="int64"),
+                "token_type_ids": np.array([e.type_ids for e in encodings], dtype="int64"),
+            }
+            vectors[batch] = self.session.run(None, {name: feed[name] for name in self.input_names})[0]
+        if normalize_embeddings:
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors
+
+
+def export(path=onnx_dir, output_dim=RERANK_DIM, quantize=False):
+    """
+    Export the SentenceTransformer model to ONNX, optionally with a
+    dynamically int8-quantized copy.
+
+    Args:
+        path (str): Output directory.
+        output_dim (int): Number of leading output dimensions kept in the graph.
+        quantize (bool): Also write model_int8.onnx.
+    """
+    import torch
+    from sentence_transformers import models
+
+    model = load_text_encoder(backend="torch")
+    model.eval()
+    modules = [module for module in model if not isinstance(module, models.Normalize)]
+    last = modules[-1]
+    if isinstance(last, models.Dense) and last.linear.out_features > output_dim:
+        # 只保留 Dense 输出的前 output_dim 行, 等价于计算完整输出后截断
+        last = copy.deepcopy(last)
+        last.linear.weight = torch.nn.Parameter(last.linear.weight[:output_dim].clone())
+        if last.linear.bias is not None:
+            last.linear.bias = torch.nn.Parameter(last.linear.bias[:output_dim].clone())
+        last.linear.out_features = output_dim
+        last.out_features = output_dim
+        modules[-1] = last
+    body = torch.nn.Sequential(*modules)
+
+    sample = model.tokenizer(["示例文本", "another sample"], padding=True, return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+
+    class EncoderGraph(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.body = body
+
+        def forward(self, *inputs):
+            features = dict(zip(input_names, inputs))
+            return self.body(features)["sentence_embedding"][:, :output_dim]
+
+    os.makedirs(path, exist_ok=True)
+    fp32_path = model_path("onnx", path)
+    with torch.no_grad():
+        torch.onnx.export(EncoderGraph(), tuple(sample[name] for name in input_names), fp32_path,
+                          input_names=input_names, output_names=["embedding"], opset_version=ONNX_OPSET,
+                          dynamic_axes={**{name: {0: "batch", 1: "sequence"} for name in input_names},
+                                        "embedding": {0: "batch"}})
+    model.tokenizer.backend_tokenizer.save(os.path.join(path, TOKENIZER_FILE))
+    prompt = model.prompts.get(model.default_prompt_name, "") if model.default_prompt_name else ""
+    config = {
+        "model": MODEL_NAME,
+        "output_dim": output_dim,
+        "max_seq_length": model.max_seq_length,
+        "pad_token": model.tokenizer.pad_token,
+        "pad_token_id": model.tokenizer.pad_token_id,
+        "prompt": prompt,
+        "exported_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    with open(os.path.join(path, CONFIG_FILE), "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    logging.info(f"Exported {MODEL_NAME} ({output_dim}-d output) to {fp32_path} "
+                 f"({os.path.getsize(fp32_path) / 2 ** 20:.1f} MiB).")
+
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        int8_path = model_path("onnx-int8", path)
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8, per_channel=True)
+        logging.info(f"Quantized {fp32_path} to {int8_path} ({os.path.getsize(int8_path) / 2 ** 20:.1f} MiB).")
+    return config
+
+
+def sample_queries(n, file_path=jsonl_file_path, seed=0):
+    """
+    从语料各字段文本中抽样作为验证查询
+    """
+    from .vector import iter_jsonl, field_texts
+    from .style_search import FIELD_KEYS
+
+    texts = []
+    for line in iter_jsonl(file_path):
+        texts.extend(text for key in FIELD_KEYS.values() for text in field_texts([line], key) if text.strip())
+    texts = list(dict.fromkeys(texts))
+    return random.Random(seed).sample(texts, min(n, len(texts)))
+
+
+def median_latency_ms(text_encoder, texts, n=50):
+    encode_texts(text_encoder, texts[:1], dim=RERANK_DIM)  # 预热
+    latencies = []
+    for text in texts[:n]:
+        start = time.perf_counter()
+        encode_texts(text_encoder, [text], dim=RERANK_DIM, batch_size=1)
+        latencies.append(time.perf_counter() - start)
+    return round(float(np.median(latencies)) * 1000, 2)
+
+
+def verify(backend, n_queries=500, k=10, path=onnx_dir):
+    """
+    Compare an ONNX backend against the PyTorch encoder.
+
+    Reports the cosine similarity between the two encodings of each query (at
+    EMBED_DIM and RERANK_DIM), the overlap of their top-k results on every
+    existing field index (recall@k of the ONNX queries against the PyTorch
+    queries), single-query latency and model file size.
+
+    Returns:
+        dict: The report.
+    """
+    from .index_benchmark import recall_at_k
+    from . import style_search as ss
+
+    queries = sample_queries(n_queries)
+    reference = load_text_encoder(backend="torch")
+    candidate = OnnxTextEncoder(path, backend)
+    base = encode_texts(reference, queries, dim=RERANK_DIM)
+    vectors = encode_texts(candidate, queries, dim=RERANK_DIM)
+
+    report = {"backend": backend, "queries": len(queries), "k": k}
+    for dim in sorted({EMBED_DIM, RERANK_DIM}):
+        cosine = np.sum(truncate_and_normalize(base, dim) * truncate_and_normalize(vectors, dim), axis=1)
+        report[f"cosine@{dim}"] = {"mean": round(float(cosine.mean()), 6), "min": round(float(cosine.min()), 6),
+                                   "p01": round(float(np.percentile(cosine, 1)), 6)}
+
+    base_queries, candidate_queries = truncate_and_normalize(base), truncate_and_normalize(vectors)
+    report["recall"] = {}
+    for name, index in ss.field_indexes.items():
+        top_k = min(k, index.ntotal)
+        _, expected = index.search(base_queries, top_k)
+        _, found = index.search(candidate_queries, top_k)
+        report["recall"][name] = round(recall_at_k(expected, found), 4)
+
+    report["latency_ms"] = {"torch": median_latency_ms(reference, queries),
+                            backend: median_latency_ms(candidate, queries)}
+    report["model_mib"] = round(os.path.getsize(model_path(backend, path)) / 2 ** 20, 1)
+    return report
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Export and verify the ONNX Runtime text encoder.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="Export the model to ONNX.")
+    export_parser.add_argument("--dim", type=int, default=RERANK_DIM, help="Leading output dimensions to keep.")
+    export_parser.add_argument("--quantize", action="store_true", help="Also write a dynamic int8 model.")
+    verify_parser = subparsers.add_parser("verify", help="Compare an ONNX backend with PyTorch.")
+    verify_parser.add_argument("--backend", default="onnx-int8", choices=[b for b in ENCODER_BACKENDS if b != "torch"])
+    verify_parser.add_argument("--queries", type=int, default=500, help="Number of sampled corpus texts.")
+    verify_parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export(output_dim=args.dim, quantize=args.quantize)
+    else:
+        print(json.dumps(verify(args.backend, args.queries, args.k), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
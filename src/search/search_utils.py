@@ -0,0 +1,250 @@
+"""
+检索用的纯函数: 字段定义、建索引、图片分组、按图片去重的检索和多路结果融合.
+导入本模块不会读取任何数据文件, 目录和索引由 style_search.StyleCatalog 加载.
+"""
+import os
+import logging
+
+import faiss
+import numpy as np
+
+from .ann_index import INDEX_TYPES, create_index
+
+# 每个字段索引对应的向量 key
+FIELD_KEYS = {
+    "type": "type_zh",
+    "content": "desc_zh",
+    "style": "ai_style_zh",
+    "features": "ai_features_zh",
+    "color": "ai_color_zh",
+    "all_ai_info": "all_ai_info_zh",
+}
+
+# 建索引时按图片折叠重复行: "none" 每行一个向量, "first" 每组取第一行的向量, "mean" 每组取平均向量
+INDEX_COLLAPSE = os.environ.get("INDEX_COLLAPSE", "none")
+
+
+# Build FAISS index
+def build_index(vectors, index_type="flat", save_path=None, params=None):
+    """
+    Build a FAISS index for the given vectors.
+
+    Args:
+        vectors (list | np.ndarray): Vectors to index, shape (n, d).
+        index_type (str): Type of FAISS index to use, one of ann_index.INDEX_TYPES
+            ("flat", "ivf", "ivfsq8", "ivfpq", "hnsw").
+        save_path (str): Path to save the built index (optional).
+        params (dict): Index parameters (nlist, nprobe, pq_m, M, efSearch, ...), defaults when omitted.
+
+    Returns:
+        faiss.Index: The built FAISS index.
+    """
+    if vectors is None or len(vectors) == 0:
+        raise ValueError("The input vectors are empty or invalid.")
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unsupported index type: {index_type}")
+
+    index = create_index(vectors, index_type=index_type, params=params)
+    logging.info(f"Built {index_type} index with {len(vectors)} vectors.")
+
+    if save_path:
+        faiss.write_index(index, save_path)
+        logging.info(f"Index saved to {save_path}.")
+
+    return index
+
+
+# Image groups: rows sharing one img_url (e.g. vincent-peters_1, vincent-peters_2) form one group
+def build_group_ids(img_urls):
+    """
+    Assign a dense group id to every row; rows with the same img_url share it.
+
+    Args:
+        img_urls (list): Image URL of every row.
+
+    Returns:
+        np.ndarray: int64 group id per row.
+    """
+    group_of = {}
+    return np.array([group_of.setdefault(url, len(group_of)) for url in img_urls], dtype='int64')
+
+
+def group_members(group_ids, alive=None):
+    """
+    CSR layout of group membership: rows of group g are members[offsets[g]:offsets[g + 1]].
+
+    Args:
+        group_ids (np.ndarray): Group id of every row.
+        alive (np.ndarray): Optional bool mask; deleted rows are left out of their group.
+
+    Returns:
+        tuple: (offsets, members) int64 arrays.
+    """
+    rows = np.arange(len(group_ids), dtype='int64') if alive is None else np.flatnonzero(alive)
+    members = rows[np.argsort(group_ids[rows], kind='stable')]
+    counts = np.bincount(group_ids[rows], minlength=group_ids.max() + 1 if len(group_ids) else 0)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype('int64')
+    return offsets, members
+
+
+def collapse_vectors(vectors, group_ids, mode):
+    """
+    Reduce per-row vectors to one vector per image group.
+
+    Args:
+        vectors (np.ndarray): Row vectors of shape (n, d).
+        group_ids (np.ndarray): Group id of every row.
+        mode (str): "first" (first row of the group) or "mean" (re-normalized mean).
+
+    Returns:
+        np.ndarray: float32 array of shape (n_groups, d), one row per group present
+            in group_ids, in ascending group order.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype='float32')
+    if mode == "first":
+        _, first_rows = np.unique(group_ids, return_index=True)
+        return vectors[first_rows]
+    if mode == "mean":
+        groups, inverse = np.unique(group_ids, return_inverse=True)
+        sums = np.zeros((len(groups), vectors.shape[1]), dtype='float64')
+        np.add.at(sums, inverse, vectors)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        return (sums / np.maximum(norms, 1e-12)).astype('float32')
+    raise ValueError(f"Unsupported collapse mode: {mode}")
+
+
+# FAISS search function
+def search_index(index, query_vector, k=5):
+    """
+    Search the FAISS index for the k most similar vectors.
+
+    Args:
+        index (faiss.Index): The FAISS index to search.
+        query_vector (np.ndarray): The query vector.
+        k (int): Number of results to return.
+
+    Returns:
+        tuple: Distances and indices of the top-k results.
+    """
+    D, I = index.search(query_vector, k)  # D: distances, I: indices
+    return D, I
+
+
+# Batched FAISS search
+def search_batch(index, query_vectors, k=5):
+    """
+    Search the FAISS index with many query vectors in one call, so FAISS can use
+    its batched (BLAS, multi-threaded) path.
+
+    Args:
+        index (faiss.Index): The FAISS index to search.
+        query_vectors (np.ndarray): Query matrix of shape (n, d).
+        k (int): Number of results per query.
+
+    Returns:
+        list: One (distances, indices) pair per query, padding (-1) entries removed.
+    """
+    query_vectors = np.ascontiguousarray(query_vectors, dtype='float32')
+    if query_vectors.ndim != 2 or query_vectors.shape[1] != index.d:
+        raise ValueError(f"Expected query vectors of shape (n, {index.d}), got {query_vectors.shape}.")
+    D, I = search_index(index, query_vectors, min(k, index.ntotal))
+    return [(d[i >= 0], i[i >= 0]) for d, i in zip(D, I)]
+
+
+def unique_by_group(distances, indices, group_ids, k):
+    """
+    Keep the best-ranked row of each group, at most k rows, in rank order.
+    Labels whose group is -1 (deleted) are dropped.
+    """
+    valid = indices >= 0
+    valid[valid] = group_ids[indices[valid]] >= 0
+    distances, indices = distances[valid], indices[valid]
+    _, first = np.unique(group_ids[indices], return_index=True)
+    first = np.sort(first)[:k]
+    return distances[first], indices[first]
+
+
+# FAISS search returning k distinct image groups per query
+def search_unique(index, query_vectors, k, group_ids, oversample=2, search_fn=None, n_candidates=None):
+    """
+    Search for k results per query with at most one row per image group.
+
+    Each query first fetches k * oversample neighbours; queries that still have
+    fewer than k distinct groups are searched again with twice the depth until
+    they have k groups or every candidate has been fetched.
+
+    Args:
+        index (faiss.Index): The FAISS index to search.
+        query_vectors (np.ndarray): Query matrix of shape (n, d).
+        k (int): Number of distinct groups to return per query.
+        group_ids (np.ndarray): Group id of every row in the index.
+        oversample (int): Initial fetch multiplier.
+        search_fn (callable): Optional replacement for `search_index`, called
+            as search_fn(query_vectors, k) (e.g. a filtered search).
+        n_candidates (int): Number of searchable labels, index.ntotal by default.
+
+    Returns:
+        list: One (distances, indices) pair per query.
+    """
+    query_vectors = np.ascontiguousarray(query_vectors, dtype='float32')
+    if query_vectors.ndim != 2 or query_vectors.shape[1] != index.d:
+        raise ValueError(f"Expected query vectors of shape (n, {index.d}), got {query_vectors.shape}.")
+    if search_fn is None:
+        search_fn = lambda queries, fetch_k: search_index(index, queries, fetch_k)
+    n_candidates = index.ntotal if n_candidates is None else n_candidates
+    results = [None] * len(query_vectors)
+    if n_candidates == 0:
+        empty = (np.array([], dtype='float32'), np.array([], dtype='int64'))
+        return [empty] * len(query_vectors)
+    pending = np.arange(len(query_vectors))
+    fetch_k = min(k * oversample, n_candidates)
+    while len(pending):
+        D, I = search_fn(query_vectors[pending], fetch_k)
+        retry = []
+        for row, query_idx in enumerate(pending):
+            r_distances, r_indices = unique_by_group(D[row], I[row], group_ids, k)
+            if len(r_indices) < k and fetch_k < n_candidates:
+                retry.append(query_idx)
+            else:
+                results[query_idx] = (r_distances, r_indices)
+        pending = np.array(retry, dtype='int64')
+        fetch_k = min(fetch_k * 2, n_candidates)
+    return results
+
+
+# Fuse results from several FAISS indexes
+def fuse_results(results, weights, method="rrf", rrf_k=60):
+    """
+    Fuse per-index search results for one query into a single ranking.
+
+    Args:
+        results (list): One (distances, indices) pair per index, each of shape (m,).
+        weights (list): One weight per index.
+        method (str): "rrf" (weighted reciprocal-rank fusion) or "distance"
+            (weighted sum of similarities, 1 - d/2 for L2 over normalized vectors).
+        rrf_k (int): RRF smoothing constant.
+
+    Returns:
+        tuple: Row ids and fused scores, sorted by descending score.
+    """
+    ids = np.concatenate([I for _, I in results])
+    valid = ids >= 0
+    candidates, inverse = np.unique(ids[valid], return_inverse=True)
+
+    if method == "rrf":
+        scores = np.concatenate([w / (rrf_k + np.arange(1, len(I) + 1)) for (_, I), w in zip(results, weights)])
+        fused = np.bincount(inverse, weights=scores[valid], minlength=len(candidates))
+    elif method == "distance":
+        # 某个索引没召回的候选, 用该索引召回结果中的最低相似度作为估计值
+        fused = np.zeros(len(candidates), dtype="float64")
+        for (D, I), w in zip(results, weights):
+            mask = I >= 0
+            sims = 1.0 - D[mask] / 2.0
+            field_sims = np.full(len(candidates), sims.min() if len(sims) else 0.0)
+            field_sims[np.searchsorted(candidates, I[mask])] = sims
+            fused += w * field_sims
+    else:
+        raise ValueError(f"Unsupported fusion method: {method}")
+
+    order = np.argsort(-fused, kind="stable")
+    return candidates[order], fused[order]
@@ -0,0 +1,422 @@
+"""
+版本化目录快照
+
+publish 把当前 data/ 下的列式目录、字段索引、标签表、图片组、精排向量和索引配置复制到
+data/snapshots/<版本号>/, 写入 manifest.json (记录编码模型与维度、行数、标签数和每个索引的类型 / 大小 / 维度),
+最后原子地更新 data/snapshots/CURRENT. 快照一经发布不再修改, 之后 vector.py / catalog_update.py
+对 data/ 的改动不会影响正在服务的快照.
+
+API 服务的每个 worker 在后台轮询 CURRENT, 发现变化后以只读方式加载新快照 (StyleCatalog), 快照中的文件
+缺失或过期时加载失败, 不会在服务中重建; 校验维度和行数后原子切换; 切换前开始的请求持有旧快照的引用, 全部结束后旧快照才被释放.
+每个 worker 把自己的状态写到 data/snapshots/workers/<pid>.json, 供 admin 接口汇总.
+
+用法:
+    python -m src.search.snapshot publish --keep 3
+    python -m src.search.snapshot list
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import argparse
+import threading
+from contextlib import contextmanager
+
+from .ann_index import index_memory_bytes
+from .embedding import MODEL_NAME, EMBED_DIM
+from .metadata_filter import MetadataFilter
+from .style_search import StyleCatalog
+
+# 动态生成文件路径
+base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+data_dir = os.path.join(base_dir, 'data')
+snapshots_dir = os.path.join(data_dir, 'snapshots')
+db_path = os.path.join(data_dir, 'midjourney_styles_demo.db')
+
+MANIFEST_FILE = "manifest.json"
+CURRENT_FILE = "CURRENT"
+LIVE_VERSION = "live"
+workers_dir = os.path.join(snapshots_dir, "workers")
+
+
+class SnapshotError(ValueError):
+    """Raised when a snapshot is missing, incomplete or incompatible with the service."""
+
+
+def snapshot_path(version):
+    return os.path.join(snapshots_dir, version)
+
+
+def list_versions():
+    if not os.path.isdir(snapshots_dir):
+        return []
+    return sorted(name for name in os.listdir(snapshots_dir)
+                  if os.path.exists(os.path.join(snapshots_dir, name, MANIFEST_FILE)))
+
+
+def current_version():
+    """
+    CURRENT 指向的快照版本, 尚未发布过快照时返回 None
+    """
+    path = os.path.join(snapshots_dir, CURRENT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read().strip() or None
+
+
+def set_current_version(version):
+    tmp_path = os.path.join(snapshots_dir, CURRENT_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version + "\n")
+    os.replace(tmp_path, os.path.join(snapshots_dir, CURRENT_FILE))
+
+
+def write_worker_status(status):
+    """
+    记录本进程 (API worker) 的快照状态, 原子替换 workers/<pid>.json
+    """
+    os.makedirs(workers_dir, exist_ok=True)
+    path = os.path.join(workers_dir, f"{os.getpid()}.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({**status, "pid": os.getpid(), "updated_at": time.time()}, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def remove_worker_status(path=None):
+    try:
+        os.remove(path or os.path.join(workers_dir, f"{os.getpid()}.json"))
+    except FileNotFoundError:
+        pass
+
+
+def worker_statuses(max_age):
+    """
+    Snapshot status of every API worker.
+
+    Args:
+        max_age (float): Seconds; status files not updated for longer belong
+            to workers that exited without cleaning up and are removed.
+
+    Returns:
+        list: One status dict per live worker, ordered by pid.
+    """
+    if not os.path.isdir(workers_dir):
+        return []
+    statuses = []
+    for name in os.listdir(workers_dir):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(workers_dir, name)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                status = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if time.time() - status.get("updated_at", 0) > max_age:
+            remove_worker_status(path)
+            continue
+        statuses.append(status)
+    return sorted(statuses, key=lambda status: status["pid"])
+
+
+def load_snapshot_manifest(version):
+    path = os.path.join(snapshot_path(version), MANIFEST_FILE)
+    if not os.path.exists(path):
+        raise SnapshotError(f"Snapshot {version} not found in {snapshots_dir}.")
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def describe(ss, version):
+    """
+    Manifest of a loaded StyleCatalog.
+    """
+    rerank_dims = {key: int(matrix.shape[1]) for key, matrix in ss.rerank_vectors.items()}
+    return {
+        "version": version,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "catalog_version": ss.catalog_manifest["version"],
+        "embedding": {"model": MODEL_NAME, "dim": EMBED_DIM, "rerank_dims": rerank_dims},
+        "rows": len(ss.slugs),
+        "labels": len(ss.index_rows),
+        "index_collapse": ss.collapse,
+        "indexes": {name: {"file": os.path.basename(ss.field_index_spec(name)[2]),
+                           "index_type": ss.field_index_spec(name)[0],
+                           "ntotal": int(index.ntotal), "d": int(index.d)}
+                    for name, index in ss.field_indexes.items()},
+    }
+
+
+def snapshot_files(ss):
+    """
+    data/ 下组成一个快照的文件和目录 (相对路径)
+    """
+    files = ["catalog", os.path.basename(ss.catalog_manifest_path), os.path.basename(ss.group_ids_path),
+             os.path.basename(ss.index_labels_path())]
+    files += [os.path.basename(ss.field_index_spec(name)[2]) for name in ss.field_indexes]
+    for optional in (ss.rerank_dir, ss.index_config_path):
+        if os.path.exists(optional):
+            files.append(os.path.basename(optional))
+    return files
+
+
+def publish(keep=None, activate=True):
+    """
+    Copy the current catalog artifacts into a new snapshot directory.
+
+    The live catalog is built first, so stale indexes are rebuilt before
+    they are copied; this is the only place a snapshot's artifacts are
+    produced. Files are copied (not hard-linked) because index and rerank
+    files are rewritten in place by later builds. The copy is loaded
+    read-only and validated, and only then renamed into place.
+
+    Args:
+        keep (int): Keep only this many newest snapshots (plus CURRENT); None keeps all.
+        activate (bool): Point CURRENT at the new snapshot.
+
+    Returns:
+        dict: The manifest of the new snapshot.
+
+    Raises:
+        SnapshotError: If the copy does not load read-only.
+    """
+    ss = StyleCatalog(data_dir, build=True)
+    versions = list_versions()
+    version = f"{int(versions[-1]) + 1 if versions else 1:06d}"
+    os.makedirs(snapshots_dir, exist_ok=True)
+    tmp_dir = os.path.join(snapshots_dir, f".tmp-{version}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    files = snapshot_files(ss)
+    for name in files:
+        src = os.path.join(ss.data_dir, name)
+        if os.path.isdir(src):
+            shutil.copytree(src, os.path.join(tmp_dir, name))
+        else:
+            shutil.copy2(src, os.path.join(tmp_dir, name))
+    manifest = {**describe(ss, version), "files": files}
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    try:
+        validate(StyleCatalog(tmp_dir, collapse=ss.collapse), manifest)
+    except (OSError, ValueError) as e:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise SnapshotError(f"Snapshot {version} does not load read-only: {e}")
+    os.rename(tmp_dir, snapshot_path(version))
+    if activate:
+        set_current_version(version)
+    logging.info(f"Published snapshot {version}: {manifest['rows']} rows, {manifest['labels']} labels.")
+
+    if keep is not None:
+        current = current_version()
+        for old in list_versions()[:-keep]:
+            if old != current:
+                shutil.rmtree(snapshot_path(old))
+                logging.info(f"Removed snapshot {old}.")
+    return manifest
+
+
+def check_manifest(version, manifest):
+    """
+    Cheap checks that need only the manifest: the files are present and the
+    snapshot was embedded with the model and dimension the service uses.
+
+    Raises:
+        SnapshotError: On a missing file or a model / dimension mismatch.
+    """
+    missing = [name for name in manifest["files"] if not os.path.exists(os.path.join(snapshot_path(version), name))]
+    if missing:
+        raise SnapshotError(f"Snapshot {version} is missing {missing}.")
+    if manifest["embedding"]["model"] != MODEL_NAME:
+        raise SnapshotError(f"Snapshot was embedded with {manifest['embedding']['model']}, "
+                            f"the service encodes queries with {MODEL_NAME}.")
+    if manifest["embedding"]["dim"] != EMBED_DIM:
+        raise SnapshotError(f"Snapshot index dimension {manifest['embedding']['dim']} != EMBED_DIM {EMBED_DIM}.")
+
+
+def validate(ss, manifest):
+    """
+    Check a loaded catalog against its manifest and the running service.
+
+    Raises:
+        SnapshotError: On any mismatch of model, dimensions, row or label counts.
+    """
+    if manifest["embedding"]["model"] != MODEL_NAME:
+        raise SnapshotError(f"Snapshot was embedded with {manifest['embedding']['model']}, "
+                            f"the service encodes queries with {MODEL_NAME}.")
+    if manifest["embedding"]["dim"] != EMBED_DIM:
+        raise SnapshotError(f"Snapshot index dimension {manifest['embedding']['dim']} != EMBED_DIM {EMBED_DIM}.")
+    if manifest["index_collapse"] != ss.collapse:
+        raise SnapshotError(f"Snapshot indexes are collapsed by {manifest['index_collapse']!r}, "
+                            f"the service uses {ss.collapse!r}.")
+    if len(ss.slugs) != manifest["rows"]:
+        raise SnapshotError(f"Snapshot holds {len(ss.slugs)} rows, manifest says {manifest['rows']}.")
+    if len(ss.index_rows) != manifest["labels"]:
+        raise SnapshotError(f"Snapshot holds {len(ss.index_rows)} labels, manifest says {manifest['labels']}.")
+    for name, entry in manifest["indexes"].items():
+        index = ss.field_indexes.get(name)
+        if index is None or index.ntotal != entry["ntotal"] or index.ntotal != len(ss.index_rows):
+            raise SnapshotError(f"Index {name} holds {None if index is None else index.ntotal} vectors, "
+                                f"expected {entry['ntotal']}.")
+        if index.d != entry["d"] or index.d != EMBED_DIM:
+            raise SnapshotError(f"Index {name} has dimension {index.d}, expected {EMBED_DIM}.")
+
+
+class Snapshot:
+    """
+    One loaded catalog version: a read-only StyleCatalog plus the
+    per-catalog structures the service derives from it.
+    """
+
+    def __init__(self, version, ss, manifest):
+        self.version = version
+        self.ss = ss
+        self.manifest = manifest
+        self.loaded_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.refs = 0
+        # 按类别 / 类型 / 特征预先计算的标签位图, 用于过滤检索
+        self.metadata_filter = MetadataFilter(db_path, ss.slugs, ss.row_labels, len(ss.index_rows),
+                                              ss.label_vectors)
+        # slug_new -> 索引标签, 把全文检索命中的行映射到向量索引的标签空间
+        self.slug_labels = {slug: int(label) for slug, label in zip(ss.slugs, ss.row_labels.tolist()) if label >= 0}
+        self._index_sizes = None
+
+    def info(self):
+        return {"version": self.version, "loaded_at": self.loaded_at, "in_flight": self.refs,
+                "catalog_version": self.manifest["catalog_version"], "rows": self.manifest["rows"],
+                "labels": self.manifest["labels"], "embedding": self.manifest["embedding"]}
+
+    def index_sizes(self):
+        """
+        Returns:
+            dict: Field name -> (vector count, serialized bytes), computed on first call.
+        """
+        if self._index_sizes is None:
+            self._index_sizes = {name: (int(index.ntotal), index_memory_bytes(index))
+                                 for name, index in self.ss.field_indexes.items()}
+        return self._index_sizes
+
+    def close(self):
+        # 只释放本快照的引用; 索引和 mmap 在没有其他引用后由 GC 回收
+        self.ss = self.metadata_filter = self.slug_labels = None
+
+
+def load_snapshot(version=None):
+    """
+    Load and validate a snapshot, read-only.
+
+    Args:
+        version (str): Snapshot version; None loads the live data/ directory,
+            whose indexes must have been built with `python -m src.search.style_search`.
+
+    Returns:
+        Snapshot: The loaded snapshot.
+
+    Raises:
+        SnapshotError: If the snapshot is missing or fails validation.
+    """
+    start = time.perf_counter()
+    if version is None:
+        try:
+            ss = StyleCatalog(data_dir)
+        except (OSError, ValueError, RuntimeError) as e:
+            raise SnapshotError(f"Failed to load the catalog in {data_dir}: {e}")
+        manifest = describe(ss, LIVE_VERSION)
+        version = LIVE_VERSION
+    else:
+        if version not in list_versions():
+            raise SnapshotError(f"Snapshot {version} not found in {snapshots_dir}.")
+        manifest = load_snapshot_manifest(version)
+        check_manifest(version, manifest)
+        try:
+            ss = StyleCatalog(snapshot_path(version))
+        except (OSError, ValueError, RuntimeError) as e:
+            raise SnapshotError(f"Failed to load snapshot {version}: {e}")
+    validate(ss, manifest)
+    snapshot = Snapshot(version, ss, manifest)
+    logging.info(f"Loaded snapshot {version} ({manifest['rows']} rows) in {time.perf_counter() - start:.2f}s.")
+    return snapshot
+
+
+class SnapshotRegistry:
+    """
+    Holds the active snapshot and swaps it atomically.
+
+    Requests take the active snapshot with `acquire` and use only that
+    snapshot until they finish. A swapped-out snapshot is kept while requests
+    still hold it and closed when the last one releases it.
+    """
+
+    def __init__(self, snapshot):
+        self._lock = threading.Lock()
+        self.active = snapshot
+        self.draining = []
+
+    @contextmanager
+    def acquire(self):
+        with self._lock:
+            snapshot = self.active
+            snapshot.refs += 1
+        try:
+            yield snapshot
+        finally:
+            self._release(snapshot)
+
+    def _release(self, snapshot):
+        with self._lock:
+            snapshot.refs -= 1
+            retired = snapshot is not self.active and snapshot.refs == 0 and snapshot in self.draining
+            if retired:
+                self.draining.remove(snapshot)
+        if retired:
+            snapshot.close()
+            logging.info(f"Released snapshot {snapshot.version}.")
+
+    def swap(self, snapshot):
+        """
+        Make `snapshot` active.
+
+        Returns:
+            Snapshot: The previously active snapshot.
+        """
+        with self._lock:
+            old, self.active = self.active, snapshot
+            idle = old.refs == 0
+            if not idle:
+                self.draining.append(old)
+        if idle:
+            old.close()
+        logging.info(f"Switched from snapshot {old.version} to {snapshot.version}.")
+        return old
+
+    def status(self):
+        with self._lock:
+            return {"active": self.active.info(), "draining": [snapshot.info() for snapshot in self.draining]}
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Versioned catalog snapshots.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    publish_parser = subparsers.add_parser("publish", help="Copy the current data/ artifacts into a new snapshot.")
+    publish_parser.add_argument("--keep", type=int, help="Keep only this many newest snapshots.")
+    publish_parser.add_argument("--no-activate", action="store_true", help="Do not point CURRENT at the new snapshot.")
+    subparsers.add_parser("list", help="List published snapshots.")
+    args = parser.parse_args()
+
+    if args.command == "publish":
+        manifest = publish(keep=args.keep, activate=not args.no_activate)
+        print(json.dumps(manifest, ensure_ascii=False, indent=2))
+    else:
+        current = current_version()
+        for version in list_versions():
+            manifest = load_snapshot_manifest(version)
+            print(f"{'*' if version == current else ' '} {version}  {manifest['created_at']}  "
+                  f"rows={manifest['rows']}  labels={manifest['labels']}  catalog_version={manifest['catalog_version']}")
+
+
+if __name__ == "__main__":
+    main()
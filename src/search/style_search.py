@@ -1,120 +1,430 @@
-import faiss
-import pickle
-import numpy as np
+"""
+风格目录: 列式目录、精排向量、图片分组、标签表和六个字段索引
+
+StyleCatalog(data_dir) 只读加载一个目录 (data/ 或某个已发布的快照): 任何文件缺失、过期或彼此不一致时
+抛出 StaleCatalogError, 不会重建或改写目录中的文件. StyleCatalog(data_dir, build=True) 用于离线建库
+(本脚本、catalog_update、snapshot publish、index_benchmark): 转换旧版 pickle, 重建过期的图片分组和索引,
+并写回标签表和目录版本清单.
+
+用法:
+    python -m src.search.style_search
+"""
 import os
 import logging
+import argparse
+
+import faiss
+import numpy as np
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+from .ann_index import BINARY_RESCORE_OVERSAMPLE, is_binary, set_search_params, load_index_config
+from .index_manifest import file_stamp, load_manifest, save_manifest, load_labels, save_labels
+from .embedding import truncate_and_normalize
+from .column_store import catalog_exists, meta_path, open_catalog, migrate_pickles
+from .metadata_filter import rescore_exact
+from .search_utils import (FIELD_KEYS, INDEX_COLLAPSE, build_index, build_group_ids, group_members, collapse_vectors,
+                           search_index)
 
 # 动态生成文件路径
 base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 data_dir = os.path.join(base_dir, 'data')
 
-# 检查并创建 data 目录
-if not os.path.exists(data_dir):
-    os.makedirs(data_dir)
 
-# Load pickle files
-def load_pkl(file_path):
-    with open(file_path, 'rb') as f:
-        return pickle.load(f)
+class StaleCatalogError(ValueError):
+    """Raised when a read-only catalog has missing, stale or mismatched files."""
 
-vector_dict_path = os.path.join(data_dir, 'vectors_dict.pkl')
-slugs_path = os.path.join(data_dir, 'slugs.pkl')
-img_urls_path = os.path.join(data_dir, 'img_urls.pkl')
-all_ai_info_path = os.path.join(data_dir, 'all_ai_info.pkl')
 
-vector_dict = load_pkl(vector_dict_path)
-slugs = load_pkl(slugs_path)
-img_urls = load_pkl(img_urls_path)
-all_ai_info = load_pkl(all_ai_info_path)
-
-# Build FAISS index
-def build_index(vectors, index_type="flat", save_path=None):
+def save_group_ids(group_ids_path, group_ids, img_urls):
+    """
+    保存图片分组, 同时记录生成它的 img_urls 列的哈希
     """
-    Build a FAISS index for the given vectors.
+    tmp_path = group_ids_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, group_ids=group_ids, img_urls_digest=np.str_(img_urls.digest()))
+    os.replace(tmp_path, group_ids_path)
+
 
-    Args:
-        vectors (list): List of vectors to index.
-        index_type (str): Type of FAISS index to use ("flat" or "ivf").
-        save_path (str): Path to save the built index (optional).
+class StyleCatalog:
+    """
+    One catalog directory and the field indexes over it.
 
-    Returns:
-        faiss.Index: The built FAISS index.
+    Read-only by default: loading never writes into the directory, so a
+    published snapshot stays exactly as it was published. With build=True
+    missing or stale artifacts are rebuilt and written back; only the
+    offline tools do that.
     """
-    if not vectors or len(vectors) == 0:
-        raise ValueError("The input vectors are empty or invalid.")
 
-    d = len(vectors[0])  # Vector dimension
-    vectors_np = np.array(vectors).astype('float32')
+    def __init__(self, data_dir, build=False, collapse=INDEX_COLLAPSE):
+        """
+        Args:
+            data_dir (str): Directory holding catalog/, the index files and the manifests.
+            build (bool): Rebuild and save missing or stale artifacts instead of failing.
+            collapse (str): INDEX_COLLAPSE mode of the indexes to load.
 
-    if index_type == "flat":
-        index = faiss.IndexFlatL2(d)  # Flat L2 index
-    elif index_type == "ivf":
-        nlist = 100  # Number of clusters
-        quantizer = faiss.IndexFlatL2(d)
-        index = faiss.IndexIVFFlat(quantizer, d, nlist, faiss.METRIC_L2)
-        index.train(vectors_np)  # Train the IVF index
-    else:
-        raise ValueError(f"Unsupported index type: {index_type}")
+        Raises:
+            StaleCatalogError: In read-only mode, if an artifact is missing or stale.
+        """
+        self.data_dir = data_dir
+        self.build = build
+        self.collapse = collapse
+        self.catalog_dir = os.path.join(data_dir, 'catalog')
+        # 精排用的长前缀向量 (vector.py 写入, float16), 以 mmap 方式按需读取候选行
+        self.rerank_dir = os.path.join(data_dir, 'rerank_vectors')
+        # 目录版本清单和变更日志, 由 catalog_update.py 在增量更新时写入
+        self.catalog_manifest_path = os.path.join(data_dir, 'catalog_manifest.json')
+        self.catalog_changes_path = os.path.join(data_dir, 'catalog_changes.jsonl')
+        self.group_ids_path = os.path.join(data_dir, 'group_ids.npz')
+        # 每个字段选用的索引类型和参数, 由 index_benchmark.py 扫描后写入; 缺省为 flat
+        self.index_config_path = os.path.join(data_dir, 'index_config.json')
 
-    index.add(vectors_np)  # Add vectors to the index
-    logging.info(f"Built {index_type} index with {len(vectors)} vectors.")
+        # 列式目录 (catalog/): 字符串列按行号惰性解码, 向量为只读 mmap, 只在重建索引 / 精确计算时读入
+        # 旧版 vector.py 生成的 pickle 文件在建库时自动转换
+        if not catalog_exists(self.catalog_dir):
+            if not build:
+                raise StaleCatalogError(f"No catalog in {self.catalog_dir}, run `python -m src.search.style_search`.")
+            if os.path.exists(os.path.join(data_dir, 'vectors_dict.pkl')):
+                migrate_pickles(self.catalog_dir, data_dir)
+        self.load_catalog()
+        self.rerank_vectors = self.load_rerank_vectors()
 
-    if save_path:
-        faiss.write_index(index, save_path)
-        logging.info(f"Index saved to {save_path}.")
+        if not build and not os.path.exists(self.catalog_manifest_path):
+            raise StaleCatalogError(f"{self.catalog_manifest_path} not found, the indexes were never built.")
+        self.catalog_manifest = self.check_catalog(load_manifest(self.catalog_manifest_path))
+        # 已删除的行保留在向量文件中, 只在检索时过滤, compact 时才真正移除
+        self.row_alive = np.ones(len(self.slugs), dtype=bool)
+        self.row_alive[self.catalog_manifest["deleted_rows"]] = False
 
-    return index
+        self.group_ids = self.load_or_build_group_ids()
+        self.group_offsets, self.group_member_rows = group_members(self.group_ids, self.row_alive)
 
-# Load or build index
-def load_or_build_index(vectors, index_path, index_type="flat"):
-    """
-    Load a FAISS index from a file or build it if not available.
+        self.index_config = load_index_config(self.index_config_path)
+        # 索引标签 -> 所属图片组 (-1 表示已删除) / 用于展示的目录行
+        self.index_groups, self.index_rows, self.row_labels = None, None, None
+        self.field_indexes = self.load_field_indexes()
 
-    Args:
-        vectors (list): List of vectors to index.
-        index_path (str): Path to the index file.
-        index_type (str): Type of FAISS index to use ("flat" or "ivf").
+    def load_catalog(self):
+        """
+        (Re)open the catalog store and rebind the columns.
+        """
+        _, self.catalog_columns, self.vector_dict = open_catalog(self.catalog_dir)
+        self.slugs = self.catalog_columns["slugs"]
+        self.img_urls = self.catalog_columns["img_urls"]
+        self.all_ai_info = self.catalog_columns["all_ai_info"]
 
-    Returns:
-        faiss.Index: The loaded or built FAISS index.
-    """
-    if os.path.exists(index_path):
+    def load_rerank_vectors(self):
+        """
+        Memory-map the rerank matrix of every field. Matrices that are missing or
+        not aligned with the catalog rows are skipped (rerank is then unavailable
+        for that field).
+
+        Returns:
+            dict: vectors_dict key -> read-only (n_rows, rerank_dim) float16 memmap.
+        """
+        matrices = {}
+        for key in self.vector_dict:
+            path = os.path.join(self.rerank_dir, f'{key}.npy')
+            if not os.path.exists(path):
+                continue
+            matrix = np.load(path, mmap_mode='r')
+            if len(matrix) != len(self.slugs):
+                logging.warning(f"Rerank vectors {path} hold {len(matrix)} rows, catalog has {len(self.slugs)}. "
+                                f"Skipping.")
+                continue
+            matrices[key] = matrix
+        if matrices:
+            logging.info(f"Mapped rerank vectors for {len(matrices)} fields from {self.rerank_dir}.")
+        return matrices
+
+    def check_catalog(self, manifest):
+        """
+        Check that the catalog columns agree with each other and with the manifest.
+
+        If the catalog store was rewritten outside of catalog_update (e.g. by
+        re-running vector.py), a build bumps the catalog version and drops the
+        deleted rows and index entries, so every index is rebuilt instead of
+        being silently reused; a read-only load fails.
+
+        Args:
+            manifest (dict): Manifest from `load_manifest`.
+
+        Returns:
+            dict: The manifest for the current vectors.
+        """
+        n_rows = len(self.slugs)
+        lengths = {"img_urls": len(self.img_urls), "all_ai_info": len(self.all_ai_info),
+                   **{key: len(vectors) for key, vectors in self.vector_dict.items()}}
+        mismatched = {name: n for name, n in lengths.items() if n != n_rows}
+        if mismatched:
+            raise ValueError(f"Catalog files are out of sync: {n_rows} slugs but {mismatched}.")
+
+        stamp = file_stamp(meta_path(self.catalog_dir))
+        if manifest["vectors_stamp"] is not None and (manifest["vectors_stamp"] != stamp or manifest["rows"] != n_rows):
+            if not self.build:
+                raise StaleCatalogError(f"{self.catalog_dir} changed after its indexes were built.")
+            logging.warning(f"{self.catalog_dir} changed outside of catalog_update, all indexes will be rebuilt.")
+            manifest = {**manifest, "version": manifest["version"] + 1, "deleted_rows": [], "indexes": {}}
+        return {**manifest, "vectors_stamp": stamp, "rows": n_rows}
+
+    def load_or_build_group_ids(self):
+        """
+        Load the image groups. Groups built from a different img_urls column
+        (compared by content hash, not just length) are rebuilt, or rejected
+        in read-only mode.
+
+        Returns:
+            np.ndarray: int64 group id per row.
+        """
+        path = self.group_ids_path
+        if os.path.exists(path):
+            with np.load(path) as saved:
+                if str(saved["img_urls_digest"]) == self.img_urls.digest():
+                    logging.info(f"Loading image groups from {path}.")
+                    return saved["group_ids"]
+            if not self.build:
+                raise StaleCatalogError(f"Image groups in {path} were built from other image URLs.")
+            logging.info(f"Image groups in {path} were built from other image URLs, rebuilding.")
+        elif not self.build:
+            raise StaleCatalogError(f"{path} not found.")
+        group_ids = build_group_ids(self.img_urls)
+        save_group_ids(path, group_ids, self.img_urls)
+        logging.info(f"Built {group_ids.max() + 1 if len(group_ids) else 0} image groups for {len(group_ids)} rows.")
+        return group_ids
+
+    def index_path_for(self, name, collapse=None, index_type="flat"):
+        collapse = self.collapse if collapse is None else collapse
+        suffix = "" if collapse == "none" else f".{collapse}"
+        if index_type != "flat":
+            suffix += f".{index_type}"
+        return os.path.join(self.data_dir, f'index4{name}{suffix}.faiss')
+
+    def index_labels_path(self, collapse=None):
+        collapse = self.collapse if collapse is None else collapse
+        suffix = "" if collapse == "none" else f".{collapse}"
+        return os.path.join(self.data_dir, f'index_labels{suffix}.npz')
+
+    def field_vectors(self, key, collapse=None):
+        """
+        Vectors of a freshly built index for one field, aligned with `build_labels`.
+        """
+        collapse = self.collapse if collapse is None else collapse
+        if self.row_alive.all():
+            vectors, groups = self.vector_dict[key], self.group_ids
+        else:
+            live_rows = np.flatnonzero(self.row_alive)
+            vectors, groups = self.vector_dict[key][live_rows], self.group_ids[live_rows]
+        if collapse == "none":
+            return vectors
+        return collapse_vectors(vectors, groups, collapse)
+
+    def row_vectors(self, key, rows, dim=None):
+        """
+        Vectors of some catalog rows: the index vectors, or the re-normalized
+        `dim`-long prefix of the rerank vectors.
+        """
+        if dim is None:
+            return self.vector_dict[key][rows]
+        return truncate_and_normalize(self.rerank_vectors[key][rows, :dim], dim)
+
+    def label_vectors(self, key, labels, dim=None):
+        """
+        Exact vectors of the given index labels of one field, row vectors or
+        re-collapsed group vectors depending on the collapse mode.
+
+        Args:
+            key (str): vectors_dict key of the field.
+            labels (np.ndarray): Live index labels.
+            dim (int): Prefix length of the rerank vectors; the index vectors when None.
+
+        Returns:
+            np.ndarray: float32 array of shape (len(labels), d).
+        """
+        if self.collapse == "none":
+            return self.row_vectors(key, self.index_rows[labels], dim)
+        groups = self.index_groups[labels]
+        members = np.flatnonzero(np.isin(self.group_ids, groups) & self.row_alive)
+        vectors = collapse_vectors(self.row_vectors(key, members, dim), self.group_ids[members], self.collapse)
+        return vectors[np.searchsorted(np.unique(groups), groups)]
+
+    def rerank_dim_limit(self, key):
+        """
+        字段可用于精排的最大前缀长度, 没有精排向量时为 0
+        """
+        return self.rerank_vectors[key].shape[1] if key in self.rerank_vectors else 0
+
+    def rerank_results(self, key, query_vectors, results, dim):
+        """
+        Re-score search candidates exactly with a longer Matryoshka prefix.
+
+        The index is searched with short (EMBED_DIM) vectors; the candidates it
+        returns are re-ordered by L2 distance between the re-normalized `dim`-long
+        prefixes of the query and of the candidate vectors.
+
+        Args:
+            key (str): vectors_dict key of the field.
+            query_vectors (np.ndarray): Query matrix of shape (n, D) with D >= dim.
+            results (list): One (distances, labels) pair per query, e.g. from `search_unique`.
+            dim (int): Prefix length, at most `rerank_dim_limit(key)`.
+
+        Returns:
+            list: One (distances, labels) pair per query, sorted by the new distances.
+        """
+        candidates = np.unique(np.concatenate([labels for _, labels in results] + [np.array([], dtype='int64')]))
+        if len(candidates) == 0:
+            return results
+        queries = truncate_and_normalize(query_vectors, dim)
+        vectors = self.label_vectors(key, candidates, dim)
+        reranked = []
+        for query, (_, labels) in zip(queries, results):
+            d2 = ((vectors[np.searchsorted(candidates, labels)] - query) ** 2).sum(axis=1)
+            order = np.argsort(d2, kind='stable')
+            reranked.append((d2[order].astype('float32'), labels[order]))
+        return reranked
+
+    def build_labels(self, collapse=None):
+        """
+        Label table of a freshly built index: one label per live row, or one per
+        image group that still has live rows.
+
+        Returns:
+            tuple: (index_groups, index_rows) int64 arrays.
+        """
+        collapse = self.collapse if collapse is None else collapse
+        if collapse == "none":
+            live_rows = np.flatnonzero(self.row_alive)
+            return self.group_ids[live_rows], live_rows
+        groups = np.flatnonzero(np.diff(self.group_offsets) > 0)
+        return groups, self.group_member_rows[self.group_offsets[groups]]
+
+    def build_row_labels(self):
+        """
+        目录行 -> 当前索引中的标签 (折叠索引中为该行所属图片组的标签), 已删除的行为 -1
+        """
+        row_labels = np.full(len(self.group_ids), -1, dtype='int64')
+        alive_labels = np.flatnonzero(self.index_groups >= 0)
+        if self.collapse == "none":
+            row_labels[self.index_rows[alive_labels]] = alive_labels
+        else:
+            group_labels = np.full(self.group_ids.max() + 1, -1, dtype='int64')
+            group_labels[self.index_groups[alive_labels]] = alive_labels
+            row_labels[self.row_alive] = group_labels[self.group_ids[self.row_alive]]
+        return row_labels
+
+    def member_slugs(self, row):
+        """
+        同一图片组内所有行的 slug
+        """
+        g = self.group_ids[row]
+        return [self.slugs[i] for i in self.group_member_rows[self.group_offsets[g]:self.group_offsets[g + 1]]]
+
+    def field_index_spec(self, name):
+        field_config = self.index_config.get(name, {})
+        index_type = field_config.get("index_type", "flat")
+        return index_type, field_config.get("params", {}), self.index_path_for(name, index_type=index_type)
+
+    def load_current_index(self, name, n_labels):
+        """
+        读取字段索引; 文件缺失、版本落后于目录或向量数与标签表不一致时返回 None
+        """
+        index_type, params, index_path = self.field_index_spec(name)
+        if not os.path.exists(index_path):
+            logging.info(f"Index {index_path} not found.")
+            return None
+        entry = self.catalog_manifest["indexes"].get(os.path.basename(index_path), {})
+        if entry.get("version", 0) != self.catalog_manifest["version"]:
+            logging.info(f"Index {index_path} is from catalog version {entry.get('version', 0)}, "
+                         f"current is {self.catalog_manifest['version']}.")
+            return None
         logging.info(f"Loading index from {index_path}.")
-        return faiss.read_index(index_path)
-    else:
-        logging.info(f"Index file not found. Building a new {index_type} index.")
-        return build_index(vectors, index_type=index_type, save_path=index_path)
-
-# Build or load indices for different vector types
-index4type_path = os.path.join(data_dir, 'index4type.faiss')
-index4content_path = os.path.join(data_dir, 'index4content.faiss')
-index4style_path = os.path.join(data_dir, 'index4style.faiss')
-index4features_path = os.path.join(data_dir, 'index4features.faiss')
-index4color_path = os.path.join(data_dir, 'index4color.faiss')
-index4all_ai_info_path = os.path.join(data_dir, 'index4all_ai_info.faiss')
-
-index4type = load_or_build_index(vector_dict["type_zh"], index4type_path, index_type="flat")
-index4content = load_or_build_index(vector_dict["desc_zh"], index4content_path, index_type="flat")
-index4style = load_or_build_index(vector_dict["ai_style_zh"], index4style_path, index_type="flat")
-index4features = load_or_build_index(vector_dict["ai_features_zh"], index4features_path, index_type="flat")
-index4color = load_or_build_index(vector_dict["ai_color_zh"], index4color_path, index_type="flat")
-index4all_ai_info = load_or_build_index(vector_dict["all_ai_info_zh"], index4all_ai_info_path, index_type="flat")
-
-# FAISS search function
-def search_index(index, query_vector, k=5):
-    """
-    Search the FAISS index for the k most similar vectors.
+        index = faiss.read_index(index_path)
+        if index.ntotal != n_labels or index.d != self.vector_dict[FIELD_KEYS[name]].shape[1]:
+            logging.warning(f"Index {index_path} holds {index.ntotal} vectors, label table has {n_labels}.")
+            return None
+        set_search_params(index, params)
+        return index
 
-    Args:
-        index (faiss.Index): The FAISS index to search.
-        query_vector (np.ndarray): The query vector.
-        k (int): Number of results to return.
+    def load_field_indexes(self):
+        """
+        Load the index of every field. A build rebuilds missing or stale ones;
+        a read-only load fails on them.
 
-    Returns:
-        tuple: Distances and indices of the top-k results.
-    """
-    D, I = index.search(query_vector, k)  # D: distances, I: indices
-    return D, I
+        All field indexes share one label table. After incremental updates the
+        table contains tombstoned labels, so rebuilding a single index would shift
+        its labels; in that case every index is rebuilt from the live rows.
+
+        Returns:
+            dict: Field name -> faiss.Index.
+
+        Raises:
+            StaleCatalogError: In read-only mode, if the label table or an index is missing or stale.
+        """
+        version = self.catalog_manifest["version"]
+        labels_path = self.index_labels_path()
+        labels = load_labels(labels_path, version)
+        if labels is None and not self.build:
+            raise StaleCatalogError(f"Label table {labels_path} is missing or not from catalog version {version}.")
+        fresh_groups, fresh_rows = self.build_labels()
+        self.index_groups, self.index_rows = labels if labels is not None else (fresh_groups, fresh_rows)
+
+        indexes = {name: self.load_current_index(name, len(self.index_rows)) for name in FIELD_KEYS}
+        stale = [name for name, index in indexes.items() if index is None]
+        if stale and not self.build:
+            raise StaleCatalogError(f"Indexes {stale} in {self.data_dir} are missing or stale.")
+        if stale and not (np.array_equal(self.index_groups, fresh_groups) and np.array_equal(self.index_rows, fresh_rows)):
+            logging.info(f"Indexes {stale} are stale, rebuilding all field indexes from the live rows.")
+            self.index_groups, self.index_rows = fresh_groups, fresh_rows
+            stale = list(FIELD_KEYS)
+        for name in stale:
+            index_type, params, index_path = self.field_index_spec(name)
+            indexes[name] = build_index(self.field_vectors(FIELD_KEYS[name]), index_type=index_type,
+                                        save_path=index_path, params=params)
+        self.row_labels = self.build_row_labels()
+        if self.collapse != "none":
+            logging.info(f"Collapsing {int(self.row_alive.sum())} rows into {int((self.index_groups >= 0).sum())} "
+                         f"image groups ({self.collapse}).")
+        if not self.build:
+            return indexes
+
+        if labels is None or stale:
+            save_labels(labels_path, version, self.index_groups, self.index_rows)
+        entries = {os.path.basename(self.field_index_spec(name)[2]): {"version": version, "ntotal": int(index.ntotal)}
+                   for name, index in indexes.items()}
+        manifest = {**self.catalog_manifest, "indexes": {**self.catalog_manifest["indexes"], **entries}}
+        if manifest != self.catalog_manifest or not os.path.exists(self.catalog_manifest_path):
+            self.catalog_manifest = manifest
+            save_manifest(self.catalog_manifest_path, self.catalog_manifest)
+        return indexes
+
+    def search_field(self, index, key, query_vectors, k):
+        """
+        search_index for a field index. A binary index ranks by Hamming distance,
+        so it is searched k * BINARY_RESCORE_OVERSAMPLE deep and its live
+        candidates are re-scored with exact L2 distances; the distances are then
+        comparable with every other index type and with filtered exact search.
+
+        Args:
+            index (faiss.Index): Field index.
+            key (str): vectors_dict key of the field.
+            query_vectors (np.ndarray): Query matrix of shape (n, d).
+            k (int): Number of results per query.
+
+        Returns:
+            tuple: (distances, labels) of shape (n, k), padded with -1 like faiss.
+        """
+        if not is_binary(index):
+            return search_index(index, query_vectors, k)
+        _, I = search_index(index, query_vectors, min(index.ntotal, k * BINARY_RESCORE_OVERSAMPLE))
+        # 已删除的标签没有对应的精确向量, 先去掉
+        I = np.where((I >= 0) & (self.index_groups[np.maximum(I, 0)] >= 0), I, -1)
+        return rescore_exact(lambda labels: self.label_vectors(key, labels), I, query_vectors, k)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Build the image groups and field indexes of the catalog in data/.")
+    parser.parse_args()
+    catalog = StyleCatalog(data_dir, build=True)
+    logging.info(f"Catalog version {catalog.catalog_manifest['version']}: {len(catalog.slugs)} rows, "
+                 f"{len(catalog.index_rows)} labels ({catalog.collapse}).")
+
+
+if __name__ == "__main__":
+    main()
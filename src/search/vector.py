@@ -1,10 +1,26 @@
+"""
+离线向量构建
+
+流式读取 JSONL, 按字段分批编码, 每个分片编码完成后立即落盘 (data/vector_shards/),
+中途崩溃后重新运行会跳过已完成的分片, 最后合并为连续的 float32 数组.
+
+用法:
+    python -m src.search.vector --batch-size 256 --shard-size 20000
+"""
 import os
 import json
+import glob
+import hashlib
+import logging
+import argparse
 import numpy as np
 from tqdm import tqdm
-from sentence_transformers import SentenceTransformer
-from sklearn.preprocessing import normalize
-import pickle
+
+from .embedding import ENCODER_ID, EMBED_DIM, RERANK_DIM, load_text_encoder, encode_texts, truncate_and_normalize
+from .embedding_cache import EmbeddingCache
+from .column_store import catalog_dir, write_catalog
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 
 # 动态生成文件路径
 base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -13,55 +29,245 @@ data_dir = os.path.join(base_dir, 'data')
 os.environ["HF_ENDPOINT"] = "https://hf-mirror.com"
 # 设置HF模型保存路径变量
 os.environ["HF_HOME"] = os.path.join(base_dir, ".cache/huggingface")
-text_encoder = SentenceTransformer("richinfoai/ritrieve_zh_v1")  # infgrad/stella-mrl-large-zh-v3.5-1792d
 
-# 加载所有数据
 jsonl_file_path = os.path.join(data_dir, 'midjoury_styles_lib_final_zh_en_demo.jsonl')
-with open(jsonl_file_path, 'r', encoding="utf-8") as f:
-    lines = [json.loads(data.strip()) for data in f.readlines()]
+shard_dir = os.path.join(data_dir, 'vector_shards')
+# 每个字段 RERANK_DIM 维前缀向量 (float16, 可 mmap), 供检索时精排
+rerank_dir = os.path.join(data_dir, 'rerank_vectors')
+embedding_cache_path = os.path.join(data_dir, 'embedding_cache.sqlite')
 
-need_embed_keys = [key for key in lines[0].keys() if "zh" in key]
+ALL_AI_INFO_KEY = "all_ai_info_zh"
 
-slugs = [line["slug_new"] for line in lines]
-img_urls = [line["img_url"] for line in lines]
-all_ai_info = [f"""描述: {line['ai_desc_zh']} 风格: {line['ai_style_zh']} 特征: {line['ai_features_zh']}  颜色: {line['ai_color_zh']}""" for line in lines]
 
-vectors_dict = {key: [] for key in need_embed_keys + ["all_ai_info_zh"]}
-for line in tqdm(lines):
-    slug = line["slug"]
-    for key in need_embed_keys:
-        texts = [str(line[key])]
-        print(key, texts)
-        try:
-            vectors = text_encoder.encode(texts, normalize_embeddings=False)
-            vectors_dict[key].append(normalize(vectors[:, :100])[0])  # d=1792d
-        except Exception as e:
-            print(f"Error processing slug {slug} for key {key}: {e}")
-            vectors_dict[key].append([0.0] * 100)
-    key_new = "all_ai_info_zh"
-    texts_new = [f"""描述: {line['ai_desc_zh']} 风格: {line['ai_style_zh']} 特征: {line['ai_features_zh']}  颜色: {line['ai_color_zh']}"""]
-    print(key_new, texts_new)
+def format_all_ai_info(line):
+    return f"""描述: {line['ai_desc_zh']} 风格: {line['ai_style_zh']} 特征: {line['ai_features_zh']}  颜色: {line['ai_color_zh']}"""
+
+
+def iter_jsonl(file_path):
+    """
+    逐行读取 JSONL, 不会把整个文件读入内存
+    """
+    with open(file_path, 'r', encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def iter_shards(file_path, shard_size):
+    """
+    按 shard_size 行切分 JSONL, 产出 (分片序号, 行列表)
+    """
+    shard = []
+    shard_idx = 0
+    for line in iter_jsonl(file_path):
+        shard.append(line)
+        if len(shard) >= shard_size:
+            yield shard_idx, shard
+            shard_idx += 1
+            shard = []
+    if shard:
+        yield shard_idx, shard
+
+
+def get_embed_keys(file_path):
+    first = next(iter_jsonl(file_path), None)
+    if first is None:
+        raise ValueError(f"No data found in {file_path}.")
+    return [key for key in first.keys() if "zh" in key] + [ALL_AI_INFO_KEY]
+
+
+def field_texts(rows, key):
+    if key == ALL_AI_INFO_KEY:
+        return [format_all_ai_info(line) for line in rows]
+    return [str(line[key]) for line in rows]
+
+
+def style_id(line):
+    """
+    与 process_data.py 写入 styles 表的主键一致
+    """
+    return str(line['id']) + str(line['slug_new'])
+
+
+def row_hash(line, keys):
+    """
+    一行所有被编码文本的哈希, 文本不变时无需重新编码
+    """
+    texts = [field_texts([line], key)[0] for key in keys]
+    return hashlib.sha1("\x1f".join(texts).encode("utf-8")).hexdigest()
+
+
+def embed_field(text_encoder, texts, batch_size, cache=None, dim=EMBED_DIM):
+    """
+    编码一个字段的所有文本; 整批失败时退化为逐条编码, 失败的行填充零向量
+    """
     try:
-        vectors = text_encoder.encode(texts_new, normalize_embeddings=False)
-        vectors_dict[key_new].append(normalize(vectors[:, :100])[0])  # d=1792d
+        return encode_texts(text_encoder, texts, dim=dim, batch_size=batch_size, cache=cache)
     except Exception as e:
-        print(f"Error processing slug {slug} for key {key}: {e}")
-        vectors_dict[key].append([0.0] * 100)
+        logging.warning(f"Batch encode failed ({e}), falling back to per-text encoding.")
+
+    vectors = np.zeros((len(texts), dim), dtype="float32")
+    for i, text in enumerate(texts):
+        try:
+            vectors[i] = encode_texts(text_encoder, [text], dim=dim, batch_size=1, cache=cache)[0]
+        except Exception as e:
+            logging.error(f"Error encoding text {text[:50]!r}: {e}")
+    return vectors
+
+
+def embed_rows(text_encoder, rows, keys, batch_size, cache=None):
+    """
+    Embed every field of some rows once at RERANK_DIM and derive the EMBED_DIM
+    index vectors from the same output (a re-normalized prefix).
+
+    Returns:
+        dict: key -> (n, EMBED_DIM) float32 and rerank_key(key) -> (n, RERANK_DIM) float16.
+    """
+    arrays = {}
+    for key in keys:
+        long_vectors = embed_field(text_encoder, field_texts(rows, key), batch_size, cache, dim=RERANK_DIM)
+        arrays[key] = truncate_and_normalize(long_vectors, EMBED_DIM)
+        arrays[rerank_key(key)] = long_vectors.astype("float16")
+    return arrays
+
+
+def rerank_key(key):
+    return f"{key}.rerank"
+
+
+def rerank_path(key):
+    return os.path.join(rerank_dir, f"{key}.npy")
+
+
+def shard_path(shard_idx):
+    return os.path.join(shard_dir, f"shard_{shard_idx:05d}.npz")
+
+
+def save_shard(path, arrays):
+    """
+    先写临时文件再原子替换, 保证崩溃时不会留下半个分片
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def check_checkpoint(meta, restart):
+    """
+    校验已有分片与本次运行的参数是否一致, 不一致时必须 --restart 重新开始
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    meta_path = os.path.join(shard_dir, "meta.json")
+    if restart:
+        for path in glob.glob(os.path.join(shard_dir, "shard_*.npz*")):
+            os.remove(path)
+    elif os.path.exists(meta_path):
+        with open(meta_path, "r", encoding="utf-8") as f:
+            old_meta = json.load(f)
+        if old_meta != meta:
+            raise ValueError(f"Existing shards in {shard_dir} were built with {old_meta}, "
+                             f"current run uses {meta}. Re-run with --restart.")
+    with open(meta_path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+
+def build_vectors(file_path=jsonl_file_path, batch_size=256, shard_size=20000, restart=False, cache=None):
+    """
+    Embed every `*_zh` field of the corpus shard by shard.
+
+    Args:
+        file_path (str): Source JSONL file.
+        batch_size (int): Number of texts per forward pass.
+        shard_size (int): Number of rows per checkpointed shard.
+        restart (bool): Discard existing shards instead of resuming.
+        cache (EmbeddingCache): Optional embedding cache; unchanged texts are not re-encoded.
+
+    Returns:
+        tuple: (vectors_dict, slugs, img_urls, all_ai_info, style_ids, style_hashes)
+    """
+    embed_keys = get_embed_keys(file_path)
+    meta = {"model": ENCODER_ID, "dim": EMBED_DIM, "rerank_dim": RERANK_DIM, "shard_size": shard_size, "keys": embed_keys,
+            "source": os.path.basename(file_path), "source_size": os.path.getsize(file_path),
+            "source_mtime": os.path.getmtime(file_path)}
+    check_checkpoint(meta, restart)
+
+    text_encoder = None
+    slugs, img_urls, all_ai_info, style_ids, style_hashes = [], [], [], [], []
+    shard_paths = []
+    for shard_idx, rows in tqdm(iter_shards(file_path, shard_size), desc="shards"):
+        slugs.extend(line["slug_new"] for line in rows)
+        img_urls.extend(line["img_url"] for line in rows)
+        all_ai_info.extend(format_all_ai_info(line) for line in rows)
+        style_ids.extend(style_id(line) for line in rows)
+        style_hashes.extend(row_hash(line, embed_keys) for line in rows)
+
+        path = shard_path(shard_idx)
+        shard_paths.append(path)
+        if os.path.exists(path):
+            logging.info(f"Shard {shard_idx} already embedded, skipping.")
+            continue
+
+        if text_encoder is None:
+            text_encoder = load_text_encoder()
+        save_shard(path, embed_rows(text_encoder, rows, embed_keys, batch_size, cache))
+        logging.info(f"Shard {shard_idx} embedded ({len(rows)} rows).")
+    if cache is not None:
+        logging.info(f"Embedding cache stats: {cache.stats()}")
+
+    vectors_dict = {}
+    for key in embed_keys:
+        parts = []
+        for path in shard_paths:
+            with np.load(path) as shard:
+                parts.append(shard[key])
+        vectors_dict[key] = np.ascontiguousarray(np.concatenate(parts), dtype="float32")
+    save_rerank_vectors(shard_paths, embed_keys, len(slugs))
+    return vectors_dict, slugs, img_urls, all_ai_info, style_ids, style_hashes
+
+
+def save_rerank_vectors(shard_paths, keys, n_rows):
+    """
+    逐个分片写入精排向量矩阵 (.npy, 可 mmap), 不需要把所有长向量同时放进内存
+    """
+    os.makedirs(rerank_dir, exist_ok=True)
+    for key in keys:
+        path = rerank_path(key)
+        tmp_path = path + ".tmp.npy"
+        matrix = np.lib.format.open_memmap(tmp_path, mode="w+", dtype="float16", shape=(n_rows, RERANK_DIM))
+        start = 0
+        for shard_file in shard_paths:
+            with np.load(shard_file) as shard:
+                part = shard[rerank_key(key)]
+            matrix[start:start + len(part), :part.shape[1]] = part
+            start += len(part)
+        matrix.flush()
+        del matrix
+        os.replace(tmp_path, path)
+    logging.info(f"Saved {RERANK_DIM}-d rerank vectors for {len(keys)} fields to {rerank_dir}.")
+
 
-# vectors_dict 本地化保存 pkl
-vectors_dict_path = os.path.join(data_dir, 'vectors_dict.pkl')
-slugs_path = os.path.join(data_dir, 'slugs.pkl')
-img_urls_path = os.path.join(data_dir, 'img_urls.pkl')
-all_ai_info_path = os.path.join(data_dir, 'all_ai_info.pkl')
+def main():
+    parser = argparse.ArgumentParser(description="Embed the style corpus into per-field vectors.")
+    parser.add_argument("--input", default=jsonl_file_path, help="Source JSONL file.")
+    parser.add_argument("--batch-size", type=int, default=256, help="Texts per forward pass.")
+    parser.add_argument("--shard-size", type=int, default=20000, help="Rows per checkpointed shard.")
+    parser.add_argument("--restart", action="store_true", help="Discard existing shards and start over.")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the embedding cache.")
+    args = parser.parse_args()
 
-with open(vectors_dict_path, "wb") as f:
-    pickle.dump(vectors_dict, f)
+    cache = None if args.no_cache else EmbeddingCache(embedding_cache_path, dim=RERANK_DIM)
+    vectors_dict, slugs, img_urls, all_ai_info, style_ids, style_hashes = build_vectors(
+        args.input, batch_size=args.batch_size, shard_size=args.shard_size, restart=args.restart, cache=cache)
 
-with open(slugs_path, "wb") as f:
-    pickle.dump(slugs, f)
+    # 写入列式目录: 向量为 (N, EMBED_DIM) 的 float32 矩阵;
+    # style_ids / style_hashes 为每行对应的 SQLite styles.id 和被编码文本的哈希, 供 catalog_update.py 做增量更新
+    write_catalog(catalog_dir, strings={"slugs": slugs, "img_urls": img_urls, "all_ai_info": all_ai_info,
+                                        "style_ids": style_ids, "style_hashes": style_hashes},
+                  vectors=vectors_dict)
+    logging.info(f"Saved vectors for {len(slugs)} rows to {catalog_dir}.")
 
-with open(img_urls_path, "wb") as f:
-    pickle.dump(img_urls, f)
 
-with open(all_ai_info_path, "wb") as f:
-    pickle.dump(all_ai_info, f)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
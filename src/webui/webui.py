@@ -1,13 +1,18 @@
 import gradio as gr
 import requests
 import base64
+import os
+from urllib.parse import quote
 
 # Define API endpoints
 BASE_URL = "http://127.0.0.1:8000"
-PIC_CAPTION_URL = f"{BASE_URL}/api/v1/pic_caption/url"
-PIC_CAPTION_FILE = f"{BASE_URL}/api/v1/pic_caption/file"
-EMBEDDING_URL = f"{BASE_URL}/api/v1/embedding"
-STYLE_SEARCH_URL = f"{BASE_URL}/api/v1/style_search"
+SEARCH_URL = f"{BASE_URL}/api/v1/search"
+# 结果图走 API 服务的缩略图缓存; 浏览器访问 API 的地址与 BASE_URL 不同时 (如反向代理) 需要设置
+THUMBNAIL_URL = f"{os.environ.get('THUMBNAIL_BASE_URL', BASE_URL)}/api/v1/thumbnail"
+
+
+def thumbnail_url(img_url, width):
+    return f"{THUMBNAIL_URL}?url={quote(img_url, safe='')}&w={width}"
 
 # Function to handle the inputs and call the appropriate API
 def process_input(text, img_url, img_file):
@@ -29,66 +34,29 @@ def process_input(text, img_url, img_file):
         </div>
         '''
 
+    # 描述、编码、检索都在服务端一次完成
     if text:
-        embedding_response = requests.post(EMBEDDING_URL, json={"text": text})
-        embedding_data = embedding_response.json()
-        query_vector = embedding_data["vector"]
-
-        style_search_response = requests.post(STYLE_SEARCH_URL, json={
-            "query_vector": query_vector,
-            "search_type": "all_ai_info",
-            "k": 50
-        })
-        style_search_data = style_search_response.json()
-        return uploaded_image_html, format_results(style_search_data)
-
+        response = requests.post(SEARCH_URL, data={"text": text, "search_type": "all_ai_info", "k": 50})
     elif img_url:
-        response = requests.post(PIC_CAPTION_URL, json={"img_url": img_url})
-        caption_data = response.json()
-
-        combined_text = f"{caption_data['desc']} {caption_data['style']} {caption_data['features']} {caption_data['color']}"
-
-        embedding_response = requests.post(EMBEDDING_URL, json={"text": combined_text})
-        embedding_data = embedding_response.json()
-        query_vector = embedding_data["vector"]
-
-        style_search_response = requests.post(STYLE_SEARCH_URL, json={
-            "query_vector": query_vector,
-            "search_type": "all_ai_info",
-            "k": 6
-        })
-        style_search_data = style_search_response.json()
-        return uploaded_image_html, format_results(style_search_data)
-
+        response = requests.post(SEARCH_URL, data={"img_url": img_url, "search_type": "all_ai_info", "k": 6})
     elif img_file:
         with open(img_file.name, "rb") as f:
-            files = {"file": f}
-            response = requests.post(PIC_CAPTION_FILE, files=files)
-        caption_data = response.json()
-
-        combined_text = f"{caption_data['desc']} {caption_data['style']} {caption_data['features']} {caption_data['color']}"
-
-        embedding_response = requests.post(EMBEDDING_URL, json={"text": combined_text})
-        embedding_data = embedding_response.json()
-        query_vector = embedding_data["vector"]
-
-        style_search_response = requests.post(STYLE_SEARCH_URL, json={
-            "query_vector": query_vector,
-            "search_type": "all_ai_info",
-            "k": 6
-        })
-        style_search_data = style_search_response.json()
-        return uploaded_image_html, format_results(style_search_data)
-
+            response = requests.post(SEARCH_URL, data={"search_type": "all_ai_info", "k": 6}, files={"file": f})
     else:
         return "Please provide text, an image URL, or upload an image.", ""
 
+    style_search_data = response.json()
+    return uploaded_image_html, format_results(style_search_data)
+
 def format_results(style_search_data):
     results = '<div style="display: grid; grid-template-columns: repeat(3, 1fr); gap: 10px;">'
     for img_url, desc in zip(style_search_data["img_urls"], style_search_data["desc"]):
         results += f'''
         <div style="text-align: center; border: 1px solid #ddd; border-radius: 8px; padding: 10px; background-color: #f9f9f9;">
-            <img src="{img_url}" alt="{desc}" style="width: 100%; height: auto; border-radius: 8px;">
+            <a href="{img_url}" target="_blank">
+                <img src="{thumbnail_url(img_url, 256)}" srcset="{thumbnail_url(img_url, 256)} 256w, {thumbnail_url(img_url, 512)} 512w"
+                     sizes="(max-width: 900px) 50vw, 256px" loading="lazy" alt="{desc}" style="width: 100%; height: auto; border-radius: 8px;">
+            </a>
             <p style="margin-top: 10px; font-size: 14px; color: #333;">{desc}</p>
         </div>
         '''
@@ -0,0 +1,189 @@
+import os
+import sys
+import json
+import time
+import base64
+import hashlib
+import threading
+from io import BytesIO
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import pytest
+from PIL import Image
+
+# 以仓库根目录为工作目录运行 pytest 时也能导入 src
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.database.process_data import connect, create_schema
+from src.search.column_store import write_catalog
+from src.search.embedding import RERANK_DIM
+from src.search.search_utils import FIELD_KEYS
+from src.search.style_search import StyleCatalog
+from src.search.vector import embed_rows, rerank_key, row_hash, format_all_ai_info
+
+CAPTION = {"desc": "一只猫", "style": "写实", "features": "毛茸茸", "color": "红色"}
+
+
+def image_bytes(color, size=(64, 48), fmt="PNG"):
+    buffered = BytesIO()
+    Image.new("RGB", size, color).save(buffered, fmt)
+    return buffered.getvalue()
+
+
+def chat_line(content, done=False):
+    return json.dumps({"model": "stub", "message": {"role": "assistant", "content": content}, "done": done},
+                      ensure_ascii=False) + "\n"
+
+
+class StubOllama:
+    """
+    Local stand-in for an image host and the Ollama /api/chat endpoint.
+
+    GET /img/<name> serves `images[name]` (404 if missing). POST /api/chat
+    first answers with the statuses queued in `fail_statuses`, then sleeps
+    `delay` seconds and calls `reply(image)` with the decoded PIL image of
+    the request (None without one): a str is returned as the model output,
+    an int as the HTTP status.
+    """
+
+    def __init__(self):
+        self.images = {}
+        self.fail_statuses = []
+        self.delay = 0.0
+        self.reply = lambda image: "```json\n" + json.dumps(CAPTION, ensure_ascii=False) + "\n```"
+        self.chat_calls = 0
+        self.fetched = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                name = self.path.rsplit("/", 1)[-1]
+                with stub._lock:
+                    stub.fetched.append(name)
+                data = stub.images.get(name)
+                if data is None:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with stub._lock:
+                    stub.chat_calls += 1
+                    status = stub.fail_statuses.pop(0) if stub.fail_statuses else 200
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                try:
+                    if status == 200:
+                        time.sleep(stub.delay)
+                        images = (body.get("messages") or [{}])[0].get("images") or []
+                        image = Image.open(BytesIO(base64.b64decode(images[0]))).convert("RGB") if images else None
+                        reply = stub.reply(image)
+                        status = reply if isinstance(reply, int) else 200
+                    if status != 200:
+                        self.send_response(status)
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    payload = (chat_line(reply) + chat_line("", done=True)).encode("utf-8")
+                    try:
+                        self.send_response(200)
+                        self.send_header("Content-Type", "application/x-ndjson")
+                        self.send_header("Content-Length", str(len(payload)))
+                        self.end_headers()
+                        self.wfile.write(payload)
+                    except (BrokenPipeError, ConnectionResetError):
+                        pass  # 客户端已超时断开
+                finally:
+                    with stub._lock:
+                        stub.in_flight -= 1
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.api_url = self.base_url + "/api/chat"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def image_url(self, name):
+        return f"{self.base_url}/img/{name}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_ollama():
+    stub = StubOllama()
+    yield stub
+    stub.close()
+
+
+class StubEncoder:
+    """
+    Stand-in for the sentence encoder: every text maps to a fixed
+    pseudo-random RERANK_DIM vector, so equal texts embed identically.
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    def encode(self, texts, batch_size=32, normalize_embeddings=False, show_progress_bar=False):
+        self.calls += 1
+        seeds = [int(hashlib.md5(text.encode("utf-8")).hexdigest()[:8], 16) for text in texts]
+        return np.array([np.random.default_rng(seed).standard_normal(RERANK_DIM) for seed in seeds], dtype="float32")
+
+
+def style_row(i, image=None, **fields):
+    """
+    A styles table row; rows with the same image share an img_url and form one image group.
+    """
+    row = {"id": f"id-{i}", "slug_new": f"style-{i}", "name_zh": f"风格{i}", "name_en": f"Style {i}",
+           "img_url": f"https://img.example.com/{i if image is None else image}.jpg", "type_zh": "插画",
+           "desc_zh": f"描述{i}", "ai_desc_zh": f"画面{i}", "ai_style_zh": f"风格{i}", "ai_features_zh": f"特征{i}",
+           "ai_color_zh": f"颜色{i}"}
+    return {**row, **fields}
+
+
+def write_styles_db(path, rows):
+    conn = connect(path)
+    create_schema(conn)
+    columns = sorted({column for row in rows for column in row})
+    with conn:
+        conn.executemany(f"INSERT INTO styles ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                         [[row.get(column) for column in columns] for row in rows])
+    conn.close()
+
+
+def build_catalog(data_dir, rows, encoder, collapse="none"):
+    """
+    Embed rows into data_dir the way vector.py does (column store and rerank
+    matrices), then build the indexes as `python -m src.search.style_search`.
+
+    Returns:
+        StyleCatalog: The catalog opened with build=True.
+    """
+    keys = list(FIELD_KEYS.values())
+    arrays = embed_rows(encoder, rows, keys, batch_size=64)
+    os.makedirs(os.path.join(data_dir, "rerank_vectors"), exist_ok=True)
+    for key in keys:
+        np.save(os.path.join(data_dir, "rerank_vectors", f"{key}.npy"), arrays[rerank_key(key)])
+    write_catalog(os.path.join(data_dir, "catalog"),
+                  strings={"slugs": [row["slug_new"] for row in rows], "img_urls": [row["img_url"] for row in rows],
+                           "all_ai_info": [format_all_ai_info(row) for row in rows],
+                           "style_ids": [row["id"] for row in rows],
+                           "style_hashes": [row_hash(row, keys) for row in rows]},
+                  vectors={key: arrays[key] for key in keys})
+    return StyleCatalog(data_dir, build=True, collapse=collapse)
@@ -0,0 +1,106 @@
+import json
+import asyncio
+import argparse
+
+from PIL import Image
+
+from conftest import CAPTION, image_bytes
+from src.database.process_data import connect, create_schema
+from src.image_processing.bulk_caption import run, job_namespace
+from src.image_processing.ollama_picture_desc import PROMPT_CAPTION
+
+OLD_DESC = "旧描述"
+
+
+def make_db(path, stub):
+    stub.images.update({
+        "red.png": image_bytes((220, 20, 20)),
+        "blue.png": image_bytes((20, 20, 220)),
+        "green.png": image_bytes((20, 220, 20)),
+        "garbage.png": b"not an image",
+    })
+    items = {
+        "ok1": stub.image_url("red.png"),
+        "ok2": stub.image_url("red.png"),
+        "ollama": stub.image_url("blue.png"),
+        "junk": stub.image_url("green.png"),
+        "decode": stub.image_url("garbage.png"),
+        "missing": stub.image_url("missing.png"),
+        "no_image": "",
+    }
+    conn = connect(path)
+    create_schema(conn)
+    with conn:
+        conn.executemany("INSERT INTO styles (id, img_url, ai_desc_zh) VALUES (?, ?, ?)",
+                         [(item_id, url, OLD_DESC) for item_id, url in items.items()])
+    conn.close()
+
+
+def dominant(image):
+    r, g, b = image.resize((1, 1), Image.BOX).getpixel((0, 0))
+    return max((r, "red"), (g, "green"), (b, "blue"))[1]
+
+
+def job_args(db, api, **overrides):
+    args = dict(source="db", input=None, db=db, api=api, model="stub", fetch_concurrency=4, caption_concurrency=2,
+                rate=0.0, commit_every=2, limit=0, restart=False, no_update_styles=False, export=None)
+    return argparse.Namespace(**{**args, **overrides})
+
+
+def test_bulk_caption_counts_resume_and_styles(tmp_path, stub_ollama):
+    db = str(tmp_path / "styles.db")
+    make_db(db, stub_ollama)
+    # 红色: 正常描述; 蓝色: Ollama 返回 500 (重试后仍失败); 绿色: 无法解析的输出
+    caption = "```json\n" + json.dumps(CAPTION, ensure_ascii=False) + "\n```"
+    stub_ollama.reply = lambda image: {"red": caption, "blue": 500, "green": "no json here"}[dominant(image)]
+
+    summary = asyncio.run(run(job_args(db, stub_ollama.api_url)))
+    assert summary["total"] == 7
+    assert summary["ok"] == 2
+    assert summary["failures"] == {"ollama": 1, "caption": 1, "decode": 1, "fetch": 1, "no_image": 1}
+
+    conn = connect(db)
+    styles = {row[0]: row[1:] for row in conn.execute(
+        "SELECT id, ai_desc_zh, ai_style_zh, ai_features_zh, ai_color_zh FROM styles")}
+    assert styles["ok1"] == styles["ok2"] == (CAPTION["desc"], CAPTION["style"], CAPTION["features"], CAPTION["color"])
+    assert all(styles[item_id] == (OLD_DESC, None, None, None) for item_id in styles if not item_id.startswith("ok"))
+    errors = dict(conn.execute("SELECT id, error FROM caption_jobs WHERE namespace=? AND status='failed'",
+                               (job_namespace("stub", PROMPT_CAPTION),)))
+    assert errors["ollama"].startswith("ollama: ")
+    assert errors["junk"].startswith("caption: unusable model output")
+    conn.close()
+
+    # 重新运行只处理失败的行, 已成功的图片不再下载
+    stub_ollama.fetched.clear()
+    stub_ollama.reply = lambda image: json.dumps({"desc": "重试"}, ensure_ascii=False)
+    summary = asyncio.run(run(job_args(db, stub_ollama.api_url)))
+    assert summary["total"] == 5
+    assert summary["ok"] == 2
+    assert summary["failures"] == {"decode": 1, "fetch": 1, "no_image": 1}
+    assert "red.png" not in stub_ollama.fetched
+
+    conn = connect(db)
+    desc = dict(conn.execute("SELECT id, ai_desc_zh FROM styles"))
+    assert desc["ollama"] == desc["junk"] == "重试"
+    assert desc["ok1"] == CAPTION["desc"]
+    conn.close()
+
+
+def test_bad_items_do_not_stop_the_fetch_worker(tmp_path, stub_ollama, monkeypatch):
+    # 像素数超过 MAX_IMAGE_PIXELS 两倍时 PIL 抛出 DecompressionBombError
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 2000)
+    stub_ollama.images.update({"red.png": image_bytes((220, 20, 20), size=(32, 24)),
+                               "bomb.png": image_bytes((220, 20, 20), size=(100, 100))})
+    items = [("bomb", stub_ollama.image_url("bomb.png")), ("bad_url", "http://[::1/red.png"),
+             ("ok1", stub_ollama.image_url("red.png")), ("ok2", stub_ollama.image_url("red.png"))]
+    db = str(tmp_path / "styles.db")
+    conn = connect(db)
+    create_schema(conn)
+    with conn:
+        conn.executemany("INSERT INTO styles (id, img_url) VALUES (?, ?)", items)
+    conn.close()
+
+    # 只有一个下载 worker: 它因为坏条目退出时, 后面的条目就不会被处理
+    summary = asyncio.run(run(job_args(db, stub_ollama.api_url, fetch_concurrency=1)))
+    assert summary["ok"] == 2
+    assert summary["failures"] == {"decode": 1, "fetch": 1}
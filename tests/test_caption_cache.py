@@ -0,0 +1,71 @@
+from io import BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image, ImageFilter
+
+from conftest import CAPTION, image_bytes
+from src.image_processing.caption_cache import CaptionCache
+from src.image_processing.image_preprocess import prepare_image
+
+
+def textured_bytes(size, fmt="PNG", seed=0, quality=90):
+    noise = np.random.default_rng(seed).integers(0, 256, (48, 64, 3), dtype="uint8")
+    image = Image.fromarray(noise).filter(ImageFilter.GaussianBlur(4)).resize(size, Image.LANCZOS)
+    buffered = BytesIO()
+    image.save(buffered, fmt, **({"quality": quality} if fmt == "JPEG" else {}))
+    return buffered.getvalue()
+
+
+@pytest.fixture
+def cache_factory(tmp_path):
+    caches = []
+
+    def make(key_mode="sha256", **kwargs):
+        cache = CaptionCache(str(tmp_path / f"{key_mode}.sqlite"), "model", "prompt", key_mode=key_mode, **kwargs)
+        caches.append(cache)
+        return cache
+
+    yield make
+    for cache in caches:
+        cache.close()
+
+
+def test_sha256_key_hashes_raw_bytes(cache_factory):
+    cache = cache_factory()
+    assert not cache.needs_image
+    # 不解码图片: 任意字节都能算出 key
+    assert cache.key_for(b"not an image") == cache.key_for(b"not an image")
+    assert cache.key_for(image_bytes("red")) != cache.key_for(image_bytes("red", fmt="BMP"))
+
+
+def test_phash_key_from_preprocessed_image(cache_factory):
+    cache = cache_factory("phash")
+    assert cache.needs_image
+    with pytest.raises(ValueError):
+        cache.key_for(image_bytes("red"))
+
+    def key(data):
+        return cache.key_for(data, prepare_image(data))
+
+    original = textured_bytes((1600, 1200), "PNG")
+    assert key(original) == key(textured_bytes((800, 600), "JPEG"))
+    assert key(original) != key(textured_bytes((1600, 1200), "PNG", seed=1))
+    # 纯色图片没有纹理, 退回按文件字节匹配
+    assert key(image_bytes("red")).split(":")[1].startswith("s")
+    assert key(image_bytes("red")) != key(image_bytes("red", fmt="BMP"))
+
+
+def test_replacing_a_key_does_not_grow_entries(cache_factory):
+    cache = cache_factory(max_entries=10)
+    key = cache.key_for(image_bytes("red"))
+    for _ in range(20):
+        cache.put(key, CAPTION)
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["evictions"] == 0
+    assert cache.get(key) == CAPTION
+
+    for i in range(12):
+        cache.put(cache.key_for(bytes([i])), CAPTION)
+    assert cache.stats()["entries"] <= 10
+    assert cache.stats()["entries"] == cache._conn.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
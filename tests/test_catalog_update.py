@@ -0,0 +1,117 @@
+import json
+
+import numpy as np
+import pytest
+
+from conftest import StubEncoder, style_row, write_styles_db, build_catalog
+from src.search.catalog_update import apply_changes, compact, diff_catalog, fetch_db_styles, load_style_rows
+from src.search.search_utils import FIELD_KEYS, search_unique
+from src.search.style_search import StyleCatalog
+
+KEYS = list(FIELD_KEYS.values())
+# 图片 A 有两行, 其余每张图片一行
+IMAGES = "AABCDE"
+
+
+@pytest.fixture
+def encoder():
+    return StubEncoder()
+
+
+def make_catalog(tmp_path, encoder, collapse="none"):
+    rows = [style_row(i, image=image) for i, image in enumerate(IMAGES)]
+    return rows, build_catalog(str(tmp_path), rows, encoder, collapse=collapse)
+
+
+def live_style_ids(ss):
+    style_ids, _ = load_style_rows(ss, KEYS)
+    return [style_ids[row] for row in np.flatnonzero(ss.row_alive)]
+
+
+def live_groups(ss):
+    """每个有效标签对应图片组内所有行的 slug"""
+    return sorted(sorted(ss.member_slugs(row)) for row in ss.index_rows[ss.index_groups >= 0])
+
+
+def self_hits(ss):
+    """
+    用每个有效行自己的向量检索, 返回 styles.id -> 命中行的 styles.id
+    """
+    style_ids, _ = load_style_rows(ss, KEYS)
+    key = FIELD_KEYS["style"]
+    rows = np.flatnonzero(ss.row_alive)
+    results = search_unique(ss.field_indexes["style"], np.asarray(ss.vector_dict[key][rows]), 1, ss.index_groups)
+    return {style_ids[row]: style_ids[ss.index_rows[labels[0]]] for row, (_, labels) in zip(rows, results)}
+
+
+def test_sync_adds_updates_and_deletes(tmp_path, encoder):
+    rows, ss = make_catalog(tmp_path, encoder)
+    db_rows = [row for row in rows if row["id"] != "id-1"]
+    db_rows[1] = {**db_rows[1], "ai_style_zh": "新的风格"}  # id-2
+    db_rows.append(style_row(6, image="A"))
+    write_styles_db(str(tmp_path / "styles.db"), db_rows)
+
+    db_styles = fetch_db_styles(str(tmp_path / "styles.db"))
+    style_ids, style_hashes = load_style_rows(ss, KEYS)
+    added, updated, deleted = diff_catalog(ss, db_styles, style_ids, style_hashes, KEYS)
+    assert (added, updated, deleted) == (["id-6"], ["id-2"], ["id-1"])
+
+    summary = apply_changes(ss, [db_styles[sid] for sid in added + updated], deleted, text_encoder=encoder)
+    assert summary == {"version": 1, "upserted": 2, "deleted_rows": 2, "rows": 8, "live_rows": 6, "labels": 8}
+    # 被删除和被修改的旧行留作墓碑, 新行追加在末尾
+    assert ss.catalog_manifest["deleted_rows"] == [1, 2]
+    assert ss.index_groups[[1, 2]].tolist() == [-1, -1]
+    assert all(index.ntotal == 8 for index in ss.field_indexes.values())
+    assert list(ss.slugs) == [f"style-{i}" for i in range(7)] + ["style-2"]
+    # 与已有行同一图片的新行加入该图片组
+    assert ss.group_ids[6] == ss.group_ids[0]
+    assert ss.member_slugs(0) == ["style-0", "style-6"]
+    assert self_hits(ss) == {sid: sid for sid in ["id-0", "id-3", "id-4", "id-5", "id-6", "id-2"]}
+
+    style_ids, style_hashes = load_style_rows(ss, KEYS)
+    assert diff_catalog(ss, db_styles, style_ids, style_hashes, KEYS) == ([], [], [])
+    with open(ss.catalog_changes_path, encoding="utf-8") as f:
+        change = json.loads(f.readlines()[-1])
+    assert change["upserted_ids"] == ["id-6", "id-2"] and change["deleted_ids"] == ["id-1"]
+
+    # 只读加载得到同样的目录
+    reloaded = StyleCatalog(str(tmp_path))
+    assert reloaded.catalog_manifest["version"] == 1
+    assert np.array_equal(reloaded.index_groups, ss.index_groups)
+    assert np.array_equal(reloaded.row_alive, ss.row_alive)
+    assert self_hits(reloaded) == self_hits(ss)
+
+
+@pytest.mark.parametrize("collapse", ["none", "first"])
+def test_delete_and_compact_keep_style_ids(tmp_path, encoder, collapse):
+    _, ss = make_catalog(tmp_path, encoder, collapse)
+    before = self_hits(ss) if collapse == "none" else None
+
+    summary = apply_changes(ss, [], ["id-0", "id-3", "unknown"])
+    assert summary["deleted_rows"] == 2 and summary["live_rows"] == 4
+    assert live_style_ids(ss) == ["id-1", "id-2", "id-4", "id-5"]
+    # 折叠模式下删除 A 组的第一行: A 组换成新标签, 展示行变为该组剩下的一行
+    assert live_groups(ss) == [["style-1"], ["style-2"], ["style-4"], ["style-5"]]
+    tombstones = int((ss.index_groups < 0).sum())
+    assert tombstones == 2
+    if collapse == "none":
+        assert self_hits(ss) == {sid: sid for sid in live_style_ids(ss)}
+        assert all(before[sid] == sid for sid in live_style_ids(ss))
+        # 墓碑标签不会再被检索到, 即使用被删除行自己的向量查询
+        deleted = np.asarray(ss.vector_dict[FIELD_KEYS["style"]][[0, 3]])
+        for _, labels in search_unique(ss.field_indexes["style"], deleted, 6, ss.index_groups):
+            assert not np.isin(ss.index_rows[labels], [0, 3]).any()
+
+    summary = compact(ss)
+    assert summary["version"] == 2 and summary["rows"] == summary["labels"] == 4
+    assert (ss.index_groups >= 0).all()
+    assert list(ss.slugs) == ["style-1", "style-2", "style-4", "style-5"]
+    assert live_style_ids(ss) == ["id-1", "id-2", "id-4", "id-5"]
+    assert live_groups(ss) == [["style-1"], ["style-2"], ["style-4"], ["style-5"]]
+    if collapse == "none":
+        assert self_hits(ss) == {sid: sid for sid in live_style_ids(ss)}
+
+    reloaded = StyleCatalog(str(tmp_path), collapse=collapse)
+    assert reloaded.catalog_manifest["version"] == 2
+    assert live_style_ids(reloaded) == live_style_ids(ss)
+    assert live_groups(reloaded) == live_groups(ss)
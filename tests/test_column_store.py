@@ -0,0 +1,68 @@
+import os
+import json
+
+import numpy as np
+import pytest
+
+from conftest import StubEncoder, style_row, build_catalog
+from src.search.column_store import StringColumn, load_meta, meta_path, open_catalog, string_file, write_catalog
+from src.search.style_search import StaleCatalogError, StyleCatalog
+
+
+def test_generations_and_readers_of_the_old_meta(tmp_path):
+    store = str(tmp_path / "catalog")
+    meta = write_catalog(store, strings={"slugs": ["a", "b"], "img_urls": ["u1", "u2"]},
+                         vectors={"v": np.eye(2, dtype="float32")})
+    assert meta["generation"] == 1 and meta["rows"] == 2
+    assert meta["string_files"] == {"slugs": "slugs.g1", "img_urls": "img_urls.g1"}
+
+    # 旧 meta 的读者在新一代写入后仍读到旧数据
+    old_slugs = StringColumn(os.path.join(store, string_file(meta, "slugs")), meta["rows"])
+    meta = write_catalog(store, strings={"slugs": ["a", "b2", "c"], "img_urls": ["u1", "u2", "u3"]},
+                         vectors={"v": np.eye(3, dtype="float32")})
+    assert meta["generation"] == 2 and meta["rows"] == 3
+    assert list(old_slugs) == ["a", "b"]
+    _, strings, vectors = open_catalog(store)
+    assert list(strings["slugs"]) == ["a", "b2", "c"] and vectors["v"].shape == (3, 3)
+
+    # 只写一列时其余列沿用原文件; 比上一代更早的文件被删除
+    meta = write_catalog(store, strings={"slugs": ["x", "y", "z"]})
+    assert meta["generation"] == 3
+    assert meta["string_files"] == {"slugs": "slugs.g3", "img_urls": "img_urls.g2"}
+    assert not os.path.exists(os.path.join(store, "slugs.g1.blob"))
+    assert os.path.exists(os.path.join(store, "slugs.g2.blob"))
+    assert list(open_catalog(store)[1]["img_urls"]) == ["u1", "u2", "u3"]
+
+
+def test_rejects_mismatched_lengths(tmp_path):
+    store = str(tmp_path / "catalog")
+    write_catalog(store, strings={"slugs": ["a", "b"]})
+    with pytest.raises(ValueError):
+        write_catalog(store, strings={"slugs": ["a", "b", "c"], "img_urls": ["u1"]})
+    with pytest.raises(ValueError):
+        write_catalog(store, vectors={"v": np.zeros((3, 2), dtype="float32")})
+    assert load_meta(store)["generation"] == 1
+
+    # meta 中的行数多于列文件时拒绝打开
+    with open(meta_path(store), encoding="utf-8") as f:
+        meta = json.load(f)
+    with open(meta_path(store), "w", encoding="utf-8") as f:
+        json.dump({**meta, "rows": 3}, f)
+    with pytest.raises(ValueError):
+        open_catalog(store)
+
+
+def test_catalog_rewritten_after_indexes_were_built(tmp_path):
+    rows = [style_row(i) for i in range(4)]
+    ss = build_catalog(str(tmp_path), rows, StubEncoder())
+    StyleCatalog(str(tmp_path))
+
+    # 在 catalog_update 之外重写目录 (meta.json 的代号变了), 已建好的索引不再可信
+    write_catalog(ss.catalog_dir, strings={"slugs": [f"renamed-{i}" for i in range(4)]})
+    with pytest.raises(StaleCatalogError):
+        StyleCatalog(str(tmp_path))
+
+    rebuilt = StyleCatalog(str(tmp_path), build=True)
+    assert rebuilt.catalog_manifest["version"] == ss.catalog_manifest["version"] + 1
+    assert rebuilt.slugs[0] == "renamed-0"
+    assert StyleCatalog(str(tmp_path)).catalog_manifest["version"] == rebuilt.catalog_manifest["version"]
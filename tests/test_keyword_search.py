@@ -0,0 +1,56 @@
+import pytest
+
+from src.database.process_data import connect, create_schema
+from src.search.keyword_search import KeywordIndex
+
+STYLES = [
+    # slug_new, name_zh, name_en, categories_zh, features_zh, desc_zh
+    ("monet", "莫奈", "Claude Monet", "印象派", "光影 户外", "法国印象派画家"),
+    ("monet-garden", "莫奈花园", "Monet Garden", "风景", "花卉", "吉维尼的花园"),
+    ("bw-portrait", "人像摄影", "Portrait Photography", "肖像", "黑白 高对比", "经典的黑白肖像"),
+    ("bw-street", "街头摄影", "Street Photography", "纪实", "黑白 颗粒", "城市街景"),
+    ("oil-portrait", "古典油画", "Classical Oil", "肖像", "油画 暗调", "文艺复兴风格"),
+    ("ink", "水墨画", "Ink Wash", "国画", "留白", "传统水墨, 受莫奈影响的光影处理"),
+]
+
+
+@pytest.fixture(params=[True, False], ids=["fts", "no-fts"])
+def keyword_index(tmp_path, request):
+    conn = connect(str(tmp_path / "styles.db"))
+    create_schema(conn)
+    conn.executemany(
+        "INSERT INTO styles (id, slug_new, name_zh, name_en, categories_zh, features_zh, desc_zh) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [(str(i), *style) for i, style in enumerate(STYLES)])
+    if not request.param:
+        conn.execute("DROP TABLE styles_fts")
+    conn.commit()
+    conn.close()
+    index = KeywordIndex(str(tmp_path / "styles.db"))
+    yield index
+    index.close()
+
+
+def test_two_character_name(keyword_index):
+    slugs, scores = keyword_index.search("莫奈")
+    # 名称完全相同的排第一, 名称包含的其次, 只在描述中出现的排最后
+    assert slugs == ["monet", "monet-garden", "ink"]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_two_character_terms_in_other_columns(keyword_index):
+    slugs, _ = keyword_index.search("黑白 肖像")
+    # 两个词都命中的排在只命中一个词的前面
+    assert slugs[0] == "bw-portrait"
+    assert set(slugs[1:]) == {"bw-street", "oil-portrait"}
+
+
+def test_long_and_short_terms(keyword_index):
+    slugs, _ = keyword_index.search("印象派 黑白", k=10)
+    assert set(slugs) == {"monet", "bw-portrait", "bw-street"}
+    assert keyword_index.search("莫奈", k=1)[0] == ["monet"]
+
+
+def test_no_match(keyword_index):
+    assert keyword_index.search("赛博朋克") == ([], [])
+    assert keyword_index.search("   ") == ([], [])
@@ -0,0 +1,119 @@
+import math
+
+import faiss
+import numpy as np
+import pytest
+
+from conftest import write_styles_db
+from src.search import metadata_filter
+from src.search.ann_index import create_index
+from src.search.metadata_filter import MetadataFilter
+
+N, D, K = 800, 16, 10
+INDEX_PARAMS = {"flat": {}, "ivf": {"nlist": 16, "nprobe": 2}, "hnsw": {"M": 16, "efConstruction": 40, "efSearch": 16},
+                "binary": {}}
+
+
+@pytest.fixture(scope="module")
+def vectors():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((N, D)).astype("float32")
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.fixture
+def metadata(tmp_path, vectors):
+    """
+    每 4 行一个类别 (cat0 .. cat3); 第 5 行起每 100 行有一行 type_en = "rare"; 第 0 行已删除
+    """
+    rows = [{"id": str(i), "slug_new": f"s{i}", "categories_en": f"cat{i % 4}",
+             "type_en": "rare" if i % 100 == 5 else "common", "features_en": "bw,portrait" if i % 2 else "color"}
+            for i in range(N)]
+    write_styles_db(str(tmp_path / "styles.db"), rows)
+    row_labels = np.arange(N)
+    row_labels[0] = -1
+    calls = []
+
+    def label_vectors(key, labels):
+        calls.append(len(labels))
+        return vectors[labels]
+
+    mf = MetadataFilter(str(tmp_path / "styles.db"), [row["slug_new"] for row in rows], row_labels, N, label_vectors)
+    return mf, calls
+
+
+def selected_labels(selection):
+    return np.flatnonzero(np.unpackbits(selection.bitmap, count=N, bitorder="little"))
+
+
+def exact_top_k(vectors, labels, queries, k):
+    d2 = ((queries[:, None, :] - vectors[labels][None, :, :]) ** 2).sum(-1)
+    return labels[np.argsort(d2, axis=1, kind="stable")[:, :k]]
+
+
+def test_select_combines_fields(metadata):
+    mf, _ = metadata
+    assert mf.select({}) is None and mf.select({"type_en": []}) is None
+    # 同一字段的取值取并集, 不同字段取交集; 已删除的行不会被选中
+    cat0 = mf.select({"categories_en": ["cat0"]})
+    assert selected_labels(cat0).tolist() == list(range(4, N, 4))
+    both = mf.select({"categories_en": ["cat0", "cat1"], "features_en": ["bw"]})
+    assert selected_labels(both).tolist() == list(range(1, N, 4))
+    assert both.count == N // 4
+    assert mf.select({"categories_en": ["nope"]}).count == 0
+    with pytest.raises(ValueError):
+        mf.select({"name_en": ["x"]})
+
+
+@pytest.mark.parametrize("index_type", ["flat", "ivf", "hnsw", "binary"])
+@pytest.mark.parametrize("brute_force", [True, False])
+def test_filtered_search_on_both_sides_of_the_threshold(monkeypatch, metadata, vectors, index_type, brute_force):
+    mf, calls = metadata
+    selection = mf.select({"categories_en": ["cat1"]})
+    assert selection.count == N // 4
+    # 选中数等于阈值时精确计算, 比阈值多一个时交给 FAISS
+    monkeypatch.setattr(metadata_filter, "FILTER_BRUTE_FORCE_MAX", selection.count - (not brute_force))
+
+    index = create_index(vectors, index_type, INDEX_PARAMS[index_type])
+    queries = vectors[[3, 10, 501]] + 0.01
+    distances, labels = mf.search(index, "style", selection, queries, K)
+
+    assert labels.shape == (len(queries), K)
+    assert np.isin(labels, selected_labels(selection)).all()
+    # 精确计算和二值索引 (取候选后精确重排) 只调用 label_vectors
+    assert bool(calls) == (brute_force or index_type == "binary")
+    truth = exact_top_k(vectors, selected_labels(selection), queries, K)
+    if brute_force or index_type == "flat":
+        assert labels.tolist() == truth.tolist()
+        np.testing.assert_allclose(distances, ((queries[:, None] - vectors[labels]) ** 2).sum(-1), rtol=1e-4,
+                                   atol=1e-5)
+    else:
+        recall = np.mean([len(set(l) & set(t)) / K for l, t in zip(labels.tolist(), truth.tolist())])
+        assert recall >= 0.6
+
+
+def test_search_params_scale_with_selectivity(monkeypatch, metadata, vectors):
+    mf, _ = metadata
+    monkeypatch.setattr(metadata_filter, "FILTER_BRUTE_FORCE_MAX", 0)
+    created = []
+    for name in ("SearchParametersIVF", "SearchParametersHNSW"):
+        original = getattr(faiss, name)
+        monkeypatch.setattr(faiss, name, lambda original=original, name=name, **kwargs:
+                            created.append((name, kwargs)) or original(**kwargs))
+
+    ivf = create_index(vectors, "ivf", INDEX_PARAMS["ivf"])
+    hnsw = create_index(vectors, "hnsw", INDEX_PARAMS["hnsw"])
+    quarter = mf.select({"categories_en": ["cat2"]})
+    rare = mf.select({"type_en": ["rare"]})
+    for index in (ivf, hnsw):
+        for selection in (quarter, rare):
+            _, labels = mf.search(index, "style", selection, vectors[:2], 5)
+            assert np.isin(labels[labels >= 0], selected_labels(selection)).all()
+
+    selectivity = rare.count / N
+    assert [(name, kwargs.get("nprobe", kwargs.get("efSearch"))) for name, kwargs in created] == [
+        ("SearchParametersIVF", 2 * 4),  # nprobe / 0.25
+        ("SearchParametersIVF", 16),  # 不超过 nlist
+        ("SearchParametersHNSW", 16 * 4),
+        ("SearchParametersHNSW", min(4096, math.ceil(16 / selectivity))),
+    ]
@@ -0,0 +1,124 @@
+import os
+import json
+import time
+
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import Response
+from fastapi.testclient import TestClient
+
+from src.api.metrics import Registry, MetricsMiddleware, SlowRequestProfiler, current_trace
+
+BUCKETS = (0.01, 0.1, 1.0)
+
+
+def parse(text):
+    """
+    Prometheus 文本格式 -> {(指标名, 排序后的标签对): 值}
+    """
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name, value = line.rsplit(" ", 1)
+        labels = ()
+        if "{" in name:
+            name, raw = name[:-1].split("{", 1)
+            labels = tuple(sorted((key, label.strip('"')) for key, label in (pair.split("=", 1)
+                                                                             for pair in raw.split(","))))
+        samples[name, labels] = float(value)
+    return samples
+
+
+def make_app(tmp_path, slow_ms=0, profiler=None):
+    registry = Registry()
+    duration = registry.histogram("request_seconds", "Request latency", ("method", "route", "status"), BUCKETS)
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware, duration=duration, slow_log_path=str(tmp_path / "slow_requests.jsonl"),
+                       slow_ms=slow_ms, profiler=profiler)
+
+    @app.get("/items/{item_id}")
+    def get_item(item_id: int, sleep: float = 0):
+        start = time.perf_counter()
+        time.sleep(sleep)
+        current_trace.get().add("work", "style", round((time.perf_counter() - start) * 1000, 3))
+        if item_id < 0:
+            raise HTTPException(status_code=404, detail="No such item.")
+        return {"id": item_id}
+
+    @app.get("/metrics")
+    def metrics():
+        return Response(registry.render(), media_type="text/plain; version=0.0.4")
+
+    return app
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    histogram = registry.histogram("stage_seconds", "Stage latency", ("stage",), BUCKETS)
+    for value in (0.005, 0.05, 0.05, 0.5, 5.0):
+        histogram.observe(value, stage="embed")
+    histogram.observe(0.01, stage="search")  # 等于上界时计入该桶
+    samples = parse(registry.render())
+
+    def bucket(stage, le):
+        return samples["stage_seconds_bucket", (("le", le), ("stage", stage))]
+
+    assert [bucket("embed", le) for le in ("0.01", "0.1", "1.0", "+Inf")] == [1, 3, 4, 5]
+    assert [bucket("search", le) for le in ("0.01", "0.1", "1.0", "+Inf")] == [1, 1, 1, 1]
+    assert samples["stage_seconds_count", (("stage", "embed"),)] == 5
+    assert samples["stage_seconds_sum", (("stage", "embed"),)] == pytest.approx(5.605)
+    with pytest.raises(ValueError):
+        histogram.observe(1.0, search_type="style")
+    with pytest.raises(ValueError):
+        registry.counter("stage_seconds", "Duplicate")
+
+
+def test_requests_are_labelled_by_route_template(tmp_path):
+    app = make_app(tmp_path)
+    with TestClient(app) as client:
+        for item_id in (1, 2, 3, -1):
+            client.get(f"/items/{item_id}")
+        client.get("/nope/42")
+        samples = parse(client.get("/metrics").text)
+
+    def count(route, status):
+        return samples.get(("request_seconds_count", (("method", "GET"), ("route", route), ("status", status))))
+
+    # 实际路径 (/items/1 ...) 不会出现在标签中
+    assert count("/items/{item_id}", "200") == 3
+    assert count("/items/{item_id}", "404") == 1
+    assert count("unmatched", "404") == 1
+    assert not any("/items/1" in value for _, labels in samples for _, value in labels)
+    routes = {dict(labels)["route"] for name, labels in samples if name == "request_seconds_bucket"}
+    assert routes == {"/items/{item_id}", "unmatched"}
+    for labels in {tuple(pair for pair in labels if pair[0] != "le") for name, labels in samples
+                   if name == "request_seconds_bucket"}:
+        buckets = [samples["request_seconds_bucket", tuple(sorted(labels + (("le", le),)))]
+                   for le in ("0.01", "0.1", "1.0", "+Inf")]
+        assert buckets == sorted(buckets)
+        assert buckets[-1] == samples["request_seconds_count", labels]
+
+
+def test_slow_requests_are_logged_with_stages_and_profile(tmp_path):
+    profiler = SlowRequestProfiler(str(tmp_path / "profiles"), sample_rate=1.0, interval_ms=1)
+    app = make_app(tmp_path, slow_ms=50, profiler=profiler)
+    with TestClient(app) as client:
+        assert client.get("/items/7").status_code == 200
+        assert client.get("/items/8", params={"sleep": 0.2}).status_code == 200
+
+    with open(tmp_path / "slow_requests.jsonl", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    # 只有超过阈值的请求被记录
+    assert len(records) == 1
+    record = records[0]
+    assert (record["method"], record["route"], record["status"]) == ("GET", "/items/{item_id}", 200)
+    assert record["ms"] >= 200
+    assert [stage["stage"] for stage in record["stages"]] == ["work"] and record["stages"][0]["ms"] >= 200
+
+    # 采样栈以 folded 格式写出: "线程名;外层帧;...;内层帧 次数"
+    assert profiler.dumped == 1 and os.path.dirname(record["profile"]) == str(tmp_path / "profiles")
+    with open(record["profile"], encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert any("get_item (test_metrics.py:" in line for line in lines)
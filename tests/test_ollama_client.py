@@ -0,0 +1,93 @@
+import time
+import asyncio
+
+from conftest import CAPTION
+from src.image_processing.ollama_picture_desc import AsyncOllamaClient, PROMPT_CAPTION
+
+CAPTION_TEXT = f'{{"desc": "{CAPTION["desc"]}"}}'
+
+
+def caption_once(client, **kwargs):
+    async def call():
+        try:
+            return await client.pic_caption(PROMPT_CAPTION, "", **kwargs)
+        finally:
+            await client.aclose()
+    return asyncio.run(call())
+
+
+def test_timeout_fails_the_call(stub_ollama):
+    stub_ollama.delay = 2.0
+    client = AsyncOllamaClient(api_url=stub_ollama.api_url, model="stub", timeout=0.3, max_retries=0)
+    start = time.perf_counter()
+    assert caption_once(client) == ""
+    assert time.perf_counter() - start < 1.5
+    assert client.failures["caption"] == 1
+
+
+def test_retries_5xx_with_backoff(stub_ollama):
+    stub_ollama.reply = lambda image: CAPTION_TEXT
+    stub_ollama.fail_statuses = [503, 502]
+    client = AsyncOllamaClient(api_url=stub_ollama.api_url, model="stub", max_retries=2, backoff=0.1)
+    start = time.perf_counter()
+    assert caption_once(client) == CAPTION_TEXT
+    # 两次退避: 0.1 * 2^0 和 0.1 * 2^1, 各乘以 [1, 2) 的随机系数
+    assert time.perf_counter() - start >= 0.3
+    assert stub_ollama.chat_calls == 3
+    assert client.failures["caption"] == 0
+
+
+def test_gives_up_after_max_retries(stub_ollama):
+    stub_ollama.fail_statuses = [500] * 5
+    client = AsyncOllamaClient(api_url=stub_ollama.api_url, model="stub", max_retries=2, backoff=0.01)
+    assert caption_once(client) == ""
+    assert stub_ollama.chat_calls == 3
+    assert client.failures["caption"] == 1
+
+
+def test_does_not_retry_4xx(stub_ollama):
+    stub_ollama.fail_statuses = [404]
+    client = AsyncOllamaClient(api_url=stub_ollama.api_url, model="stub", max_retries=2, backoff=0.01)
+    assert caption_once(client) == ""
+    assert stub_ollama.chat_calls == 1
+
+
+def test_semaphore_bounds_in_flight_calls(stub_ollama):
+    stub_ollama.reply = lambda image: CAPTION_TEXT
+    stub_ollama.delay = 0.2
+
+    async def main():
+        client = AsyncOllamaClient(api_url=stub_ollama.api_url, model="stub", max_concurrency=2)
+        try:
+            return await asyncio.gather(*(client.pic_caption(PROMPT_CAPTION, "") for _ in range(6)))
+        finally:
+            await client.aclose()
+
+    start = time.perf_counter()
+    assert asyncio.run(main()) == [CAPTION_TEXT] * 6
+    assert stub_ollama.max_in_flight == 2
+    # 6 个调用, 每次最多 2 个在途, 至少需要 3 轮
+    assert time.perf_counter() - start >= 0.6
+
+
+def test_backoff_releases_the_semaphore(stub_ollama):
+    stub_ollama.reply = lambda image: CAPTION_TEXT
+    stub_ollama.fail_statuses = [503]
+
+    async def main():
+        client = AsyncOllamaClient(api_url=stub_ollama.api_url, model="stub", max_concurrency=1, backoff=0.5)
+        try:
+            retried = asyncio.create_task(client.pic_caption(PROMPT_CAPTION, ""))
+            await asyncio.sleep(0.1)  # 第一个调用收到 503, 正在退避
+            start = time.perf_counter()
+            assert await client.pic_caption(PROMPT_CAPTION, "") == CAPTION_TEXT
+            waited = time.perf_counter() - start
+            assert await retried == CAPTION_TEXT
+            return waited
+        finally:
+            await client.aclose()
+
+    # 退避至少 0.5 秒; 退避期间仍占着唯一的名额时, 第二个调用要等它结束
+    assert asyncio.run(main()) < 0.4
+    assert stub_ollama.chat_calls == 3
+    assert stub_ollama.max_in_flight == 1
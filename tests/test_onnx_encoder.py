@@ -0,0 +1,87 @@
+import json
+
+import numpy as np
+import pytest
+
+onnx = pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+tokenizers = pytest.importorskip("tokenizers")
+
+from onnx import helper, numpy_helper, TensorProto
+from src.search.embedding import MODEL_NAME, EMBED_DIM, RERANK_DIM, encode_texts
+from src.search.onnx_encoder import OnnxTextEncoder
+
+VOCAB = {"[PAD]": 0, "[UNK]": 1, **{c: i + 2 for i, c in enumerate("示例文本风格颜色红蓝abc")}}
+MAX_SEQ_LENGTH = 8
+HIDDEN = 16
+OUTPUT_DIM = RERANK_DIM + 32
+TEXTS = ["示例", "文本风格颜色红蓝", "a", "示例文本风格颜色红蓝abc示例"]
+
+
+@pytest.fixture(scope="module")
+def model_dir(tmp_path_factory):
+    """
+    A tiny exported encoder: per-character embeddings, masked mean pooling
+    and a linear projection, in the layout `onnx_encoder export` writes.
+    """
+    path = tmp_path_factory.mktemp("onnx")
+    tokenizer = tokenizers.Tokenizer(tokenizers.models.WordLevel(VOCAB, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.Split("", "isolated")
+    tokenizer.save(str(path / "tokenizer.json"))
+
+    rng = np.random.default_rng(0)
+    embeddings = rng.standard_normal((len(VOCAB), HIDDEN)).astype("float32")
+    projection = rng.standard_normal((HIDDEN, OUTPUT_DIM)).astype("float32")
+    nodes = [
+        helper.make_node("Gather", ["E", "input_ids"], ["x"]),
+        helper.make_node("Cast", ["attention_mask"], ["m"], to=TensorProto.FLOAT),
+        helper.make_node("Unsqueeze", ["m", "axis2"], ["m3"]),
+        helper.make_node("Mul", ["x", "m3"], ["xm"]),
+        helper.make_node("ReduceSum", ["xm", "axis1"], ["total"], keepdims=0),
+        helper.make_node("ReduceSum", ["m3", "axis1"], ["count"], keepdims=0),
+        helper.make_node("Div", ["total", "count"], ["pooled"]),
+        helper.make_node("MatMul", ["pooled", "W"], ["embedding"]),
+    ]
+    graph = helper.make_graph(
+        nodes, "encoder",
+        [helper.make_tensor_value_info("input_ids", TensorProto.INT64, ["batch", "seq"]),
+         helper.make_tensor_value_info("attention_mask", TensorProto.INT64, ["batch", "seq"])],
+        [helper.make_tensor_value_info("embedding", TensorProto.FLOAT, ["batch", OUTPUT_DIM])],
+        [numpy_helper.from_array(embeddings, "E"), numpy_helper.from_array(projection, "W"),
+         numpy_helper.from_array(np.array([2], dtype="int64"), "axis2"),
+         numpy_helper.from_array(np.array([1], dtype="int64"), "axis1")])
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid("", 17)])
+    model.ir_version = 8
+    onnx.save(model, str(path / "model.onnx"))
+
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantize_dynamic(str(path / "model.onnx"), str(path / "model_int8.onnx"), weight_type=QuantType.QInt8)
+
+    with open(path / "encoder.json", "w", encoding="utf-8") as f:
+        json.dump({"model": MODEL_NAME, "output_dim": OUTPUT_DIM, "max_seq_length": MAX_SEQ_LENGTH,
+                   "pad_token": "[PAD]", "pad_token_id": 0, "prompt": ""}, f)
+
+    def reference(text):
+        ids = [VOCAB.get(c, 1) for c in text][:MAX_SEQ_LENGTH]
+        return embeddings[ids].mean(0) @ projection
+
+    return str(path), np.stack([reference(text) for text in TEXTS])
+
+
+@pytest.mark.parametrize("backend, min_cosine", [("onnx", 0.99999), ("onnx-int8", 0.99)])
+@pytest.mark.parametrize("dim", [EMBED_DIM, RERANK_DIM])
+def test_encode_texts_shape_and_normalization(model_dir, backend, min_cosine, dim):
+    path, reference = model_dir
+    encoder = OnnxTextEncoder(path, backend=backend, num_threads=1)
+    vectors = encode_texts(encoder, TEXTS, dim=dim, batch_size=2)
+
+    assert vectors.shape == (len(TEXTS), dim)
+    assert vectors.dtype == np.float32
+    np.testing.assert_allclose(np.linalg.norm(vectors, axis=1), 1.0, rtol=1e-5)
+    expected = reference[:, :dim] / np.linalg.norm(reference[:, :dim], axis=1, keepdims=True)
+    assert ((vectors * expected).sum(axis=1) >= min_cosine).all()
+
+
+def test_encode_texts_empty(model_dir):
+    encoder = OnnxTextEncoder(model_dir[0], backend="onnx", num_threads=1)
+    assert encode_texts(encoder, [], dim=EMBED_DIM).shape == (0, EMBED_DIM)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from conftest import StubEncoder, style_row, build_catalog
+from src.search.embedding import EMBED_DIM, RERANK_DIM
+from src.search.search_utils import FIELD_KEYS
+
+KEY = FIELD_KEYS["style"]
+
+
+def unit(*pairs):
+    vector = np.zeros(RERANK_DIM, dtype="float32")
+    for dim, value in pairs:
+        vector[dim] = value
+    return vector
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    """
+    四行手工构造的精排向量 (前 EMBED_DIM 维之后的部分只有精排能看到), 查询为 (e0 + e200) / √2:
+        行 0: e0                      前缀距离 0,   全长距离 2 - √2
+        行 1: 0.8 e0 + 0.6 e1 + e200  前缀距离 0.4, 全长距离 0.2
+        行 2: e1                      前缀距离 2,   全长距离 2
+        行 3: e2 + e200               前缀距离 2,   全长距离 1
+    """
+    ss = build_catalog(str(tmp_path), [style_row(i) for i in range(4)], StubEncoder())
+    ss.rerank_vectors[KEY] = np.stack([unit((0, 1)), unit((0, 0.8), (1, 0.6), (200, 1)), unit((1, 1)),
+                                       unit((2, 1), (200, 1))])
+    return ss
+
+
+def test_longer_prefix_changes_the_order(catalog):
+    assert RERANK_DIM > 200 and catalog.rerank_dim_limit(KEY) == RERANK_DIM
+    query = unit((0, 1), (200, 1))[None]
+    candidates = [(np.zeros(4, dtype="float32"), np.array([0, 1, 2, 3]))]
+
+    # 只看前 EMBED_DIM 维时顺序不变
+    (distances, labels), = catalog.rerank_results(KEY, query, candidates, EMBED_DIM)
+    assert labels.tolist() == [0, 1, 2, 3]
+    np.testing.assert_allclose(distances, [0.0, 0.4, 2.0, 2.0], atol=1e-5)
+
+    (distances, labels), = catalog.rerank_results(KEY, query, candidates, RERANK_DIM)
+    assert labels.tolist() == [1, 0, 3, 2]
+    np.testing.assert_allclose(distances, [0.2, 2 - np.sqrt(2), 1.0, 2.0], atol=1e-5)
+    assert distances.dtype == np.float32
+
+
+def test_each_query_keeps_its_own_candidates(catalog):
+    queries = np.stack([unit((0, 1), (200, 1)), unit((1, 1))])
+    results = [(np.zeros(2, dtype="float32"), np.array([3, 0])), (np.zeros(3, dtype="float32"), np.array([0, 1, 2]))]
+    reranked = catalog.rerank_results(KEY, queries, results, RERANK_DIM)
+    assert [labels.tolist() for _, labels in reranked] == [[0, 3], [2, 1, 0]]
+
+    empty = [(np.array([], dtype="float32"), np.array([], dtype="int64"))]
+    assert catalog.rerank_results(KEY, queries[:1], empty, RERANK_DIM) is empty
@@ -0,0 +1,118 @@
+import faiss
+import numpy as np
+import pytest
+
+from conftest import StubEncoder, style_row, build_catalog
+from src.search.search_utils import FIELD_KEYS, fuse_results, search_unique
+
+
+def line_index(n):
+    """一维向量 0, 1, ..., n-1: 到查询点的 L2 距离就是差值的平方"""
+    index = faiss.IndexFlatL2(1)
+    index.add(np.arange(n, dtype="float32").reshape(-1, 1))
+    return index
+
+
+def recording(index, calls):
+    def search_fn(queries, fetch_k):
+        calls.append((len(queries), fetch_k))
+        return index.search(queries, fetch_k)
+    return search_fn
+
+
+def test_keeps_the_best_member_of_each_group():
+    group_ids = np.array([0, 1, 0, 2, 1])
+    distances, rows = search_unique(line_index(5), np.array([[2.1]]), 3, group_ids)[0]
+    # 组 0 的第 2 行比第 0 行近, 组 1 的第 1 行比第 4 行近
+    assert rows.tolist() == [2, 3, 1]
+    np.testing.assert_allclose(distances, [0.01, 0.81, 1.21], rtol=1e-4)
+
+
+def test_drops_deleted_rows():
+    group_ids = np.array([0, -1, 1, -1, 2])
+    _, rows = search_unique(line_index(5), np.array([[1.0]]), 3, group_ids)[0]
+    assert rows.tolist() == [0, 2, 4]
+
+
+def test_refetches_until_k_groups():
+    # 最近的 8 行都属于组 0, 第一次只取 k * oversample = 6 个候选, 不够 3 个组
+    index = line_index(12)
+    group_ids = np.array([0] * 8 + [1, 2, 3, 4])
+    calls = []
+    results = search_unique(index, np.array([[0.0], [11.0]]), 3, group_ids, search_fn=recording(index, calls))
+    assert results[0][1].tolist() == [0, 8, 9]
+    assert results[1][1].tolist() == [11, 10, 9]
+    # 只有第一个查询需要加深重查, 深度翻倍 (不超过候选总数)
+    assert calls == [(2, 6), (1, 12)]
+
+
+def test_returns_every_group_when_fewer_than_k():
+    index = line_index(6)
+    calls = []
+    _, rows = search_unique(index, np.array([[0.0]]), 5, np.array([0, 0, 1, 1, 2, 2]),
+                            search_fn=recording(index, calls))[0]
+    assert rows.tolist() == [0, 2, 4]
+    assert calls == [(1, 6)]
+
+
+def test_rejects_wrong_query_dimension():
+    with pytest.raises(ValueError):
+        search_unique(line_index(3), np.zeros((1, 2)), 1, np.zeros(3, dtype="int64"))
+
+
+@pytest.mark.parametrize("collapse", ["first", "mean"])
+def test_collapsed_labels_map_back_to_rows(tmp_path, collapse):
+    # 三张图片: A 有 3 行, B 有 1 行, C 有 2 行
+    rows = [style_row(i, image=image) for i, image in enumerate("AAABCC")]
+    ss = build_catalog(str(tmp_path), rows, StubEncoder(), collapse=collapse)
+    assert ss.index_groups.tolist() == [0, 1, 2]
+    assert ss.index_rows.tolist() == [0, 3, 4]
+    assert ss.row_labels.tolist() == [0, 0, 0, 1, 2, 2]
+    assert ss.member_slugs(5) == ["style-4", "style-5"]
+
+    key = FIELD_KEYS["style"]
+    index = ss.field_indexes["style"]
+    group_vectors = []
+    for label, group in enumerate(ss.index_groups):
+        members = ss.vector_dict[key][np.flatnonzero(ss.group_ids == group)]
+        mean = members.mean(axis=0)
+        group_vectors.append(members[0] if collapse == "first" else mean / np.linalg.norm(mean))
+        np.testing.assert_allclose(index.reconstruct(label), group_vectors[-1], rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(ss.label_vectors(key, np.array([label]))[0], group_vectors[-1],
+                                   rtol=1e-5, atol=1e-6)
+
+    # 用 C 组的向量检索: 命中 C 组的标签, 展示行是该组的第一行
+    _, labels = search_unique(index, group_vectors[2][None], 3, ss.index_groups)[0]
+    assert labels[0] == ss.row_labels[5] == 2
+    assert ss.index_rows[labels[0]] == 4
+    assert sorted(ss.index_groups[labels].tolist()) == [0, 1, 2]
+
+
+def test_rrf_fusion_weights_ranks():
+    # 索引 A 召回 1, 2, 3; 索引 B (权重 2) 召回 3, 1, 第三个位置为空 (-1)
+    results = [(np.array([0.1, 0.2, 0.3]), np.array([1, 2, 3])), (np.array([0.1, 0.5, 0.0]), np.array([3, 1, -1]))]
+    ids, scores = fuse_results(results, [1.0, 2.0], method="rrf", rrf_k=1)
+    assert ids.tolist() == [3, 1, 2]
+    np.testing.assert_allclose(scores, [1 / 4 + 2 / 2, 1 / 2 + 2 / 3, 1 / 3])
+    # 同分时按 id 升序
+    ids, _ = fuse_results([(np.zeros(2), np.array([7, 4])), (np.zeros(2), np.array([4, 7]))], [1.0, 1.0])
+    assert ids.tolist() == [4, 7]
+
+
+def test_distance_fusion_fills_missing_candidates():
+    # 相似度 1 - d/2: A 召回 1 (0.9), 2 (0.8), 3 (0.5); B 召回 3 (1.0), 5 (0.7)
+    results = [(np.array([0.2, 0.4, 1.0]), np.array([1, 2, 3])), (np.array([0.0, 0.6, 9.9]), np.array([3, 5, -1]))]
+    ids, scores = fuse_results(results, [1.0, 0.5], method="distance")
+    # 某个索引没召回的候选记为该索引召回结果中的最低相似度
+    assert ids.tolist() == [1, 2, 3, 5]
+    np.testing.assert_allclose(scores, [0.9 + 0.35, 0.8 + 0.35, 0.5 + 0.5, 0.5 + 0.35])
+
+    # 一个索引什么都没召回时, 它对所有候选的贡献为 0
+    ids, scores = fuse_results([results[0], (np.zeros(2), np.array([-1, -1]))], [1.0, 1.0], method="distance")
+    assert ids.tolist() == [1, 2, 3]
+    np.testing.assert_allclose(scores, [0.9, 0.8, 0.5])
+
+
+def test_fusion_rejects_unknown_method():
+    with pytest.raises(ValueError):
+        fuse_results([(np.zeros(1), np.array([0]))], [1.0], method="max")
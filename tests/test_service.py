@@ -0,0 +1,140 @@
+import base64
+import importlib
+from functools import partial
+
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+from conftest import StubEncoder, StubOllama, style_row, write_styles_db, build_catalog, image_bytes
+from src.image_processing.caption_cache import CaptionCache
+from src.image_processing.ollama_picture_desc import AsyncOllamaClient, PROMPT_CAPTION
+from src.search import embedding, snapshot
+from src.search.embedding import EMBED_DIM, RERANK_DIM
+from src.search.embedding_cache import EmbeddingCache
+from src.search.search_utils import FIELD_KEYS
+
+ROWS = [style_row(i) for i in range(8)]
+
+
+@pytest.fixture(scope="module")
+def stub():
+    stub = StubOllama()
+    yield stub
+    stub.close()
+
+
+@pytest.fixture(scope="module")
+def service(tmp_path_factory, stub):
+    """
+    在临时目录建库后导入 src.api.service: 文本编码器换成 StubEncoder, 快照、
+    缓存和 Ollama 客户端都指向临时目录和本地桩服务
+    """
+    data_dir = tmp_path_factory.mktemp("data")
+    db_path = str(data_dir / "midjourney_styles_demo.db")
+    write_styles_db(db_path, ROWS)
+    encoder = StubEncoder()
+    build_catalog(str(data_dir), ROWS, encoder)
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(embedding, "load_text_encoder", lambda *args, **kwargs: encoder)
+        mp.setattr(snapshot, "data_dir", str(data_dir))
+        mp.setattr(snapshot, "snapshots_dir", str(data_dir / "snapshots"))
+        mp.setattr(snapshot, "db_path", db_path)
+        service = importlib.import_module("src.api.service")
+        mp.setattr(service, "SNAPSHOT_POLL_INTERVAL", 0)
+        mp.setattr(service, "embedding_cache",
+                   EmbeddingCache(str(data_dir / "embedding_cache.sqlite"), dim=RERANK_DIM))
+        mp.setattr(service, "caption_cache",
+                   CaptionCache(str(data_dir / "caption_cache.sqlite"), "stub", PROMPT_CAPTION))
+        mp.setattr(service, "ollama_client", AsyncOllamaClient(api_url=stub.api_url, model="stub", max_retries=0))
+        yield service
+
+
+@pytest.fixture(scope="module")
+def client(service):
+    with TestClient(service.app) as client:
+        yield client
+
+
+def vectors_of(service, rows, dim=EMBED_DIM, key=FIELD_KEYS["style"]):
+    with service.snapshots.acquire() as snap:
+        if dim == EMBED_DIM:
+            return np.asarray(snap.ss.vector_dict[key][rows], dtype="float32")
+        return snap.ss.row_vectors(key, rows, dim)
+
+
+def test_batch_search_base64_and_lists_agree(service, client):
+    queries = vectors_of(service, [2, 5, 7])
+    payload = base64.b64encode(queries.astype("<f4").tobytes()).decode("ascii")
+    by_b64 = client.post("/api/v1/style_search/batch",
+                         json={"search_type": "style", "k": 3, "query_vectors_b64": payload})
+    by_list = client.post("/api/v1/style_search/batch",
+                          json={"search_type": "style", "k": 3, "query_vectors": queries.tolist()})
+    assert by_b64.status_code == by_list.status_code == 200
+    results = by_b64.json()["results"]
+    assert results == by_list.json()["results"]
+    # 每个查询的最近邻是它自己
+    assert [result["slugs"][0] for result in results] == ["style-2", "style-5", "style-7"]
+    assert all(len(result["indices"]) == 3 for result in results)
+
+    # 精排时 query 向量长度等于 rerank_dim
+    long_queries = vectors_of(service, [4], dim=256)
+    reranked = client.post("/api/v1/style_search/batch", json={
+        "search_type": "style", "k": 2, "rerank_dim": 256,
+        "query_vectors_b64": base64.b64encode(long_queries.astype("<f4").tobytes()).decode("ascii")})
+    assert reranked.status_code == 200 and reranked.json()["results"][0]["slugs"][0] == "style-4"
+
+    empty = client.post("/api/v1/style_search/batch", json={"search_type": "style", "query_vectors_b64": ""})
+    assert empty.status_code == 200 and empty.json() == {"results": []}
+
+
+@pytest.mark.parametrize("body, detail", [
+    ({"query_vectors_b64": "not base64!"}, "not valid base64"),
+    ({"query_vectors_b64": base64.b64encode(b"\0" * (4 * EMBED_DIM + 4)).decode("ascii")}, "multiple of"),
+    ({"query_vectors": [[0.0] * (EMBED_DIM - 1)]}, "dimension"),
+    ({}, "is required"),
+    ({"search_type": "nope", "query_vectors": [[0.0] * EMBED_DIM]}, "Invalid search type"),
+    ({"k": 0, "query_vectors": [[0.0] * EMBED_DIM]}, "k must be"),
+])
+def test_batch_search_rejects_bad_payloads(client, body, detail):
+    response = client.post("/api/v1/style_search/batch", json={"search_type": "style", **body})
+    assert response.status_code == 400
+    assert detail in response.json()["detail"]
+
+
+def test_search_by_image_url(client, stub):
+    stub.images["red.png"] = image_bytes("red")
+    response = client.post("/api/v1/search", data={"img_url": stub.image_url("red.png"), "k": 3})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["caption"]["desc"] == "一只猫" and len(body["slugs"]) == 3
+    assert {"fetch", "caption", "embed", "search", "total"} <= set(body["timings"])
+
+
+@pytest.mark.parametrize("source", ["url", "file"])
+def test_image_errors(monkeypatch, service, client, stub, source):
+    def search(name, data):
+        if source == "url":
+            stub.images[name] = data
+            return client.post("/api/v1/search", data={"img_url": stub.image_url(name)})
+        return client.post("/api/v1/search", files={"file": (name, data, "application/octet-stream")})
+
+    # 无法识别的图片格式
+    response = search("text.png", b"definitely not an image")
+    assert response.status_code == 400 and response.json()["detail"] == "Unsupported image format."
+    # 超过大小上限 (下载按流式读取计数, 上传读取 MAX_IMAGE_BYTES + 1 字节)
+    limit = len(image_bytes("blue")) - 1
+    if source == "url":
+        client_ = service.ollama_client
+        monkeypatch.setattr(client_, "fetch_image", partial(AsyncOllamaClient.fetch_image, client_, max_bytes=limit))
+    else:
+        monkeypatch.setattr(service, "MAX_IMAGE_BYTES", limit)
+    response = search("big.png", image_bytes("blue"))
+    assert response.status_code == 413 and str(limit) in response.json()["detail"]
+
+
+def test_image_url_errors(client, stub):
+    assert client.post("/api/v1/search", data={"img_url": "not a url"}).status_code == 400
+    response = client.post("/api/v1/search", data={"img_url": stub.image_url("missing.png")})
+    assert response.status_code == 400 and response.json()["detail"] == "Failed to process the image URL."